@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+"""
+承認・却下から一定期間が過ぎたリクエストを Redis から SQLite に移す
+
+    $ ARCHIVE_PATH=archive.sqlite3 python archive.py --days 90
+"""
+
+import argparse
+import os
+
+from purchase_bot.archive import Archive, archive_closed
+from purchase_bot.repo import PurchaseRepo, channel_namespace, connect_redis
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--days", type=float, default=90, help="Redis に残す日数")
+    parser.add_argument("--path", default=os.environ.get("ARCHIVE_PATH"), help="保管先の SQLite ファイル")
+    parser.add_argument("--batch-size", type=int, default=500, help="1 回に移すリクエスト数")
+    parser.add_argument("--include-undated", action="store_true",
+                        help="承認・却下の日時が記録されていない古いリクエストも移す")
+    parser.add_argument("--channel", help="購入申請チャンネルのID (省略時は SLACK_CHANNEL_ID)")
+    args = parser.parse_args()
+    if not args.path:
+        parser.error("--path or ARCHIVE_PATH is required")
+
+    client = connect_redis()
+    legacy_channel = os.environ.get("SLACK_CHANNEL_ID")
+    channel = args.channel or legacy_channel
+    namespace = channel_namespace(client, channel) if channel == legacy_channel else channel
+    archive = Archive(args.path, namespace=namespace)
+    repo = PurchaseRepo(client, archive=archive, namespace=namespace)
+    total = archive_closed(repo, archive, args.days, batch_size=args.batch_size,
+                           include_undated=args.include_undated)
+    print("archived {} requests".format(total))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+PurchaseBot の負荷試験
+
+偽の Slack クライアントと遅延を入れた Redis の代替を使い、シナリオごとに
+処理件数/秒・処理時間の p50/p99・Slack API と Redis の呼び出し数を計測する。
+
+    $ python bench.py --output bench.json
+    $ python bench.py --baseline bench.json
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+from fakes import FakeSlackClient, LatencyRedis
+from purchase_bot import PurchaseBot
+from purchase_bot.repo import PurchaseRepo
+from purchase_bot.runtime import replay
+
+CHANNEL = "CPURCHASE"
+ADMIN = "UADMIN"
+
+
+def _request_event(i, text=None):
+    return {"type": "message", "channel": CHANNEL, "user": "U{}".format(i % 50),
+            "text": text or "購入申請 {}".format(i), "ts": "{}.000100".format(1000 + i)}
+
+
+def _edit_event(i):
+    previous = _request_event(i)
+    return {"type": "message", "channel": CHANNEL, "subtype": "message_changed",
+            "message": {"text": previous["text"] + " (修正)", "ts": previous["ts"]},
+            "previous_message": previous}
+
+
+def _delete_event(i):
+    previous = _request_event(i)
+    return {"type": "message", "channel": CHANNEL, "subtype": "message_deleted",
+            "deleted_ts": previous["ts"], "previous_message": previous}
+
+
+def _command_event(text):
+    return {"type": "message", "channel": "D" + ADMIN, "user": ADMIN, "text": text}
+
+
+def _percentile(values, ratio):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * ratio))]
+
+
+class Harness:
+    """ 1 シナリオ分のボットと偽の外部サービス """
+
+    def __init__(self, slack_latency, redis_latency, workers):
+        self.slack = FakeSlackClient(latency=slack_latency)
+        self.redis = LatencyRedis(latency=redis_latency)
+        self.repo = PurchaseRepo(self.redis)
+        self.bot = PurchaseBot(client=self.slack, repo=self.repo, purchase_channel=CHANNEL)
+        self.bot._workers = workers
+        self.bot._outbox.min_interval = 0
+        self.repo.add_admin(ADMIN)
+        self.durations = []
+        handle = self.bot._handle_message
+
+        def timed(message):
+            start = time.perf_counter()
+            try:
+                handle(message)
+            finally:
+                self.durations.append(time.perf_counter() - start)
+
+        self.bot._handle_message = timed
+
+    def setup(self, events):
+        """ 計測前の状態を作る (計測には含めない) """
+        asyncio.run(self.bot.run(replay(events)))
+        self.reset()
+
+    def reset(self):
+        self.durations = []
+        self.slack.counts.clear()
+        self.redis.reset_stats()
+
+    def measure(self, events):
+        start = time.perf_counter()
+        asyncio.run(self.bot.run(replay(events)))
+        elapsed = time.perf_counter() - start
+        return {
+            "events": len(events),
+            "seconds": round(elapsed, 4),
+            "events_per_sec": round(len(events) / elapsed, 2) if elapsed else None,
+            "p50_ms": round(_percentile(self.durations, 0.5) * 1000, 3),
+            "p99_ms": round(_percentile(self.durations, 0.99) * 1000, 3),
+            "slack_calls": dict(self.slack.counts),
+            "redis_round_trips": self.redis.round_trips,
+            "redis_commands": dict(self.redis.commands),
+        }
+
+
+def scenario_burst(harness, size):
+    """ 購入申請が一度に届く """
+    return harness.measure([_request_event(i) for i in range(size)])
+
+
+def scenario_edits(harness, size):
+    """ 未承認リクエストの編集 """
+    harness.setup([_request_event(i) for i in range(size)])
+    return harness.measure([_edit_event(i) for i in range(size)])
+
+
+def scenario_deletes(harness, size):
+    """ 未承認リクエストの削除 """
+    harness.setup([_request_event(i) for i in range(size)])
+    return harness.measure([_delete_event(i) for i in range(size)])
+
+
+def scenario_range_approvals(harness, size):
+    """ 範囲指定での承認 """
+    harness.setup([_request_event(i) for i in range(size)])
+    step = 10
+    commands = ["承認 {}-{}".format(start, start + step - 1) for start in range(1, size + 1, step)]
+    return harness.measure([_command_event(text) for text in commands])
+
+
+def scenario_backlog(harness, size):
+    """ 大量の未承認リクエストがある状態での一覧表示 """
+    harness.setup([_request_event(i) for i in range(size)])
+    return harness.measure([_command_event("未承認") for _ in range(10)])
+
+
+SCENARIOS = {
+    "burst": scenario_burst,
+    "edits": scenario_edits,
+    "deletes": scenario_deletes,
+    "range_approvals": scenario_range_approvals,
+    "backlog": scenario_backlog,
+}
+
+
+def compare(results, baseline):
+    """ 基準の結果と比較した処理件数/秒の比率を表示する """
+    for name, result in results.items():
+        base = baseline.get(name)
+        if not base or not base.get("events_per_sec") or not result.get("events_per_sec"):
+            continue
+        ratio = result["events_per_sec"] / base["events_per_sec"]
+        print("{:<16} {:>10.2f} ev/s  ({:+.1%} vs baseline), round trips {} -> {}".format(
+            name, result["events_per_sec"], ratio - 1, base["redis_round_trips"], result["redis_round_trips"]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--size", type=int, default=200, help="シナリオあたりのリクエスト数")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS), help="実行するシナリオ")
+    parser.add_argument("--slack-latency", type=float, default=0.002, help="Slack API 1 回の遅延 (秒)")
+    parser.add_argument("--redis-latency", type=float, default=0.0005, help="Redis 1 ラウンドトリップの遅延 (秒)")
+    parser.add_argument("--workers", type=int, default=8, help="並行に処理するイベント数")
+    parser.add_argument("--output", help="結果を書き出す JSON ファイル")
+    parser.add_argument("--baseline", help="比較対象の JSON ファイル")
+    args = parser.parse_args()
+
+    results = {}
+    for name in args.scenario or list(SCENARIOS):
+        harness = Harness(args.slack_latency, args.redis_latency, args.workers)
+        results[name] = SCENARIOS[name](harness, args.size)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+    else:
+        json.dump(results, sys.stdout, indent=2, ensure_ascii=False, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,171 @@
+"""
+テスト・負荷試験 (bench.py) 用の Slack クライアントと Redis の代替実装
+
+fakeredis (requirements-dev.txt) が必要なため、purchase_bot パッケージには含めない。
+"""
+
+import threading
+import time
+from collections import Counter
+
+import fakeredis
+from redis.client import Pipeline
+from redis.crc import key_slot
+from redis.exceptions import RedisClusterException, ResponseError
+
+
+class FakeSlackClient:
+    """ Slack の RTM / Web API の代わりをするクライアント
+
+    api_call は呼び出しを記録し、ボットが必要とする最低限の応答を返す。
+    rtm_read は push したイベントを返す。
+
+    :param float latency: 各 API 呼び出しにかかる時間 (秒)
+    :param dict[str, float] method_latency: API メソッドごとの呼び出し時間 (秒)
+    """
+
+    def __init__(self, latency=0.0, method_latency=None):
+        self.latency = latency
+        self.method_latency = method_latency or {}
+        self.calls = []
+        self.counts = Counter()
+        self.usernames = {}
+        # conversations.history で返すメッセージ
+        self.history = []
+        self._events = []
+        self._lock = threading.Lock()
+
+    def rtm_connect(self, **kwargs):
+        return True
+
+    def rtm_read(self):
+        with self._lock:
+            events, self._events = self._events, []
+        return events
+
+    def push(self, *events):
+        """ rtm_read で返すイベントを追加する """
+        with self._lock:
+            self._events.extend(events)
+
+    def api_call(self, method, **kwargs):
+        latency = self.method_latency.get(method, self.latency)
+        if latency:
+            time.sleep(latency)
+        if method == "files.upload" and hasattr(kwargs.get("file"), "read"):
+            # アップロードされた内容を呼び出し後も確認できるように読み込んでおく
+            kwargs = dict(kwargs, file=kwargs["file"].read())
+        with self._lock:
+            self.calls.append((method, kwargs))
+            self.counts[method] += 1
+        if method == "users.info":
+            user_id = kwargs["user"]
+            return {"ok": True, "user": {"id": user_id, "name": self.usernames.get(user_id, "name-" + user_id)}}
+        if method == "im.open":
+            return {"ok": True, "channel": {"id": "D" + kwargs["user"]}}
+        if method == "conversations.history":
+            oldest = float(kwargs.get("oldest") or 0)
+            messages = [m for m in self.history if float(m["ts"]) > oldest]
+            return {"ok": True, "messages": sorted(messages, key=lambda m: float(m["ts"]), reverse=True),
+                    "has_more": False, "response_metadata": {"next_cursor": ""}}
+        if method == "chat.postMessage":
+            return {"ok": True, "channel": kwargs.get("channel"), "ts": "{:.6f}".format(time.time())}
+        return {"ok": True}
+
+    def sent(self, method):
+        """ 特定メソッドの呼び出し引数の一覧を返す """
+        with self._lock:
+            return [kwargs for name, kwargs in self.calls if name == method]
+
+
+class LatencyPipeline(Pipeline):
+    """ execute 1 回を 1 ラウンドトリップとして数えるパイプライン """
+
+    def __init__(self, owner, *args):
+        super().__init__(*args)
+        self._owner = owner
+
+    def execute(self, raise_on_error=True):
+        names = [args[0] for args, options in self.command_stack]
+        if names:
+            self._owner.round_trip(names)
+        return super().execute(raise_on_error)
+
+
+class LatencyRedis(fakeredis.FakeStrictRedis):
+    """ ラウンドトリップごとに遅延を入れ、コマンド数を数える Redis の代替
+
+    :param float latency: 1 ラウンドトリップにかかる時間 (秒)
+    """
+
+    def __init__(self, latency=0.0, **kwargs):
+        kwargs.setdefault("decode_responses", True)
+        super().__init__(**kwargs)
+        self.latency = latency
+        self.round_trips = 0
+        self.commands = Counter()
+        self._stats_lock = threading.Lock()
+
+    def round_trip(self, names):
+        with self._stats_lock:
+            self.round_trips += 1
+            self.commands.update(str(name).upper() for name in names)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def execute_command(self, *args, **options):
+        self.round_trip([args[0]])
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return LatencyPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self.round_trips = 0
+            self.commands = Counter()
+
+
+# redis-py の Redis Cluster のパイプラインで使えないコマンド (redis.cluster.PIPELINE_BLOCKED_COMMANDS の一部)
+CLUSTER_PIPELINE_BLOCKED = {"EVAL", "EVALSHA", "MGET", "MSET", "PUBLISH", "RENAME", "RENAMENX", "WATCH", "MULTI"}
+
+
+def _check_slot(keys):
+    if len({key_slot(str(key).encode("utf-8")) for key in keys}) > 1:
+        raise ResponseError("CROSSSLOT Keys in request don't hash to the same slot: {}".format(list(keys)))
+
+
+class ClusterRulesPipeline(LatencyPipeline):
+    """ Redis Cluster のパイプラインで使えないコマンドを拒否するパイプライン """
+
+    def pipeline_execute_command(self, *args, **options):
+        name = str(args[0]).upper()
+        if name in CLUSTER_PIPELINE_BLOCKED:
+            raise RedisClusterException("{} is blocked in cluster pipelines".format(name))
+        if name in ("DEL", "EXISTS"):
+            _check_slot(args[1:])
+        return super().pipeline_execute_command(*args, **options)
+
+    def watch(self, *names):
+        raise RedisClusterException("watch() is not implemented in cluster pipelines")
+
+    def multi(self):
+        raise RedisClusterException("multi() is not implemented in cluster pipelines")
+
+
+class ClusterRulesRedis(LatencyRedis):
+    """ Redis Cluster で使えない操作を拒否する LatencyRedis
+
+    トランザクションのパイプライン、パイプライン内のスクリプトと MGET、
+    スロットの異なるキーを渡すスクリプトを、redis-py の RedisCluster と同じように拒否する。
+    """
+
+    def execute_command(self, *args, **options):
+        if str(args[0]).upper() in ("EVAL", "EVALSHA"):
+            _check_slot(args[3:3 + int(args[2])])
+        return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        if transaction:
+            raise RedisClusterException("transaction is deprecated in cluster mode")
+        return ClusterRulesPipeline(self, self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -1,14 +1,18 @@
 #!/usr/bin/env python
 
+import os
 import sys
 
-from purchase_bot import PurchaseBot
+from purchase_bot import MultiChannelBot, PurchaseBot
 
 
 def main():
     debug = len(sys.argv) == 2 and sys.argv[1] == "--debug"
 
-    bot = PurchaseBot(debug=debug)
+    if os.environ.get("SLACK_CHANNEL_IDS"):
+        bot = MultiChannelBot(debug=debug)
+    else:
+        bot = PurchaseBot(debug=debug)
     bot.main()
 
 
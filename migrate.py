@@ -0,0 +1,51 @@
+#!/usr/bin/env python
+"""
+Redis に保存された購入承認リクエストの移行
+
+    $ python migrate.py run                 # 旧形式のリクエストをハッシュ形式に移行
+    $ python migrate.py compare --db 15     # 空のデータベースで旧形式と新形式を比較
+    $ python migrate.py move --channel C0123  # 以前のキーを SLACK_CHANNEL_ID の名前空間に移す
+"""
+
+import argparse
+import json
+import os
+import sys
+
+from purchase_bot.archive import Archive
+from purchase_bot.migrate import compare_layouts, migrate, move_to_namespace
+from purchase_bot.repo import PurchaseRepo, connect_redis
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run = subparsers.add_parser("run", help="旧形式のリクエストをハッシュ形式に移行する")
+    run.add_argument("--batch-size", type=int, default=500, help="1 回に変換するリクエスト数")
+    compare = subparsers.add_parser("compare", help="旧形式と新形式のメモリ使用量と読み込み速度を比較する")
+    compare.add_argument("--db", type=int, required=True, help="計測に使う空のデータベース番号")
+    compare.add_argument("--size", type=int, default=10000, help="作成するリクエスト数")
+    move = subparsers.add_parser("move", help="以前のキーを購入申請チャンネルの名前空間 (ハッシュタグ付きのキー) に移す")
+    move.add_argument("--channel", default=os.environ.get("SLACK_CHANNEL_ID"), help="購入申請チャンネルのID")
+    move.add_argument("--archive", default=os.environ.get("ARCHIVE_PATH"), help="保管済みリクエストの SQLite ファイル")
+    args = parser.parse_args()
+
+    if args.command == "run":
+        repo = PurchaseRepo()
+        total = migrate(repo, batch_size=args.batch_size,
+                        progress=lambda count: print("converted {}".format(count), file=sys.stderr))
+        print("migrated {} requests".format(total))
+    elif args.command == "move":
+        if not args.channel:
+            parser.error("--channel or SLACK_CHANNEL_ID is required")
+        archive = Archive(args.archive) if args.archive else None
+        total = move_to_namespace(connect_redis(), args.channel, archive=archive)
+        print("moved {} keys to purchase:{{{}}}".format(total, args.channel))
+    else:
+        os.environ["REDIS_DB"] = str(args.db)
+        json.dump(compare_layouts(PurchaseRepo(), args.size), sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,2 @@
 from .bot import PurchaseBot
+from .tenants import MultiChannelBot
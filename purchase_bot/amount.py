@@ -0,0 +1,40 @@
+"""
+リクエストの投稿内容からの金額・数量の読み取り
+"""
+
+import re
+
+from .search import normalize
+
+# "¥12,800" / "12800円" / "1.5万円" のような金額 (NFKC 正規化で "￥" は "¥" になる)
+NUMBER = r"\d{1,3}(?:,\d{3})+|\d+"
+PRICE = re.compile(r"¥\s*(?P<yen>{0})|(?P<amount>(?:{0})(?:\.\d+)?)\s*(?P<man>万)?\s*円".format(NUMBER))
+# "x3" / "×3" / "3個" のような数量
+QUANTITY = re.compile(r"(?<![a-z0-9])[x×*]\s*(?P<times>\d+)(?![\d.])"
+                      r"|(?<![\d.,])(?P<count>\d+)\s*(?:個|点|台|冊|本|枚|箱|組|セット|つ)")
+
+
+def parse_amount(text):
+    """ 投稿内容から単価と数量を読み取る
+
+    最初に現れた金額を単価とし、"x3" や "3個" のような数量があれば合計は単価 × 数量になる。
+    金額が無い場合は単価を None にする。
+
+    :param str text: リクエストの投稿内容
+    :rtype: ((None|int), int)
+    :return: 単価 (円) と 数量 (書かれていない場合は 1)
+    """
+    text = normalize(text)
+    price = PRICE.search(text)
+    amount = None
+    if price is not None:
+        if price.group("yen"):
+            amount = int(price.group("yen").replace(",", ""))
+        else:
+            value = float(price.group("amount").replace(",", ""))
+            amount = int(round(value * (10000 if price.group("man") else 1)))
+    # 金額の数字を数量と取り違えないよう、金額の部分を除いてから探す
+    rest = text[:price.start()] + " " + text[price.end():] if price is not None else text
+    quantity = QUANTITY.search(rest)
+    count = int(quantity.group("times") or quantity.group("count")) if quantity is not None else 1
+    return amount, max(1, count)
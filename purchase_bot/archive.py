@@ -0,0 +1,186 @@
+"""
+承認・却下から一定期間が過ぎたリクエストを Redis から SQLite に移して保管する
+"""
+
+import json
+import re
+import sqlite3
+import threading
+import time
+
+from .model import PurchaseRequest, RequestStatus
+
+# 保管したリクエストを Redis から削除する
+# KEYS: 状態ごとのソート済み集合, (リクエストのハッシュ, 旧形式のリクエスト, 旧形式の承認者, 利用者ごとの一覧) * N
+# ARGV: リクエストID * N
+ARCHIVE_SCRIPT = """
+local n = 0
+for i = 2, #KEYS, 4 do
+    n = n + 1
+    redis.call('DEL', KEYS[i], KEYS[i + 1], KEYS[i + 2])
+    redis.call('ZREM', KEYS[1], ARGV[n])
+    redis.call('ZREM', KEYS[i + 3], ARGV[n])
+end
+return n
+"""
+
+
+class Archive:
+    """ 保管済みリクエストの SQLite ファイル
+
+    リクエストは Redis のハッシュと同じ形式 (PurchaseRequest.to_hash) の JSON で保存する。
+    ボットのワーカースレッドから参照されるため、接続は 1 つをロックで共有する。
+    PurchaseRepo の名前空間ごとに別のテーブルに保存する。
+
+    :param str path: SQLite のファイルパス
+    :param (None|str) namespace: PurchaseRepo の名前空間
+    """
+
+    def __init__(self, path, namespace=None):
+        self.path = path
+        self.table = self.table_name(namespace)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            if path != ":memory:":
+                self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS {} (id INTEGER PRIMARY KEY, status TEXT NOT NULL, "
+                               "closed REAL, record TEXT NOT NULL)".format(self.table))
+
+    @staticmethod
+    def table_name(namespace):
+        """ 名前空間のリクエストを保存するテーブル名を返す
+
+        :param (None|str) namespace: PurchaseRepo の名前空間
+        :rtype: str
+        """
+        return "requests" if not namespace else "requests_" + re.sub(r"\W", "_", namespace)
+
+    def rename(self, namespace):
+        """ 保管済みのリクエストを別の名前空間のテーブルに移す (purchase_bot.migrate.move_to_namespace で使う)
+
+        :param (None|str) namespace: 移動先の PurchaseRepo の名前空間
+        """
+        table = self.table_name(namespace)
+        with self._lock, self._conn:
+            self._conn.execute("ALTER TABLE {} RENAME TO {}".format(self.table, table))
+        self.table = table
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM {}".format(self.table)).fetchone()[0]
+
+    def put(self, requests):
+        """ リクエストをまとめて保存する (同じIDは上書き)
+
+        :param list[PurchaseRequest] requests:
+        """
+        rows = [(request.id, request.status.value, request.closed, json.dumps(request.to_hash(), ensure_ascii=False))
+                for request in requests]
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO {} (id, status, closed, record) "
+                                   "VALUES (?, ?, ?, ?)".format(self.table), rows)
+
+    def get(self, request_id):
+        """ 特定IDのリクエストを取得
+
+        :rtype: (PurchaseRequest|None)
+        """
+        with self._lock:
+            query = "SELECT record FROM {} WHERE id = ?".format(self.table)
+            row = self._conn.execute(query, (int(request_id),)).fetchone()
+        if row is None:
+            return None
+        return PurchaseRequest.from_hash(request_id, json.loads(row[0]))
+
+    def iter(self, start=None, end=None, chunk_size=500):
+        """ 保管済みのリクエストを ID 順に chunk_size 件ずつ読み込みながら返す
+
+        :param (None|float) start: 承認・却下の日時の下限 (UNIX 時間、この日時を含む)
+        :param (None|float) end: 承認・却下の日時の上限 (UNIX 時間、この日時を含まない)
+        :param int chunk_size: 1 回に読み込む件数
+        :rtype: collections.Iterable[PurchaseRequest]
+        """
+        conditions = ["id > ?"]
+        params = []
+        if start is not None:
+            conditions.append("closed >= ?")
+            params.append(start)
+        if end is not None:
+            conditions.append("closed < ?")
+            params.append(end)
+        query = "SELECT id, record FROM {} WHERE {} ORDER BY id LIMIT ?".format(self.table, " AND ".join(conditions))
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(query, [last_id] + params + [chunk_size]).fetchall()
+            for request_id, record in rows:
+                yield PurchaseRequest.from_hash(request_id, json.loads(record))
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1][0]
+
+    def exists(self, request_ids):
+        """ 保存済みのIDを返す
+
+        :param list[int] request_ids:
+        :rtype: set[int]
+        """
+        request_ids = [int(request_id) for request_id in request_ids]
+        if not request_ids:
+            return set()
+        query = "SELECT id FROM {} WHERE id IN ({})".format(self.table, ",".join("?" * len(request_ids)))
+        with self._lock:
+            return {row[0] for row in self._conn.execute(query, request_ids)}
+
+
+def archive_closed(repo, archive, days, batch_size=500, include_undated=False, now=None):
+    """ 承認・却下から days 日以上が過ぎたリクエストを Redis から archive に移す
+
+    archive への書き込みが済んでから Redis のキーを削除するため、途中で止まっても取りこぼしは無い
+    (再実行すると同じリクエストを上書きする)。
+
+    :param PurchaseRepo repo:
+    :param Archive archive:
+    :param float days: Redis に残す日数
+    :param int batch_size: 1 回に移すリクエスト数
+    :param bool include_undated: 承認・却下の日時が記録されていないリクエストも移す場合は True
+    :param (None|float) now: 現在日時 (UNIX 時間)
+    :rtype: int
+    :return: 移したリクエスト数
+    """
+    cutoff = (time.time() if now is None else now) - days * 86400
+    client = repo._redis
+    script = client.register_script(ARCHIVE_SCRIPT)
+    total = 0
+    for status, status_key in ((RequestStatus.approved, repo.APPROVED_KEY), (RequestStatus.denied, repo.DENIED_KEY)):
+        # 承認・却下の日時の順に並んでいるため、期限より前の範囲だけを読めばよい
+        # (移さなかったリクエストの分だけ読み込み位置を進める)
+        offset = 0
+        while True:
+            request_ids = client.zrangebyscore(status_key, "-inf", "({}".format(cutoff), start=offset, num=batch_size)
+            if not request_ids:
+                break
+            moved = _archive_batch(repo, archive, script, status, status_key, request_ids, cutoff, include_undated)
+            offset += len(request_ids) - moved
+            total += moved
+    return total
+
+
+def _archive_batch(repo, archive, script, status, status_key, request_ids, cutoff, include_undated):
+    requests = [request for request in repo.get_list(request_ids, status)
+                if (request.closed is None and include_undated)
+                or (request.closed is not None and request.closed < cutoff)]
+    if not requests:
+        return 0
+    archive.put(requests)
+    keys = [status_key]
+    for request in requests:
+        keys += [repo.RECORD_KEY.format(request.id), repo.ITEM_KEY.format(request.id),
+                 repo.ITEM_ADMIN_KEY.format(request.id), repo.USER_REQUESTS_KEY.format(request.user_id or "")]
+    script(keys=keys, args=[request.id for request in requests])
+    return len(requests)
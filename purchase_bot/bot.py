@@ -2,27 +2,68 @@
 購入申請管理ボット
 """
 
-import datetime
+import asyncio
 import logging
 import os
+import re
+import tempfile
+import threading
 import time
 import unicodedata
+from collections import namedtuple
 
 from slackclient import SlackClient
 
-from .model import PurchaseRequest
-from .repo import PurchaseRepo
+from . import digest, metrics, report
+from .amount import parse_amount
+from .cache import TTLCache
+from .cluster import Coordinator
+from .commands import CommandRouter
+from .idset import IdSet
+from .model import PurchaseRequest, RequestStatus
+from .outbox import Outbox
+from .repo import SPEND_APPROVER, SPEND_MONTH, SPEND_PENDING, SPEND_USER, PurchaseRepo, channel_namespace, connect_redis
+from .runtime import RTMEventSource, Runtime, replay
+from .scheduler import Scheduler, job_name, next_daily
+from .slack import RateLimitedSlackClient
+from .view import PendingView
 
 USAGE = """使い方\n
 `使い方`: このメッセージを表示\n
 `未承認`: 未承認の購入承認リクエスト一覧を表示\n
 `承認 1 2 3 | 承認 1-3`: ID 1, 2, 3の購入承認リクエストを承認\n
+`承認 1-300 !37 | 承認 @ユーザ`: ID 37 以外の 1〜300 / ユーザの未処理の全リクエストを承認 (却下・無視も同様)\n
 `却下 1 2 3 | 却下 1-3`: ID 1, 2, 3の購入承認リクエストを却下\n
-`無視 1 2 3 | 無視 1-3`: ID 1, 2, 3の購入承認リクエストを無視"""
-
-
-VALID_ID_RANGE = 10
+`無視 1 2 3 | 無視 1-3`: ID 1, 2, 3の購入承認リクエストを無視\n
+`レポート | レポート 2018-04`: 全期間 (または指定した月) のリクエストの集計と CSV を送信\n
+`検索 モニター | 検索 4K モニター #2`: 投稿内容かユーザ名に検索語 (2文字以上) を含むリクエストを表示 (#2 は2ページ目)\n
+`支出 | 支出 2018-04 | 支出 @ユーザ`: 投稿内容の金額 (¥12,800 や 1280円 x3) の月・承認者ごと (または指定した月・ユーザ) の合計を表示\n
+複数の購入申請チャンネルの承認者は `承認 #チャンネル 1` のようにチャンネルを指定してください"""
+
+
+# 1 つの範囲指定 (ID1-ID2) で選択できるIDの数の上限
+VALID_ID_RANGE = int(os.environ.get("MAX_ID_RANGE", 500))
+# 1 回の状態変更スクリプトで処理するIDの数
+TRANSITION_CHUNK_SIZE = 500
+# 新しいリクエストを承認者に通知するまでの秒数 (この間のリクエストはまとめて通知する)
 MIN_NOTIFICATION_SECONDS = 60
+# 予定するジョブの種類
+JOB_NOTIFY = "notify"
+JOB_REMIND = "remind"
+JOB_ESCALATE = "escalate"
+JOB_DAILY_DIGEST = "daily"
+JOB_JOURNAL = "journal"
+# 完了していないジャーナルのイベントを確認する間隔 (秒)
+JOURNAL_CHECK_INTERVAL = 60
+# 起動時に conversations.history で取得する 1 ページの件数
+HISTORY_PAGE_SIZE = 200
+# 検索結果の 1 ページの件数
+SEARCH_PAGE_SIZE = 20
+# 検索コマンドの末尾のページ指定 (#2)
+SEARCH_PAGE = re.compile(r"\s+#(\d+)\s*$")
+
+# ダイレクトメッセージのコマンド (PurchaseBot のメソッドを登録順に照合する)
+COMMANDS = CommandRouter()
 
 
 def check_id_range(start_id, end_id):
@@ -40,49 +81,84 @@ def check_id_range(start_id, end_id):
     return None
 
 
-def get_request_id(text):
-    """ 文字列から複数のIDを取得する
+# <@U123> または <@U123|name> の形式のユーザ指定
+USER_MENTION = re.compile(r"^<@([A-Z0-9]+)(?:\|[^>]*)?>$")
 
-    :param str text: "承認 1 123 1456" のような文字列
-    :rtype: list[str]
-    :return: ID のリスト
-    """
-
-    texts = text.split(' ')
+# ids: 選択されたID (除外済み), excluded: 除外するID, users: 未処理の全リクエストを選択するユーザIDのリスト,
+# message: 解釈できなかった部分についてのメッセージ
+IdSelection = namedtuple("IdSelection", ["ids", "excluded", "users", "message"])
 
-    ids = []
-    msg = ''
 
-    for text in texts[1:]:
-        if text.count('-') >= 2:
-            msg += 'WRONG_REQUEST {} : 0より小さいIDを使っている可能性があります。\n'.format(text)
-        # Parser for 「REQUEST ID1-IDN」
-        elif text.count('-') == 1:
-            start_id, end_id = text.split('-', 1)
+def _parse_id_token(token):
+    """ "ID" または "ID1-ID2" の形式の文字列を解釈する
 
-            try:
-                start_id = int(start_id)
-                end_id = int(end_id)
-            except ValueError:
-                msg += 'WRONG_REQUEST {0} : 0以上の半角数字以外が含まれています。\n'.format(text)
-                continue
+    :rtype: ((None|(int, int)), str)
+    :return: 区間 と 解釈できなかった場合のメッセージ
+    """
+    if token.count('-') >= 2:
+        return None, 'WRONG_REQUEST {} : 0より小さいIDを使っている可能性があります。\n'.format(token)
+    # Parser for 「REQUEST ID1-IDN」
+    if token.count('-') == 1:
+        start_id, end_id = token.split('-', 1)
+        try:
+            start_id = int(start_id)
+            end_id = int(end_id)
+        except ValueError:
+            return None, 'WRONG_REQUEST {0} : 0以上の半角数字以外が含まれています。\n'.format(token)
+        msg_for_wrong_usage = check_id_range(start_id, end_id)
+        if msg_for_wrong_usage:
+            return None, 'WRONG_REQUEST ' + token + ' : ' + msg_for_wrong_usage + '\n'
+        return (start_id, end_id), ''
+    # Parser for 「REQUEST ID1 ID2 ... IDN」
+    try:
+        request_id = int(token)
+    except ValueError:
+        return None, 'WRONG_REQUEST {}: IDは整数でなければなりません。\n'.format(token)
+    return (request_id, request_id), ''
+
+
+def parse_request_ids(text):
+    """ 文字列からIDの集合を取得する
+
+    "1 3-5" のようなIDと範囲に加え、"!4" や "!10-20" で除外するID、
+    "<@U123>" でそのユーザの未処理の全リクエストを指定できる。
+    範囲は展開せずに区間のまま扱うため、範囲の大きさによらず処理時間は一定になる。
+    除外は指定した順序によらず、全ての選択の後に適用する。
+
+    :param str text: "承認 1-300 !37 <@U123>" のような文字列
+    :rtype: IdSelection
+    """
+    ids = IdSet()
+    excluded = IdSet()
+    users = []
+    msg = ''
+    for token in text.split()[1:]:
+        mention = USER_MENTION.match(token)
+        if mention:
+            users.append(mention.group(1))
+            continue
+        target = ids
+        if token.startswith('!') and len(token) > 1:
+            target = excluded
+            token = token[1:]
+        interval, error = _parse_id_token(token)
+        if interval is None:
+            msg += error
+        else:
+            target.add(*interval)
+    ids.difference_update(excluded)
+    return IdSelection(ids, excluded, users, msg)
 
-            msg_for_wrong_usage = check_id_range(start_id, end_id)
-            if msg_for_wrong_usage:
-                msg += 'WRONG_REQUEST ' + text + ' : ' + msg_for_wrong_usage + '\n'
-            else:
-                ids.extend(list(range(start_id, end_id + 1)))
 
-        # Parser for 「REQUEST ID1 ID2 ... IDN」
-        else:
-            try:
-                ids.append(int(text))
-            except ValueError:
-                msg += 'WRONG_REQUEST {}: IDは整数でなければなりません。\n'.format(text)
+def get_request_id(text):
+    """ 文字列から複数のIDを取得する
 
-    # 重複している要素を除いた後、ソートする
-    ids = sorted(list(set(ids)))
-    return ids, msg
+    :param str text: "承認 1 123 1456" のような文字列
+    :rtype: list[int], str
+    :return: 昇順で重複の無い ID のリスト と 解釈できなかった部分についてのメッセージ
+    """
+    selection = parse_request_ids(text)
+    return list(selection.ids), selection.message
 
 
 class PurchaseBot:
@@ -91,34 +167,149 @@ class PurchaseBot:
     USER_ICON = ':yen:'
     REACTION_ICON = 'yen'
 
-    def __init__(self, debug=False):
+    def __init__(self, debug=False, client=None, repo=None, purchase_channel=None):
+        """
+        :param bool debug: デバッグログを出力する場合は True
+        :param client: Slack クライアント (省略時は SLACK_TOKEN の SlackClient を RateLimitedSlackClient で包んで使う)
+        :param (None|PurchaseRepo) repo: リポジトリ (省略時は環境変数の Redis に接続し、以前のキーが無ければチャンネルIDを名前空間にする)
+        :param (None|str) purchase_channel: 購入申請チャンネルのID (省略時は SLACK_CHANNEL_ID)
+        """
         self._logger = logging.getLogger("purchase_bot")
         self._logger.setLevel(logging.DEBUG if debug else logging.INFO)
-        self._logger.addHandler(logging.StreamHandler())
-        token = os.environ["SLACK_TOKEN"]
-        purchase_channel = os.environ["SLACK_CHANNEL_ID"]
+        if not self._logger.handlers:
+            self._logger.addHandler(logging.StreamHandler())
+        if client is None:
+            client = RateLimitedSlackClient(SlackClient(os.environ["SLACK_TOKEN"]),
+                                            max_retries=int(os.environ.get("SLACK_MAX_RETRIES", 3)))
+        if purchase_channel is None:
+            purchase_channel = os.environ["SLACK_CHANNEL_ID"]
         self._purchase_channel = purchase_channel
-        self.client = SlackClient(token)
-        self.repo = PurchaseRepo()
+        self.client = metrics.InstrumentedSlackClient(client)
+        if repo is None:
+            redis = connect_redis()
+            repo = PurchaseRepo(redis, namespace=channel_namespace(redis, purchase_channel))
+        self.repo = repo
         self._logger.info("connected to redis")
-        self._last_notified = datetime.datetime.now()
+        moved = self.repo.backfill_status_index()
+        if moved:
+            self._logger.info("moved {} requests to the sorted status indexes".format(moved))
+        indexed = self.repo.backfill_index()
+        if indexed:
+            self._logger.info("indexed {} pending requests".format(indexed))
+        searchable = self.repo.backfill_search_index()
+        if searchable:
+            self._logger.info("added {} requests to the search index".format(searchable))
+        priced = self.repo.backfill_spend()
+        if priced:
+            self._logger.info("read amounts of {} requests".format(priced))
+        # 未処理リクエストをメモリ上に複製し、一覧や投稿からの検索で Redis を参照しない
+        if os.environ.get("PENDING_VIEW", "") not in ("", "0"):
+            view = PendingView(self.repo, resync_interval=float(os.environ.get("PENDING_VIEW_RESYNC", 30))).start()
+            self._logger.info("loaded {} pending requests into memory".format(len(view)))
+        self._workers = int(os.environ.get("BOT_WORKERS", 8))
+        self._user_cache = TTLCache(maxsize=int(os.environ.get("USER_CACHE_SIZE", 1024)),
+                                    ttl=float(os.environ.get("USER_CACHE_TTL", 3600)))
+        metrics.register_cache("users", self._purchase_channel, self._user_cache)
+        # 複数のボット間でユーザ名を Redis 経由で共有する
+        self._share_user_cache = os.environ.get("USER_CACHE_SHARED", "") not in ("", "0")
+        # ユーザID → DM チャンネルID
+        self._im_channels = {}
+        self._share_im_cache = os.environ.get("IM_CACHE_SHARED", "") not in ("", "0")
+        # incremental: 前回の通知からの差分のみ通知, full: 毎回全件を通知
+        self._digest_mode = os.environ.get("DIGEST_MODE", "incremental")
+        self._outbox = Outbox(self._send_direct_message, self._post_channel_attachments,
+                              merge_announcements=os.environ.get("MERGE_ANNOUNCEMENTS", "") not in ("", "0"),
+                              merge_threshold=int(os.environ.get("MERGE_ANNOUNCEMENTS_ABOVE", 10)),
+                              flush_window=float(os.environ.get("OUTBOX_FLUSH_WINDOW", 0)),
+                              min_interval=float(os.environ.get("POST_INTERVAL", 1.0)))
+        # 複数のチャンネルを 1 つのプロセスで扱う場合に上書きし合わないよう、チャンネルごとに分ける
+        metrics.QUEUE_DEPTH.labels("outbox", self._purchase_channel).set_function(lambda: self._outbox.depth)
+        # 複数のボットで 1 つの Redis を共有する場合、イベントは 1 つのボットだけが処理し、
+        # 取りこぼしたイベントの処理はリーダーだけが行う
+        self._coordinator = None
+        # 受け取ったイベントをジャーナルに記録し、完了しなかったものを起動時に処理し直す
+        self._journal = os.environ.get("EVENT_JOURNAL", "1") not in ("", "0")
+        if os.environ.get("SHARED_WORKERS", "") not in ("", "0"):
+            self._coordinator = Coordinator(self.repo)
+            self._logger.info("running as worker {}".format(self._coordinator.worker_id))
+        # 未承認リクエストの通知・催促・エスカレーション・日次の一覧はジョブとして予定し、
+        # イベントの処理とは別のスレッドで予定時刻に実行する (0 または空の場合は行わない)
+        self._reminder_hours = float(os.environ.get("REMINDER_HOURS", 24))
+        self._escalation_hours = float(os.environ.get("ESCALATION_HOURS", 72))
+        self._escalation_users = [user for user in os.environ.get("ESCALATION_USERS", "").split(",") if user]
+        self._daily_digest_time = os.environ.get("DAILY_DIGEST_TIME") or None
+        # 処理中に終了したワーカーの未完了のイベントは、記録から JOURNAL_STALE_SECONDS 秒後に処理し直す
+        self._journal_stale_seconds = float(os.environ.get("JOURNAL_STALE_SECONDS", 300))
+        self.scheduler = Scheduler(self.repo, {JOB_NOTIFY: self._notify_job, JOB_REMIND: self._remind,
+                                               JOB_ESCALATE: self._escalate, JOB_DAILY_DIGEST: self._daily_digest,
+                                               JOB_JOURNAL: self._replay_stale_journal})
+        self._stop = threading.Event()
+        scheduled = self.repo.backfill_schedule(self._request_jobs)
+        if scheduled:
+            self._logger.info("scheduled reminders for {} pending requests".format(scheduled))
+        if self._daily_digest_time:
+            # 停止中に過ぎた予定は起動後に実行する
+            self.repo.schedule({JOB_DAILY_DIGEST: next_daily(self._daily_digest_time, time.time())}, nx=True)
+        else:
+            self.repo.unschedule(JOB_DAILY_DIGEST)
+        if self._journal:
+            self.repo.schedule({JOB_JOURNAL: time.time() + JOURNAL_CHECK_INTERVAL}, nx=True)
+
+    def _get_im_channel(self, user_id, refresh=False):
+        """ 特定ユーザとの DM チャンネルのIDを取得する
+
+        im.open の結果はキャッシュし、refresh が True の場合のみ取得し直す。
+
+        :param str user_id: ユーザID
+        :param bool refresh: キャッシュを使わずに im.open を呼ぶ場合は True
+        :rtype: (None|str)
+        :return: チャンネルID (im.open に失敗した場合は None)
+        """
+        im_id = None
+        if not refresh:
+            im_id = self._im_channels.get(user_id)
+            if im_id is None and self._share_im_cache:
+                im_id = self.repo.get_im_channel(user_id)
+        if im_id is None:
+            result = self.client.api_call("im.open", user=user_id)
+            if not result.get("ok"):
+                self._logger.error("Failed to open a direct message channel with {}: {}".format(
+                    user_id, result.get("error")))
+                return None
+            im_id = result["channel"]["id"]
+            if self._share_im_cache:
+                self.repo.set_im_channel(user_id, im_id)
+        self._im_channels[user_id] = im_id
+        return im_id
 
     def _send_direct_message(self, user_id, message):
         """ 特定ユーザにDMを送信 """
-        im_id = self.client.api_call("im.open", user=user_id)["channel"]["id"]
-        self.client.api_call("chat.postMessage", channel=im_id, text=message,
-                             username=self.USERNAME, icon_emoji=self.USER_ICON)
+        im_id = self._get_im_channel(user_id)
+        if im_id is None:
+            return
+        result = self.client.api_call("chat.postMessage", channel=im_id, text=message,
+                                      username=self.USERNAME, icon_emoji=self.USER_ICON)
+        if result.get("error") == "channel_not_found":
+            im_id = self._get_im_channel(user_id, refresh=True)
+            if im_id is None:
+                return
+            self.client.api_call("chat.postMessage", channel=im_id, text=message,
+                                 username=self.USERNAME, icon_emoji=self.USER_ICON)
 
     def _post_channel(self, message):
         """ チャンネルに投稿 """
         self.client.api_call("chat.postMessage", channel=self._purchase_channel, text=message,
                              username=self.USERNAME, icon_emoji=self.USER_ICON)
 
+    def _post_channel_attachments(self, message, attachments):
+        """ チャンネルに attachment 付きで投稿 """
+        return self.client.api_call("chat.postMessage", channel=self._purchase_channel, text=message,
+                                    attachments=attachments,
+                                    username=self.USERNAME, icon_emoji=self.USER_ICON)
+
     def _post_channel_color(self, message1, color, message2):
         """ チャンネルに色付きで投稿 """
-        self.client.api_call("chat.postMessage", channel=self._purchase_channel, text=message1,
-                             attachments=[{"color": color, "text": message2}],
-                             username=self.USERNAME, icon_emoji=self.USER_ICON)
+        return self._post_channel_attachments(message1, [{"color": color, "text": message2}])
 
     def _add_reaction(self, message):
         """ メッセージにリアクションを返す """
@@ -132,68 +323,157 @@ class PurchaseBot:
         :rtype: str
         :return: ユーザ名
         """
-        result = self.client.api_call("users.info", user=user_id)
-        return result["user"]["name"]
+        username = self._user_cache.get(user_id)
+        if username is not None:
+            return username
+        if self._share_user_cache:
+            username = self.repo.get_username(user_id)
+        if username is None:
+            result = self.client.api_call("users.info", user=user_id)
+            if not result.get("ok"):
+                # 取得できなかった場合はキャッシュせずにユーザIDで代用する
+                self._logger.error("Failed to get user info of {}: {}".format(user_id, result.get("error")))
+                return user_id
+            username = result["user"]["name"]
+            if self._share_user_cache:
+                self.repo.set_username(user_id, username, self._user_cache.ttl)
+        self._user_cache.set(user_id, username)
+        return username
+
+    def _user_changed(self, message):
+        """ ユーザ情報の変更をキャッシュに反映する """
+        if message.get('type') != 'user_change':
+            return False
+        user_id = message["user"]["id"]
+        self._user_cache.invalidate(user_id)
+        if self._share_user_cache:
+            self.repo.delete_username(user_id)
+        return True
+
+    def _create_new_request(self, text, user_id, channel=None, ts=None):
+        """ リクエストを登録する
+
+        同じ投稿に対しては同じIDを使い、登録済みの場合は何もしない。
 
-    def _create_new_request(self, text, user_id):
-        request_id = self.repo.get_id()
+        :rtype: bool
+        :return: 登録した場合は True
+        """
+        if ts:
+            request_id, reserved = self.repo.reserve_id(channel, ts)
+            # ID の払い出し後に登録できずに終了した場合は登録し直す
+            if not reserved and self.repo.get(request_id)[0] is not None:
+                return False
+        else:
+            request_id = self.repo.get_id()
         username = self._get_username(user_id)
-        request = PurchaseRequest(request_id, user_id, username, text)
-        self.repo.create_or_update(request)
+        amount, quantity = parse_amount(text)
+        request = PurchaseRequest(request_id, user_id, username, text, channel=channel, ts=ts,
+                                  created=time.time(), amount=amount, quantity=quantity)
+        jobs = self._request_jobs(request)
+        jobs.update(self._notify_jobs())
+        self.repo.create_or_update(request, jobs=jobs)
+        self.scheduler.notify(min(jobs.values()))
+        return True
+
+    def _notify_jobs(self):
+        """ 承認者への通知の予定 (既に予定がある場合はそのまま) """
+        return {JOB_NOTIFY: time.time() + MIN_NOTIFICATION_SECONDS}
+
+    def _request_jobs(self, request):
+        """ リクエストの催促・エスカレーションの予定を返す
+
+        :param PurchaseRequest request:
+        :rtype: dict[str, float]
+        """
+        created = request.created or time.time()
+        jobs = {}
+        if self._reminder_hours > 0:
+            jobs[job_name(JOB_REMIND, request.id)] = created + self._reminder_hours * 3600
+        if self._escalation_hours > 0 and self._escalation_users:
+            jobs[job_name(JOB_ESCALATE, request.id)] = created + self._escalation_hours * 3600
+        return jobs
 
     def _purchase_request(self, message):
         """ #purchase チャンネルの承認者以外のリクエストを処理する """
         if message.get('type') != 'message':
             return False
-        # 承認者からの申請は無視
-        if message.get('user') in self.repo.admin:
-            return False
         # purchase_channel 以外は無視
         if message.get('channel') != self._purchase_channel:
             return False
         # スレッド内は無視
         if message.get('thread_ts'):
             return False
+        # 承認者からの申請は無視
+        if message.get('user') in self.repo.admin:
+            return False
 
         sub_type = message.get('subtype')
         if not sub_type:
-            self._create_new_request(message["text"], message["user"])
-            self._add_reaction(message)
+            # 再処理で登録済みだった投稿にはリアクションを付け直さない
+            if self._create_new_request(message["text"], message["user"], message["channel"], message.get("ts")):
+                self._add_reaction(message)
             return True
         elif sub_type == "message_changed":
             prev_text = message["previous_message"].get("text")
             user = message["previous_message"].get("user")
+            ts = message["previous_message"].get("ts")
             username = self._get_username(user)
             new_text = message["message"].get("text")
-            if not self.repo.update(username, prev_text, new_text):
+            if not self.repo.update(username, prev_text, new_text, message["channel"], ts, self._notify_jobs()):
                 self._logger.error("Failed to update request: {}".format(message))
                 return True
         elif sub_type == "message_deleted":
             prev_text = message["previous_message"].get("text")
             user = message["previous_message"].get("user")
+            ts = message["previous_message"].get("ts")
             username = self._get_username(user)
-            if not self.repo.delete(username, prev_text):
+            if not self.repo.delete(username, prev_text, message["channel"], ts, self._notify_jobs()):
                 self._logger.error("Failed to delete request: {}".format(message))
             return True
         return False
 
-    def _register_admin(self, user_id, text):
-        """ 承認者登録 or 解除 """
-        if text.find("承認者登録") >= 0:
-            if user_id in self.repo.admin:
-                self._send_direct_message(user_id, "承認者登録済みです")
-            else:
-                self.repo.add_admin(user_id)
-                self._send_direct_message(user_id, "承認者登録しました")
-            return True
-        elif text.find("承認者解除") >= 0:
-            if user_id in self.repo.admin:
-                self.repo.remove_admin(user_id)
-                self._send_direct_message(user_id, "承認者登録解除しました")
-            else:
-                self._send_direct_message(user_id, "承認者登録されていません")
-            return True
-        return False
+    @COMMANDS.command("承認者登録", anywhere=True, admin=False)
+    def _add_admin(self, user_id, text):
+        """ 承認者登録 """
+        if user_id in self.repo.admin:
+            self._send_direct_message(user_id, "承認者登録済みです")
+        else:
+            self.repo.add_admin(user_id)
+            self._send_direct_message(user_id, "承認者登録しました")
+        return True
+
+    @COMMANDS.command("承認者解除", anywhere=True, admin=False)
+    def _remove_admin(self, user_id, text):
+        """ 承認者登録の解除 """
+        if user_id in self.repo.admin:
+            self.repo.remove_admin(user_id)
+            self._send_direct_message(user_id, "承認者登録解除しました")
+        else:
+            self._send_direct_message(user_id, "承認者登録されていません")
+        return True
+
+    @COMMANDS.command("使い方", anywhere=True)
+    def _send_usage(self, user_id, text):
+        self._send_direct_message(user_id, USAGE)
+        return True
+
+    @COMMANDS.command("未承認", anywhere=True)
+    def _send_unapproved(self, user_id, text):
+        self._notify_unapproved(user_id)
+        return True
+
+    @COMMANDS.command("承認", username=True)
+    def _approve(self, user_id, text, admin_name):
+        return self._close_requests(user_id, admin_name, text, "承認", "good", RequestStatus.approved)
+
+    @COMMANDS.command("却下", username=True)
+    def _deny(self, user_id, text, admin_name):
+        return self._close_requests(user_id, admin_name, text, "却下", "danger", RequestStatus.denied)
+
+    @COMMANDS.command("無視", username=True)
+    def _ignore(self, user_id, text, admin_name):
+        # 無視も一旦 deny 扱い
+        return self._close_requests(user_id, admin_name, text, "無視", None, RequestStatus.denied)
 
     def _handle_command(self, message):
         """ コマンドを処理する """
@@ -211,139 +491,411 @@ class PurchaseBot:
         if not text:
             return False
 
-        if text.find("承認者") >= 0:
-            if self._register_admin(user_id, text):
-                return True
+        # コマンドの判定は照合器 1 回で行い、計測のラベルにも同じ結果を使う
+        command = COMMANDS.match(text)
+        label = command.name if command is not None else "unknown"
+        with metrics.COMMAND_SECONDS.labels(label).time():
+            return self._run_command(user_id, text, command)
+
+    def _run_command(self, user_id, text, command):
+        """ ダイレクトメッセージで送られたコマンドを実行する
+
+        承認者かどうか (キャッシュ済み) と送信者のユーザ名 (users.info) はコマンドが必要とする場合だけ調べる。
+
+        :param str user_id: コマンドを送ったユーザのID
+        :param str text: NFKC 正規化済みのコマンド文字列
+        :param (None|Command) command: 文字列に当てはまったコマンド (無い場合は None)
+        :rtype: bool
+        """
+        if command is not None and not command.admin:
+            return command.handler(self, user_id, text)
 
         # 以下は管理者用コマンド
         if user_id not in self.repo.admin:
             self._send_direct_message(user_id, "承認者以外は利用できません")
             return False
+        if command is None:
+            self._send_direct_message(user_id, "不明なコマンドです: {}".format(text))
+            return False
+        if command.username:
+            return command.handler(self, user_id, text, self._get_username(user_id))
+        return command.handler(self, user_id, text)
+
+    def _close_requests(self, user_id, admin_name, text, action, color, status):
+        """ 承認・却下・無視コマンドで指定された各リクエストを処理する
+
+        ID (ユーザ指定を除く) は全体で VALID_ID_RANGE 個まで選択でき、超える場合は何も変更しない。
+        状態の変更は TRANSITION_CHUNK_SIZE 件ごとに 1 回のリポジトリ呼び出しでまとめて行い、
+        各IDの結果は 1 通の DM にまとめて送る。既に対応済みのIDと見つからないIDは範囲にまとめて知らせる。
+
+        :param str user_id: コマンドを送った承認者のID
+        :param str admin_name: コマンドを送った承認者のユーザ名
+        :param str text: コマンドの文字列
+        :param str action: 処理の名前 (承認, 却下, 無視)
+        :param (None|str) color: チャンネルに結果を投稿する場合の色 (投稿しない場合は None)
+        :param RequestStatus status: 変更後の状態
+        :rtype: bool
+        """
+        selection = parse_request_ids(text)
+        request_ids = selection.ids
+        # 範囲を重ねて指定しても、1 回のコマンドで処理するIDは VALID_ID_RANGE 個までにする
+        if len(request_ids) > VALID_ID_RANGE:
+            self._send_direct_message(
+                user_id, "WRONG_REQUEST : 一度に{}個より多くのIDは選択できません。".format(VALID_ID_RANGE))
+            return False
+        for user in selection.users:
+            request_ids.update(self._pending_ids(user))
+        request_ids.difference_update(selection.excluded)
+        with self._outbox.batch() as batch:
+            handled = IdSet()
+            missing = IdSet()
+            for chunk in request_ids.chunks(TRANSITION_CHUNK_SIZE):
+                result = self.repo.transition(chunk, status, admin_name)
+                for request_id in result.handled:
+                    handled.add(request_id)
+                for request_id in result.missing:
+                    missing.add(request_id)
+                for request in sorted(result.changed, key=lambda r: r.id):
+                    if color:
+                        msg1 = ">>> <@{}|{}>: {}".format(
+                            request.user_id, request.username, request.text)
+                        msg2 = "上記購入承認リクエストは{}されました (リクエスト番号は{}番, 承認者は <@{}|{}> です)".format(
+                            action, request.id, user_id, admin_name)
+                        batch.announce(msg1, color, msg2)
+                    batch.direct(user_id, "ID: {} を{}しました".format(request.id, action))
+            if handled:
+                batch.direct(user_id, "ID: {} は既に対応済みです".format(handled.format()))
+            if missing:
+                batch.direct(user_id, "ID: {} が見つかりません".format(missing.format()))
+            if selection.users and not request_ids:
+                batch.direct(user_id, "指定したユーザの未処理のリクエストはありません")
+            batch.direct(user_id, selection.message)
+        return bool(request_ids)
+
+    def _pending_ids(self, user):
+        """ ユーザの未処理のリクエストのIDを返す
+
+        :param str user: ユーザID
+        :rtype: IdSet
+        """
+        ids = IdSet()
+        for request in self.repo.new_by_user(user):
+            ids.add(request.id)
+        return ids
 
-        if text.find("使い方") >= 0:
-            self._send_direct_message(user_id, USAGE)
-            return True
+    @COMMANDS.command("レポート")
+    def _send_report(self, user_id, text):
+        """ リクエストの集計結果と CSV を承認者に送る
 
-        if text.find("未承認") >= 0:
-            self._notify_unapproved(user_id, force=True)
-            return True
+        CSV は一時ファイルに書き出してから files.upload 1 回で送るため、
+        履歴の件数によらずメモリ使用量は一定になる。
 
-        admin_name = self._get_username(user_id)
-        if text.startswith("承認"):
-            request_ids, msg = get_request_id(text)
-            if request_ids:
-                for request_id in request_ids:
-                    request, new = self._is_new_request(user_id, request_id)
-                    if new:
-                        msg1 = ">>> <@{}|{}>: {}".format(
-                            request.user_id, request.username, request.text)
-                        msg2 = "上記購入承認リクエストは承認されました (リクエスト番号は{}番, 承認者は <@{}|{}> です)".format(
-                            request_id, user_id, admin_name)
-                        self._post_channel_color(msg1, "good", msg2)
-                        self._send_direct_message(
-                            user_id, "ID: {} を承認しました".format(request_id))
-                        self.repo.approve(request_id, admin_name)
-
-                self._send_direct_message(user_id, msg)
-                return True
-            else:
-                self._send_direct_message(user_id, msg)
+        :param str user_id: コマンドを送った承認者のID
+        :param str text: コマンドの文字列 (年月を含む場合はその月だけを集計)
+        :rtype: bool
+        """
+        period = report.month_range(text)
+        start, end, label = period if period else (None, None, "all")
+        with tempfile.TemporaryFile() as f:
+            result = report.export(self.repo, f, start, end)
+            f.seek(0)
+            im_id = self._get_im_channel(user_id)
+            if im_id is None:
                 return False
+            self.client.api_call("files.upload", channels=im_id, file=f, filename="purchases-{}.csv".format(label),
+                                 title="購入承認リクエスト ({})".format(label), initial_comment=result.summary())
+        return True
 
-        elif text.startswith("却下"):
-            request_ids, msg = get_request_id(text)
-            if request_ids:
-                for request_id in request_ids:
-                    request, new = self._is_new_request(user_id, request_id)
-                    if new:
-                        msg1 = ">>> <@{}|{}>: {}".format(
-                            request.user_id, request.username, request.text)
-                        msg2 = "上記購入承認リクエストは却下されました (リクエスト番号は{}番です, 承認者は <@{}|{}> です)".format(
-                            request_id, user_id, admin_name)
-                        self._post_channel_color(msg1, "danger", msg2)
-                        self._send_direct_message(
-                            user_id, "ID: {} を却下しました".format(request_id))
-                        self.repo.deny(request_id, admin_name)
-                self._send_direct_message(user_id, msg)
-                return True
-            else:
-                self._send_direct_message(user_id, msg)
-                return False
+    @COMMANDS.command("検索")
+    def _search(self, user_id, text):
+        """ 検索語を含むリクエストを承認者に送る
 
-        elif text.startswith("無視"):
-            request_ids, msg = get_request_id(text)
-            if request_ids:
-                for request_id in request_ids:
-                    request, new = self._is_new_request(user_id, request_id)
-                    if new:
-                        self._send_direct_message(
-                            user_id, "ID: {} を無視しました".format(request_id))
-                        # 無視も一旦 deny 扱い
-                        self.repo.deny(request_id, admin_name)
-                self._send_direct_message(user_id, msg)
-                return True
-            else:
-                self._send_direct_message(user_id, msg)
-                return False
+        :param str user_id: コマンドを送った承認者のID
+        :param str text: "検索 4K モニター #2" のようなコマンドの文字列 (#2 は 2 ページ目)
+        :rtype: bool
+        """
+        query = text[len("検索"):]
+        page = 1
+        match = SEARCH_PAGE.search(query)
+        if match:
+            page = max(1, int(match.group(1)))
+            query = query[:match.start()]
+        query = " ".join(query.split())
+        if not query:
+            self._send_direct_message(user_id, "検索語を指定してください (例: `検索 モニター`)")
+            return True
+        result = self.repo.search(query, SEARCH_PAGE_SIZE, str((page - 1) * SEARCH_PAGE_SIZE))
+        for message in digest.search_digest(query, result.requests, page, result.cursor is not None):
+            self._send_direct_message(user_id, message)
+        return True
 
-        self._send_direct_message(user_id, "不明なコマンドです: {}".format(text))
-        return False
+    @COMMANDS.command("支出")
+    def _send_spend(self, user_id, text):
+        """ 投稿内容から読み取った金額の合計を承認者に送る
 
-    def _is_new_request(self, user_id, request_id):
+        合計は登録・承認のたびに Redis 上で更新済みのため、リクエストの数によらず読むだけで済む。
+
+        :param str user_id: コマンドを送った承認者のID
+        :param str text: "支出", "支出 2018-04", "支出 <@U123>" のようなコマンドの文字列
+        :rtype: bool
         """
+        users = [mention.group(1) for mention in map(USER_MENTION.match, text.split()[1:]) if mention]
+        period = report.month_range(text)
+        if users:
+            approved = self.repo.get_spend(SPEND_USER, *users)
+            pending = self.repo.get_spend(SPEND_PENDING, *users)
+            for user in users:
+                self._send_direct_message(user_id, "<@{}> の承認済みの合計: {}, 未処理の合計: {}".format(
+                    user, digest.format_yen(approved[user]), digest.format_yen(pending[user])))
+        elif period:
+            label = period[2]
+            self._send_direct_message(user_id, "{} の承認済みの合計: {}".format(
+                label, digest.format_yen(self.repo.get_spend(SPEND_MONTH, label)[label])))
+        else:
+            for message in digest.spend_digest(self.repo.get_spend(SPEND_MONTH), self.repo.get_spend(SPEND_APPROVER),
+                                               self.repo.get_spend(SPEND_PENDING)):
+                self._send_direct_message(user_id, message)
+        return True
 
-        :param str user_id: リクエストの問い合わせを行った承認者のID
-        :param (int|str) request_id: リクエストのID
-        :rtype: (PurchaseRequest|None), bool
-        :return: 取得したリクエストとそのリクエストが未対応か否か
+    def _notify_unapproved(self, user=None):
+        """ 未承認の購入承認リクエストについて報告する
+
+        user を指定した場合は、その承認者に未承認リクエストの全件を送る。
+        指定しない場合は、差分通知モードでは各承認者に前回の通知からの差分だけを、
+        全件通知モードでは全件を送る。
         """
-        request, new = self.repo.get(request_id)
-        if not request:
-            self._send_direct_message(
-                user_id, "ID: {} が見つかりません".format(request_id))
-        elif not new:
-            self._send_direct_message(
-                user_id, "ID: {} は既に対応済みです".format(request_id))
-        return request, new
+        requests = self.repo.get_new()
+        fingerprints = {request.id: digest.fingerprint(request) for request in requests}
+        if user is not None:
+            if requests:
+                for page in digest.full_digest(requests):
+                    self._send_direct_message(user, page)
+            else:
+                self._send_direct_message(user, "未承認の購入承認リクエストはありません")
+            self.repo.save_notified(user, fingerprints, reset=True)
+            return
+        if not requests and self._digest_mode != "incremental":
+            return
+
+        admins = list(self.repo.admin)
+        if self._digest_mode == "incremental":
+            notified = self.repo.get_notified(admins)
+        for admin in admins:
+            if self._digest_mode == "incremental":
+                added, edited, withdrawn = digest.diff(notified[admin], requests)
+                pages = digest.delta_digest(added, edited, withdrawn)
+                if not pages:
+                    continue
+                changed = {request.id: fingerprints[request.id] for request in added + edited}
+                self.repo.save_notified(admin, changed, removed=withdrawn)
+            else:
+                pages = digest.full_digest(requests)
+                self.repo.save_notified(admin, fingerprints, reset=True)
+            for page in pages:
+                self._send_direct_message(admin, page)
 
-    def _notify_unapproved(self, user=None, force=False):
-        """ 未承認の購入承認リクエストについて報告する """
-        now = datetime.datetime.now()
-        if not force and now - self._last_notified < datetime.timedelta(seconds=MIN_NOTIFICATION_SECONDS):
+    def _notify_job(self, args, now):
+        """ リクエストの登録・変更から MIN_NOTIFICATION_SECONDS 秒後に承認者に通知する """
+        self._notify_unapproved()
+
+    def _pending(self, args):
+        """ ジョブの引数のリクエストIDのうち、未処理のリクエストを返す """
+        return [request for request in self.repo.get_list(args, None) if request.status == RequestStatus.new]
+
+    def _remind(self, args, now):
+        """ 承認待ちが REMINDER_HOURS 時間を過ぎたリクエストを承認者に催促し、次の催促を予定する
+
+        :param list[str] args: リクエストIDのリスト
+        :param float now: 現在日時 (UNIX 時間)
+        """
+        requests = self._pending(args)
+        if not requests:
             return
+        pages = digest.reminder_digest(requests, self._reminder_hours)
+        for admin in self.repo.admin:
+            for page in pages:
+                self._send_direct_message(admin, page)
+        self.repo.schedule({job_name(JOB_REMIND, request.id): now + self._reminder_hours * 3600
+                            for request in requests})
+
+    def _escalate(self, args, now):
+        """ 承認待ちが ESCALATION_HOURS 時間を過ぎたリクエストを ESCALATION_USERS に知らせる
+
+        :param list[str] args: リクエストIDのリスト
+        :param float now: 現在日時 (UNIX 時間)
+        """
+        requests = self._pending(args)
+        if not requests:
+            return
+        pages = digest.escalation_digest(requests, self._escalation_hours)
+        for user in self._escalation_users:
+            for page in pages:
+                self._send_direct_message(user, page)
+
+    def _daily_digest(self, args, now):
+        """ 毎日 DAILY_DIGEST_TIME に未承認リクエストの全件を承認者に送り、翌日の分を予定する """
+        if not self._daily_digest_time:
+            return
+        self.repo.schedule({JOB_DAILY_DIGEST: next_daily(self._daily_digest_time, now)})
         requests = self.repo.get_new()
-        if requests:
-            message = "未承認の購入承認リクエストが {}件あります。\n".format(len(requests))
-            for request in requests:
-                message += "-----\n"
-                message += request.to_message()
-            if user is None:
-                for admin in self.repo.admin:
-                    self._send_direct_message(admin, message)
-            else:
-                self._send_direct_message(user, message)
-        elif user:
-            self._send_direct_message(user, "未承認の購入承認リクエストはありません")
-        self._last_notified = now
+        if not requests:
+            return
+        pages = digest.full_digest(requests)
+        fingerprints = {request.id: digest.fingerprint(request) for request in requests}
+        for admin in self.repo.admin:
+            for page in pages:
+                self._send_direct_message(admin, page)
+            self.repo.save_notified(admin, fingerprints, reset=True)
+
+    def _claim(self, message):
+        """ 他のボットが処理済み・処理中のイベントでなければ True を返す """
+        if self._coordinator is None:
+            return True
+        channel = message.get('channel') or ''
+        if channel != self._purchase_channel and not channel.startswith('D'):
+            return True
+        return self._coordinator.claim(message)
 
-    def _handle_message(self, message):
-        """ メッセージが届いた際のメイン処理 """
-        if self._purchase_request(message):
-            self._notify_unapproved()
-        else:
+    def _journaled(self, message):
+        """ ジャーナルに記録するイベント (購入申請チャンネルと DM のメッセージ) なら True を返す """
+        if not self._journal or message.get('type') != 'message':
+            return False
+        channel = message.get('channel') or ''
+        return channel == self._purchase_channel or channel.startswith('D')
+
+    def _journal_done(self, entry_id, message):
+        ts = None
+        if message.get('channel') == self._purchase_channel and not message.get('subtype'):
+            ts = message.get('ts')
+        self.repo.journal_done(entry_id, ts)
+
+    def _dispatch(self, message):
+        if not self._purchase_request(message):
             self._handle_command(message)
 
-    def _update(self):
-        messages = self.client.rtm_read()
-        for message in messages:
-            self._logger.debug(message)
-            self._handle_message(message)
+    def _handle_message(self, message):
+        """ メッセージが届いた際のメイン処理
+
+        処理の前にイベントをジャーナルに記録し、最後まで処理できた場合だけ完了済みにする。
+        """
+        if self._user_changed(message):
+            return
+        if not self._claim(message):
+            return
+        entry_id = self.repo.journal_append(message) if self._journaled(message) else None
+        self._dispatch(message)
+        if entry_id is not None:
+            self._journal_done(entry_id, message)
+
+    def _replay_journal(self, before=None):
+        """ 前回の終了時に完了していなかったイベントを記録順に処理し直す
+
+        処理し直しても失敗したイベントは、繰り返さないよう完了済みにする。
+
+        :param (None|float) before: 指定した場合はこの日時 (UNIX 時間) より前に記録したイベントだけを処理し直す
+        :rtype: int
+        :return: 処理し直したイベント数
+        """
+        entries = self.repo.journal_pending(before)
+        for entry_id, message in entries:
+            try:
+                self._dispatch(message)
+            except Exception:
+                self._logger.exception("Failed to replay message: {}".format(message))
+            self._journal_done(entry_id, message)
+        return len(entries)
+
+    def _replay_stale_journal(self, args, now):
+        """ 記録から JOURNAL_STALE_SECONDS 秒が過ぎても完了していないイベントを処理し直し、次の確認を予定する
+
+        SHARED_WORKERS で動かしている場合、処理の途中で終了したワーカーのイベントを
+        起動時のリーダーの catch_up を待たずに処理する。ジョブは 1 つのボットだけが取り出すため、
+        同じイベントを複数のボットが処理し直すことはない。
+
+        :param list args: 使わない
+        :param float now: 現在日時 (UNIX 時間)
+        """
+        if not self._journal:
+            return
+        self.repo.schedule({JOB_JOURNAL: now + JOURNAL_CHECK_INTERVAL})
+        replayed = self._replay_journal(now - self._journal_stale_seconds)
+        if replayed:
+            self._logger.info("replayed {} stale unfinished events".format(replayed))
+
+    def _missed_messages(self):
+        """ 最後に処理した投稿より後に購入申請チャンネルに投稿されたメッセージを取得する
+
+        一度も処理していない場合は過去の投稿を取り込まない。
+
+        :rtype: list[dict]
+        :return: RTM イベントと同じ形式のメッセージの古い順のリスト
+        """
+        oldest = self.repo.journal_cursor()
+        if oldest is None:
+            return []
+        messages = []
+        cursor = None
+        while True:
+            kwargs = {"channel": self._purchase_channel, "oldest": oldest, "limit": HISTORY_PAGE_SIZE}
+            if cursor:
+                kwargs["cursor"] = cursor
+            result = self.client.api_call("conversations.history", **kwargs)
+            if not result.get("ok"):
+                self._logger.error("Failed to fetch channel history: {}".format(result.get("error")))
+                break
+            messages.extend(result.get("messages", []))
+            cursor = (result.get("response_metadata") or {}).get("next_cursor")
+            if not cursor:
+                break
+        events = []
+        for message in sorted(messages, key=lambda m: float(m["ts"])):
+            if message.get("subtype") or message.get("bot_id"):
+                continue
+            event = dict(message, type="message", channel=self._purchase_channel)
+            # スレッドの親の投稿は、投稿された時点ではスレッドではなかった
+            if event.get("thread_ts") == event["ts"]:
+                del event["thread_ts"]
+            events.append(event)
+        return events
+
+    def catch_up(self):
+        """ 停止中に取りこぼしたイベントを処理する
+
+        完了していなかったジャーナルのイベントを処理し直し、
+        停止中の購入申請チャンネルへの投稿を conversations.history でまとめて取り込む。
+        リクエストの登録は投稿ごとに 1 度だけなので、既に処理済みの投稿が含まれていてもよい。
+        """
+        if not self._journal:
+            return
+        if self._coordinator is not None and not self._coordinator.is_leader():
+            return
+        replayed = self._replay_journal()
+        if replayed:
+            self._logger.info("replayed {} unfinished events".format(replayed))
+        events = self._missed_messages()
+        if events:
+            self._logger.info("catching up on {} messages".format(len(events)))
+            asyncio.run(self.run(replay(events)))
+
+    async def run(self, source):
+        """ source から届くイベントを並行に処理する
+
+        同じ投稿に対するイベントや同じユーザからのコマンドは到着順に処理される。
+
+        :param source: RTM イベントを返す非同期イテレータ
+        """
+        await Runtime(self._handle_message, max_workers=self._workers).run(source)
 
     def main(self):
         if not self.client.rtm_connect():
             raise RuntimeError('failed to connect slack, invalid token?')
         self.client.api_call("users.setActive")
+        self.catch_up()
+        self.scheduler.start(self._stop)
+        metrics_port = os.environ.get("METRICS_PORT")
+        if metrics_port:
+            metrics_host = os.environ.get("METRICS_HOST", metrics.DEFAULT_HOST)
+            metrics.start_http_server(metrics_port, host=metrics_host)
+            self._logger.info("serving metrics on {}:{}".format(metrics_host, metrics_port))
         self._logger.info("Begin main loop")
-        while True:
-            self._update()
-            time.sleep(0.1)
+        asyncio.run(self.run(RTMEventSource(self.client)))
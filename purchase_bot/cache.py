@@ -0,0 +1,65 @@
+"""
+プロセス内キャッシュ
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """ 有効期限付きの LRU キャッシュ
+
+    複数のワーカースレッドから同時に利用できる。
+
+    :param int maxsize: 保持する最大件数 (超えた場合は最も古く使われたものから捨てる)
+    :param float ttl: 有効期限 (秒)
+    :param callable timer: 現在時刻を返す関数
+    """
+
+    def __init__(self, maxsize=1024, ttl=3600, timer=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._timer = timer
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """ 有効期限内の値を返す
+
+        :return: キャッシュされた値 (存在しないか期限切れの場合は None)
+        """
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                value, expires = item
+                if expires > self._timer():
+                    self._items.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._items[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._items[key] = (value, self._timer() + self.ttl)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def stats(self):
+        """ ヒット数・ミス数・保持件数を返す
+
+        :rtype: dict
+        """
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._items)}
@@ -0,0 +1,78 @@
+"""
+1 つの Redis を共有する複数のボットプロセスの協調
+"""
+
+import os
+import socket
+import threading
+import time
+
+
+def event_id(message):
+    """ 全てのワーカーに届く RTM イベントのうち、1 つのワーカーだけが処理すべきものの識別子を返す
+
+    :param dict message: RTM イベント
+    :rtype: (None|str)
+    :return: 識別子 (全ワーカーで処理してよいイベントは None)
+    """
+    if message.get('type') != 'message':
+        return None
+    ts = message.get('event_ts') or message.get('ts') or message.get('deleted_ts')
+    if not ts:
+        return None
+    return "{}:{}:{}".format(message.get('channel'), message.get('subtype') or '', ts)
+
+
+def default_worker_id():
+    return os.environ.get("WORKER_ID") or "{}-{}".format(socket.gethostname(), os.getpid())
+
+
+class Coordinator:
+    """ イベントの重複処理を防ぎ、定期処理をリーダーだけが行うようにする
+
+    :param PurchaseRepo repo:
+    :param (None|str) worker_id: このワーカーのID
+    :param int claim_ttl: 処理担当の記録を残す秒数
+    :param float lease_ttl: リーダーのリースの有効期限 (秒)
+    :param callable timer: 現在時刻を返す関数
+    """
+    LEADER_LEASE = "leader"
+
+    def __init__(self, repo, worker_id=None, claim_ttl=3600, lease_ttl=30, timer=time.monotonic):
+        self._repo = repo
+        self.worker_id = worker_id or default_worker_id()
+        self.claim_ttl = claim_ttl
+        self.lease_ttl = lease_ttl
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._leader_until = None
+        self._checked = None
+
+    def claim(self, message):
+        """ このワーカーがイベントを処理すべきかを返す
+
+        :param dict message: RTM イベント
+        :rtype: bool
+        """
+        identifier = event_id(message)
+        if identifier is None:
+            return True
+        return self._repo.claim_event(identifier, self.worker_id, self.claim_ttl)
+
+    def is_leader(self):
+        """ このワーカーがリーダーかを返す
+
+        リースの確認・延長は有効期限の 1/3 ごとに行う。
+        延長できずに有効期限が過ぎた場合はリーダーではなくなる。
+
+        :rtype: bool
+        """
+        with self._lock:
+            now = self._timer()
+            if self._checked is None or now - self._checked >= self.lease_ttl / 3:
+                self._checked = now
+                if self._repo.acquire_lease(self.LEADER_LEASE, self.worker_id, self.lease_ttl):
+                    self._leader_until = now + self.lease_ttl
+                else:
+                    self._leader_until = None
+            return self._leader_until is not None and now < self._leader_until
@@ -0,0 +1,64 @@
+"""
+ダイレクトメッセージのコマンドの登録と振り分け
+"""
+
+import re
+from collections import namedtuple
+
+# name: コマンド名, handler: 処理する関数, admin: 承認者専用なら True, username: 送信者のユーザ名が必要なら True
+Command = namedtuple("Command", ["name", "handler", "admin", "username"])
+
+
+class CommandRouter:
+    """ コマンドの一覧と、コマンド文字列から実行するコマンドを選ぶ照合器
+
+    複数のコマンドに当てはまる場合は先に登録したものを選ぶ。
+    全てのコマンドを 1 つの正規表現にまとめておき、1 回の照合で判定する。
+    """
+
+    def __init__(self):
+        self._commands = []
+        self._pattern = None
+
+    def command(self, name, anywhere=False, admin=True, username=False):
+        """ コマンドを処理する関数を登録するデコレータ
+
+        handler は (bot, user_id, text) で呼ばれ、username が True の場合は送信者のユーザ名が加わる。
+
+        :param str name: コマンド名
+        :param bool anywhere: 文字列のどこかに name を含めば対象とする場合は True (False なら先頭が一致する場合のみ)
+        :param bool admin: 承認者だけが使えるコマンドの場合は True
+        :param bool username: 送信者のユーザ名 (users.info) が必要な場合は True
+        """
+        def decorator(handler):
+            self._commands.append((Command(name, handler, admin, username), anywhere))
+            self._pattern = None
+            return handler
+        return decorator
+
+    @property
+    def commands(self):
+        """ 登録順のコマンド一覧
+
+        :rtype: list[Command]
+        """
+        return [command for command, _ in self._commands]
+
+    def _compile(self):
+        # 先頭位置での先読みを登録順に並べると、最初に当てはまったコマンドの空のグループだけが一致する
+        parts = ["(?={}{})(?P<c{}>)".format(".*?" if anywhere else "", re.escape(command.name), i)
+                 for i, (command, anywhere) in enumerate(self._commands)]
+        return re.compile("(?:{})".format("|".join(parts)), re.DOTALL)
+
+    def match(self, text):
+        """ 文字列に当てはまるコマンドを返す
+
+        :param str text: NFKC 正規化済みのコマンド文字列
+        :rtype: (None|Command)
+        """
+        if self._pattern is None:
+            self._pattern = self._compile()
+        match = self._pattern.match(text)
+        if match is None:
+            return None
+        return self._commands[int(match.lastgroup[1:])][0]
@@ -0,0 +1,177 @@
+"""
+未承認リクエストの通知文の組み立て
+"""
+
+import hashlib
+
+# 1 通のメッセージに含める最大文字数
+MAX_MESSAGE_LENGTH = 3000
+
+
+def fingerprint(request):
+    """ 通知済みの内容から変更されたかを判定するための値を返す
+
+    :param PurchaseRequest request:
+    :rtype: str
+    """
+    return hashlib.sha1(request.text.encode("utf-8")).hexdigest()
+
+
+def diff(notified, requests):
+    """ 前回通知した内容と現在の未承認リクエストの差分を求める
+
+    :param dict[str, str] notified: 通知済みのリクエストID → fingerprint
+    :param list[PurchaseRequest] requests: 現在の未承認リクエスト
+    :rtype: (list[PurchaseRequest], list[PurchaseRequest], list[int])
+    :return: 新規のリクエスト, 内容が変更されたリクエスト, 未承認ではなくなったリクエストのID
+    """
+    added = []
+    edited = []
+    current = set()
+    for request in requests:
+        key = str(request.id)
+        current.add(key)
+        previous = notified.get(key)
+        if previous is None:
+            added.append(request)
+        elif previous != fingerprint(request):
+            edited.append(request)
+    withdrawn = sorted(int(key) for key in notified if key not in current)
+    return added, edited, withdrawn
+
+
+def paginate(blocks, limit=MAX_MESSAGE_LENGTH):
+    """ 文字列のブロックを limit 文字以内のメッセージに分ける
+
+    1 つのブロックが limit を超える場合はそのブロックだけで 1 通とする。
+    複数のメッセージになる場合は末尾にページ番号を付ける。
+
+    :param list[str] blocks: メッセージの構成要素
+    :param int limit: 1 通の最大文字数
+    :rtype: list[str]
+    """
+    pages = []
+    page = []
+    length = 0
+    for block in blocks:
+        if page and length + len(block) > limit:
+            pages.append(page)
+            page = []
+            length = 0
+        page.append(block)
+        length += len(block)
+    if page:
+        pages.append(page)
+    if len(pages) == 1:
+        return ["".join(pages[0])]
+    return ["".join(page) + "({}/{})".format(i, len(pages)) for i, page in enumerate(pages, 1)]
+
+
+def _request_blocks(requests):
+    return ["-----\n" + request.to_message() for request in requests]
+
+
+def full_digest(requests):
+    """ 未承認リクエスト全件の通知文を返す
+
+    :param list[PurchaseRequest] requests:
+    :rtype: list[str]
+    """
+    header = "未承認の購入承認リクエストが {}件あります。\n".format(len(requests))
+    return paginate([header] + _request_blocks(requests))
+
+
+def delta_digest(added, edited, withdrawn):
+    """ 差分の通知文を返す (差分が無い場合は空のリスト)
+
+    :param list[PurchaseRequest] added: 新規のリクエスト
+    :param list[PurchaseRequest] edited: 内容が変更されたリクエスト
+    :param list[int] withdrawn: 未承認ではなくなったリクエストのID
+    :rtype: list[str]
+    """
+    blocks = []
+    if added:
+        blocks.append("新しい購入承認リクエストが {}件あります。\n".format(len(added)))
+        blocks.extend(_request_blocks(added))
+    if edited:
+        blocks.append("内容が変更された購入承認リクエストが {}件あります。\n".format(len(edited)))
+        blocks.extend(_request_blocks(edited))
+    if withdrawn:
+        blocks.append("取り下げまたは対応済みになった購入承認リクエスト: ID: {}\n".format(
+            ", ".join(str(request_id) for request_id in withdrawn)))
+    if not blocks:
+        return []
+    return paginate(blocks)
+
+
+STATUS_LABELS = {"new": "未承認", "approved": "承認済み", "denied": "却下済み"}
+
+
+def search_digest(query, requests, page, has_next):
+    """ 検索結果の通知文を返す
+
+    :param str query: 検索語
+    :param list[PurchaseRequest] requests: 1 ページ分の検索結果
+    :param int page: ページ番号 (1 から)
+    :param bool has_next: 次のページがある場合は True
+    :rtype: list[str]
+    """
+    if not requests:
+        return ["「{}」に当てはまる購入承認リクエストはありません".format(query)]
+    blocks = ["「{}」の検索結果 ({}ページ目)\n".format(query, page)]
+    blocks.extend("-----\n[{}] {}".format(STATUS_LABELS[request.status.value], request.to_message())
+                  for request in requests)
+    if has_next:
+        blocks.append("続き: `検索 {} #{}`\n".format(query, page + 1))
+    return paginate(blocks)
+
+
+def reminder_digest(requests, hours):
+    """ 承認待ちが長いリクエストの催促の通知文を返す
+
+    :param list[PurchaseRequest] requests:
+    :param float hours: 催促までの時間
+    :rtype: list[str]
+    """
+    header = "承認待ちが {:g}時間を過ぎた購入承認リクエストが {}件あります。\n".format(hours, len(requests))
+    return paginate([header] + _request_blocks(requests))
+
+
+def escalation_digest(requests, hours):
+    """ エスカレーション先に送る通知文を返す
+
+    :param list[PurchaseRequest] requests:
+    :param float hours: エスカレーションまでの時間
+    :rtype: list[str]
+    """
+    header = "{:g}時間以上承認されていない購入承認リクエストが {}件あります。\n".format(hours, len(requests))
+    return paginate([header] + _request_blocks(requests))
+
+
+def format_yen(amount):
+    """ 金額を "¥12,800" の形式にする
+
+    :param int amount: 円
+    :rtype: str
+    """
+    return "¥{:,}".format(amount)
+
+
+def spend_digest(months, approvers, pending):
+    """ 金額の合計の通知文を返す
+
+    :param dict[str, int] months: "YYYY-MM" → その月に承認したリクエストの合計
+    :param dict[str, int] approvers: 承認者のユーザ名 → 承認したリクエストの合計
+    :param dict[str, int] pending: 利用者のユーザID → 未処理のリクエストの合計
+    :rtype: list[str]
+    """
+    blocks = ["承認済みの合計: {}\n".format(format_yen(sum(months.values())))]
+    if months:
+        blocks.append("-----\n月ごと\n")
+        blocks.extend("{}: {}\n".format(month, format_yen(amount)) for month, amount in sorted(months.items()))
+    if approvers:
+        blocks.append("-----\n承認者ごと\n")
+        blocks.extend("{}: {}\n".format(approver or "(不明)", format_yen(amount))
+                      for approver, amount in sorted(approvers.items(), key=lambda item: -item[1]))
+    blocks.append("-----\n未処理の合計: {} ({}人)\n".format(format_yen(sum(pending.values())), len(pending)))
+    return paginate(blocks)
@@ -0,0 +1,120 @@
+"""
+整数IDの集合を重ならない区間のリストとして扱う
+"""
+
+import bisect
+
+
+class IdSet:
+    """ 整数IDの集合
+
+    連続したIDは 1 つの区間 (両端を含む) にまとめて保持するため、
+    1-100000 のような範囲も区間 1 つ分のメモリで表せる。
+    区間は開始位置の順に並び、隣り合う区間の間には必ず 1 つ以上の隙間がある。
+
+    :param collections.Iterable[(int, int)] intervals: 初期値の区間のリスト
+    """
+
+    def __init__(self, intervals=()):
+        self._starts = []
+        self._ends = []
+        for start, end in intervals:
+            self.add(start, end)
+
+    def __repr__(self):
+        return "<IdSet: {}>".format(self.format())
+
+    def __len__(self):
+        return sum(end - start + 1 for start, end in zip(self._starts, self._ends))
+
+    def __bool__(self):
+        return bool(self._starts)
+
+    def __iter__(self):
+        for start, end in zip(self._starts, self._ends):
+            yield from range(start, end + 1)
+
+    def __contains__(self, value):
+        i = bisect.bisect_right(self._starts, value) - 1
+        return i >= 0 and value <= self._ends[i]
+
+    def __eq__(self, other):
+        return isinstance(other, IdSet) and self.intervals() == other.intervals()
+
+    def intervals(self):
+        """ 区間のリストを返す
+
+        :rtype: list[(int, int)]
+        """
+        return list(zip(self._starts, self._ends))
+
+    def add(self, start, end=None):
+        """ start から end までのIDを加える (end を省略した場合は start だけ) """
+        if end is None:
+            end = start
+        if end < start:
+            return
+        # 重なるか隣り合う区間をまとめて 1 つにする
+        i = bisect.bisect_left(self._ends, start - 1)
+        j = bisect.bisect_right(self._starts, end + 1)
+        if i < j:
+            start = min(start, self._starts[i])
+            end = max(end, self._ends[j - 1])
+        self._starts[i:j] = [start]
+        self._ends[i:j] = [end]
+
+    def discard(self, start, end=None):
+        """ start から end までのIDを取り除く (end を省略した場合は start だけ) """
+        if end is None:
+            end = start
+        if end < start:
+            return
+        i = bisect.bisect_left(self._ends, start)
+        j = bisect.bisect_right(self._starts, end)
+        if i >= j:
+            return
+        starts, ends = [], []
+        if self._starts[i] < start:
+            starts.append(self._starts[i])
+            ends.append(start - 1)
+        if self._ends[j - 1] > end:
+            starts.append(end + 1)
+            ends.append(self._ends[j - 1])
+        self._starts[i:j] = starts
+        self._ends[i:j] = ends
+
+    def update(self, other):
+        """ other の全てのIDを加える """
+        for start, end in other.intervals():
+            self.add(start, end)
+
+    def difference_update(self, other):
+        """ other に含まれるIDを全て取り除く """
+        for start, end in other.intervals():
+            self.discard(start, end)
+
+    def chunks(self, size):
+        """ IDを小さい順に size 個ずつのリストにして返す
+
+        :rtype: collections.Iterable[list[int]]
+        """
+        chunk = []
+        for start, end in zip(self._starts, self._ends):
+            value = start
+            while value <= end:
+                stop = min(end, value + size - len(chunk) - 1)
+                chunk.extend(range(value, stop + 1))
+                value = stop + 1
+                if len(chunk) >= size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+    def format(self):
+        """ "1-3, 5" の形式の文字列を返す
+
+        :rtype: str
+        """
+        return ", ".join(str(start) if start == end else "{}-{}".format(start, end)
+                         for start, end in zip(self._starts, self._ends))
@@ -0,0 +1,326 @@
+"""
+処理時間と呼び出し回数の計測、および Prometheus 形式での公開
+"""
+
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import redis
+from redis.client import Pipeline
+from redis.cluster import ClusterPipeline, RedisCluster
+
+# /metrics の既定の待ち受けアドレス (外部に公開する場合は METRICS_HOST で指定する)
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra:
+        pairs.append('{}="{}"'.format(*extra))
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _Metric:
+    """ ラベルの値ごとに子を持つメトリクスの基底クラス """
+    TYPE = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        self._lock = threading.Lock()
+        (registry if registry is not None else REGISTRY).register(self)
+
+    def labels(self, *values):
+        values = tuple(str(value) for value in values)
+        child = self._children.get(values)
+        if child is None:
+            with self._lock:
+                child = self._children.setdefault(values, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def collect(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation),
+                 "# TYPE {} {}".format(self.name, self.TYPE)]
+        for values, child in sorted(self._children.items()):
+            lines.extend(self._render(values, child))
+        return lines
+
+    def _render(self, values, child):
+        return ["{}{} {}".format(self.name, _format_labels(self.labelnames, values), child.value)]
+
+
+class _CounterChild:
+
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+class Counter(_Metric):
+    """ 単調増加するカウンタ """
+    TYPE = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class _GaugeChild:
+
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """ 値を収集時に function を呼んで求める """
+        self._function = function
+
+    @property
+    def value(self):
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+
+class Gauge(_Metric):
+    """ 増減する値 """
+    TYPE = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class _Timer:
+
+    def __init__(self, child):
+        self._child = child
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._child.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _HistogramChild:
+
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        index = bisect.bisect_left(self._buckets, value)
+        with self._lock:
+            self.counts[index] += 1
+            self.sum += value
+
+    def time(self):
+        """ with 文の中の処理時間を記録する """
+        return _Timer(self)
+
+
+class Histogram(_Metric):
+    """ 値の分布 (累積バケット) """
+    TYPE = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=None):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render(self, values, child):
+        with child._lock:
+            counts = list(child.counts)
+            total = child.sum
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            le = "+Inf" if bound == float("inf") else repr(bound)
+            lines.append("{}_bucket{} {}".format(
+                self.name, _format_labels(self.labelnames, values, ("le", le)), cumulative))
+        labels = _format_labels(self.labelnames, values)
+        lines.append("{}_sum{} {}".format(self.name, labels, total))
+        lines.append("{}_count{} {}".format(self.name, labels, cumulative))
+        return lines
+
+
+class Registry:
+    """ メトリクスの一覧 """
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+
+    def render(self):
+        """ Prometheus のテキスト形式で出力する
+
+        :rtype: str
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.collect())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+EVENT_SECONDS = Histogram("purchase_bot_event_seconds", "Time spent handling an RTM event.", ["type"])
+COMMAND_SECONDS = Histogram("purchase_bot_command_seconds", "Time spent handling a direct message command.",
+                            ["command"])
+SLACK_API_SECONDS = Histogram("purchase_bot_slack_api_seconds", "Latency of Slack Web API calls.", ["method"])
+SLACK_API_ERRORS = Counter("purchase_bot_slack_api_errors_total", "Slack Web API calls that returned ok=false.",
+                           ["method", "error"])
+REDIS_SECONDS = Histogram("purchase_bot_redis_seconds", "Latency of Redis round trips.", ["command"])
+# channel は購入申請チャンネルごとのキューの場合のチャンネルID (プロセスで共有するキューは空文字列)
+QUEUE_DEPTH = Gauge("purchase_bot_queue_depth", "Number of items waiting in an internal queue.", ["queue", "channel"])
+RATE_LIMIT_RETRIES = Counter("purchase_bot_rate_limit_retries_total", "Slack calls retried after a rate limit.",
+                             ["method"])
+SLACK_API_RETRIES = Counter("purchase_bot_slack_api_retries_total",
+                            "Slack Web API requests resent after a rate limit or a transient error.",
+                            ["method", "reason"])
+CACHE_LOOKUPS = Gauge("purchase_bot_cache_lookups", "Lookups of an in-process cache since start, by result.",
+                      ["cache", "channel", "result"])
+CACHE_SIZE = Gauge("purchase_bot_cache_size", "Number of entries held in an in-process cache.", ["cache", "channel"])
+
+
+def register_cache(name, channel, cache):
+    """ TTLCache のヒット数・ミス数・保持件数を収集時に読むよう登録する
+
+    :param str name: キャッシュの名前 (ラベルの値)
+    :param str channel: キャッシュを持つボットの購入申請チャンネルのID
+    :param purchase_bot.cache.TTLCache cache:
+    """
+    CACHE_LOOKUPS.labels(name, channel, "hit").set_function(lambda: cache.stats()["hits"])
+    CACHE_LOOKUPS.labels(name, channel, "miss").set_function(lambda: cache.stats()["misses"])
+    CACHE_SIZE.labels(name, channel).set_function(lambda: cache.stats()["size"])
+
+
+class InstrumentedSlackClient:
+    """ Web API の呼び出しを計測する Slack クライアントのラッパー
+
+    api_call 以外の属性は元のクライアントに委譲する。
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def api_call(self, method, **kwargs):
+        with SLACK_API_SECONDS.labels(method).time():
+            result = self._client.api_call(method, **kwargs)
+        if isinstance(result, dict) and not result.get("ok", True):
+            SLACK_API_ERRORS.labels(method, result.get("error", "")).inc()
+        return result
+
+
+class InstrumentedPipeline(Pipeline):
+    """ execute 1 回を 1 ラウンドトリップとして計測するパイプライン """
+
+    def execute(self, raise_on_error=True):
+        command = "MULTI" if self.transaction else "PIPELINE"
+        with REDIS_SECONDS.labels(command).time():
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedis(redis.StrictRedis):
+    """ コマンドごとの処理時間を計測する Redis クライアント """
+
+    def execute_command(self, *args, **options):
+        with REDIS_SECONDS.labels(str(args[0]).upper()).time():
+            return super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+
+class InstrumentedClusterPipeline(ClusterPipeline):
+    """ execute 1 回を 1 ラウンドトリップとして計測する Redis Cluster のパイプライン """
+
+    def execute(self, raise_on_error=True):
+        with REDIS_SECONDS.labels("PIPELINE").time():
+            return super().execute(raise_on_error)
+
+
+class InstrumentedRedisCluster(RedisCluster):
+    """ コマンドごとの処理時間を計測する Redis Cluster クライアント """
+
+    def execute_command(self, *args, **kwargs):
+        with REDIS_SECONDS.labels(str(args[0]).upper()).time():
+            return super().execute_command(*args, **kwargs)
+
+    def pipeline(self, transaction=None, shard_hint=None):
+        if transaction or shard_hint:
+            # RedisCluster.pipeline と同じエラーにする
+            return super().pipeline(transaction, shard_hint)
+        return InstrumentedClusterPipeline(
+            nodes_manager=self.nodes_manager,
+            commands_parser=self.commands_parser,
+            startup_nodes=self.nodes_manager.startup_nodes,
+            result_callbacks=self.result_callbacks,
+            cluster_response_callbacks=self.cluster_response_callbacks,
+            cluster_error_retry_attempts=self.cluster_error_retry_attempts,
+            read_from_replicas=self.read_from_replicas,
+            reinitialize_steps=self.reinitialize_steps,
+            lock=self._lock,
+        )
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_http_server(port, host=DEFAULT_HOST, registry=REGISTRY):
+    """ /metrics でメトリクスを公開する HTTP サーバをバックグラウンドで起動する
+
+    :param (int|str) port: 待ち受けるポート
+    :param str host: 待ち受けるアドレス (既定はローカルホストのみ)
+    :rtype: ThreadingHTTPServer
+    """
+    handler = type("MetricsHandler", (_MetricsHandler,), {"registry": registry})
+    server = ThreadingHTTPServer((host, int(port)), handler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics", daemon=True)
+    thread.start()
+    return server
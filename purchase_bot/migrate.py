@@ -0,0 +1,199 @@
+"""
+旧形式 (JSON 文字列 + 承認者キー) のリクエストをハッシュ形式に移行する
+"""
+
+import time
+
+from .model import SCHEMA_VERSION, PurchaseRequest, RequestStatus
+from .repo import PurchaseRepo
+
+# 旧形式のリクエストをハッシュに変換する (ハッシュが既にある場合は何もしない)
+# KEYS: 未処理の集合, 承認済みの集合, 却下済みの集合, (リクエストのハッシュ, 旧形式のリクエスト, 旧形式の承認者) * N
+# ARGV: 保存形式のバージョン, リクエストID * N
+MIGRATE_SCRIPT = """
+local converted = 0
+local n = 1
+for i = 4, #KEYS, 3 do
+    local record, item, approver = KEYS[i], KEYS[i + 1], KEYS[i + 2]
+    n = n + 1
+    local request_id = ARGV[n]
+    local value = redis.call('GET', item)
+    if value and redis.call('EXISTS', record) == 0 then
+        local status = 'denied'
+        if redis.call('ZSCORE', KEYS[1], request_id) then
+            status = 'new'
+        elseif redis.call('ZSCORE', KEYS[2], request_id) then
+            status = 'approved'
+        end
+        local request = cjson.decode(value)
+        local fields = {'v', ARGV[1], 'u', request.user_id or '', 'n', request.username or '',
+                        't', request.text or '', 's', status}
+        local name = redis.call('GET', approver)
+        if name then
+            table.insert(fields, 'a')
+            table.insert(fields, name)
+        end
+        if request.ts then
+            table.insert(fields, 'ch')
+            table.insert(fields, request.channel)
+            table.insert(fields, 'ts')
+            table.insert(fields, request.ts)
+        end
+        redis.call('HSET', record, unpack(fields))
+        redis.call('DEL', item, approver)
+        converted = converted + 1
+    end
+end
+return converted
+"""
+
+
+def migrate(repo, batch_size=500, progress=None):
+    """ 旧形式のリクエストを batch_size 件ずつハッシュ形式に変換する
+
+    ボットを動かしたまま実行できる。変換中に状態が変わったリクエストを取りこぼさないよう、
+    変換件数が 0 になるまで全ての状態の集合を走査し、最後に保存形式のバージョンを記録する。
+    変換した場合は金額の合計を集計済みでない状態に戻し、次の起動時の PurchaseRepo.backfill_spend で数え直す。
+    以前のバージョンの状態ごとの集合が残っている場合は、先にソート済み集合に移す。
+
+    :param PurchaseRepo repo:
+    :param int batch_size: 1 回のスクリプト呼び出しで変換する件数
+    :param (None|callable) progress: 変換件数の累計を受け取る関数
+    :rtype: int
+    :return: 変換したリクエスト数
+    """
+    client = repo._redis
+    repo.backfill_status_index()
+    script = client.register_script(MIGRATE_SCRIPT)
+    status_keys = [repo.NEW_KEY, repo.APPROVED_KEY, repo.DENIED_KEY]
+    total = 0
+    while True:
+        converted = 0
+        for status_key in status_keys:
+            batch = []
+            for request_id, _ in client.zscan_iter(status_key, count=batch_size):
+                batch.append(request_id)
+                if len(batch) >= batch_size:
+                    converted += _migrate_batch(repo, script, status_keys, batch)
+                    batch = []
+            if batch:
+                converted += _migrate_batch(repo, script, status_keys, batch)
+            if progress is not None:
+                progress(total + converted)
+        total += converted
+        if converted == 0:
+            break
+    pipe = client.pipeline(transaction=False)
+    if total:
+        # 変換したリクエストには単価と数量が無いため、次の起動時に金額の合計を数え直させる
+        # (保存形式のバージョンより先に消すため、途中で止まっても再実行すれば数え直される)
+        pipe.delete(repo.SPEND_READY_KEY)
+    pipe.set(repo.SCHEMA_KEY, SCHEMA_VERSION)
+    pipe.execute()
+    repo.refresh_schema()
+    return total
+
+
+def _migrate_batch(repo, script, status_keys, request_ids):
+    script_keys = list(status_keys)
+    for request_id in request_ids:
+        script_keys.append(repo.RECORD_KEY.format(request_id))
+        script_keys.append(repo.ITEM_KEY.format(request_id))
+        script_keys.append(repo.ITEM_ADMIN_KEY.format(request_id))
+    return script(keys=script_keys, args=[SCHEMA_VERSION] + list(request_ids))
+
+
+def move_to_namespace(client, namespace, batch_size=500, archive=None):
+    """ 名前空間の無い (以前の単一チャンネルのボットの) キーを "purchase:{namespace}:" で始まるキーに移す
+
+    移した後は全てのキーが同じハッシュタグを持ち、Redis Cluster の 1 つのスロットに入る。
+    スロットの異なるキーには RENAME できないため、Redis Cluster に移る前の Redis で、全てのボットを止めてから実行する。
+    ボットは SCHEMA_KEY か ID_KEY が残っている間は以前のキーを使うため (purchase_bot.repo.channel_namespace)、
+    この 2 つは最後に移す。途中で止まった場合も再実行すれば残りを移せる。
+
+    :param redis.StrictRedis client:
+    :param str namespace: 移動先の名前空間 (購入申請チャンネルのID)
+    :param int batch_size: 1 ラウンドトリップで移すキーの数
+    :param (None|purchase_bot.archive.Archive) archive: 名前空間の無いテーブルの保管済みリクエストも移す場合の保管先
+    :rtype: int
+    :return: 移したキーの数
+    """
+    prefix = "purchase:{{{}}}".format(namespace)
+    last = [PurchaseRepo.SCHEMA_KEY, PurchaseRepo.ID_KEY]
+    # 他の名前空間のキー ("purchase:{" で始まる) は移さない
+    keys = [key for key in client.scan_iter(match="purchase:*", count=batch_size)
+            if not key.startswith("purchase:{") and key not in last]
+    keys += [key for key in last if client.exists(key)]
+    pipe = client.pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(prefix + key[len("purchase"):])
+    conflicts = [key for key, exists in zip(keys, pipe.execute()) if exists]
+    if conflicts:
+        raise RuntimeError("{} keys already exist in namespace {}: {}".format(
+            len(conflicts), namespace, ", ".join(conflicts[:5])))
+    for start in range(0, len(keys), batch_size):
+        pipe = client.pipeline(transaction=False)
+        for key in keys[start:start + batch_size]:
+            pipe.renamenx(key, prefix + key[len("purchase"):])
+        pipe.execute()
+    if archive is not None:
+        archive.rename(namespace)
+    return len(keys)
+
+
+def _measure(repo, repeat=3):
+    """ キー数・使用メモリ・全件取得にかかる時間を計測する """
+    client = repo._redis
+    keys = list(client.scan_iter(count=1000))
+    try:
+        pipe = client.pipeline(transaction=False)
+        for key in keys:
+            pipe.memory_usage(key)
+        memory = sum(usage or 0 for usage in pipe.execute())
+    except Exception:
+        # MEMORY USAGE に対応していない場合
+        memory = None
+    elapsed = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        repo.get_all()
+        elapsed.append(time.perf_counter() - start)
+    return {"keys": len(keys), "memory_bytes": memory, "get_all_seconds": round(min(elapsed), 4)}
+
+
+def compare_layouts(repo, size):
+    """ 旧形式とハッシュ形式のメモリ使用量と読み込み速度を比較する
+
+    空のデータベースに size 件の旧形式のリクエストを作り、計測してから移行して再度計測する。
+
+    :param PurchaseRepo repo: 空のデータベースに接続したリポジトリ
+    :param int size: 作成するリクエスト数
+    :rtype: dict
+    """
+    client = repo._redis
+    client.delete(repo.SCHEMA_KEY)
+    if client.dbsize():
+        raise RuntimeError("compare_layouts requires an empty database")
+    repo.legacy_reads = True
+    status_keys = {RequestStatus.new: repo.NEW_KEY, RequestStatus.approved: repo.APPROVED_KEY,
+                   RequestStatus.denied: repo.DENIED_KEY}
+    statuses = list(status_keys)
+    pipe = client.pipeline(transaction=False)
+    for i in range(1, size + 1):
+        status = statuses[i % len(statuses)]
+        request = PurchaseRequest(i, "U{:08d}".format(i % 100), "user{}".format(i % 100),
+                                  "購入申請 {} モニター 1台 ¥{:,}".format(i, 10000 + i),
+                                  channel="C00000001", ts="{}.000100".format(1500000000 + i))
+        pipe.set(repo.ITEM_KEY.format(i), request.to_str())
+        pipe.zadd(status_keys[status], {i: i})
+        if status != RequestStatus.new:
+            pipe.set(repo.ITEM_ADMIN_KEY.format(i), "admin")
+        if i % 1000 == 0:
+            pipe.execute()
+    pipe.set(repo.ID_KEY, size)
+    pipe.execute()
+
+    legacy = _measure(repo)
+    migrate(repo)
+    compact = _measure(repo)
+    return {"size": size, "legacy": legacy, "compact": compact}
@@ -1,6 +1,9 @@
 import json
 from enum import Enum
 
+# Redis のハッシュに保存する形式のバージョン
+SCHEMA_VERSION = 2
+
 
 class RequestStatus(Enum):
     new = "new"
@@ -17,21 +20,37 @@ class PurchaseRequest:
     :param str text: リクエスト内容
     :param RequestStatus status: リクエストの承認状況
     :param (None|str) approver: リクエストの承認者
+    :param (None|str) channel: リクエストが投稿されたチャンネルのID
+    :param (None|str) ts: リクエストが投稿されたメッセージの ts
+    :param (None|float) created: リクエストの登録日時 (UNIX 時間)
+    :param (None|float) closed: リクエストが承認・却下された日時 (UNIX 時間)
+    :param (None|int) amount: 投稿内容から読み取った単価 (円、金額が無い場合は None)
+    :param int quantity: 投稿内容から読み取った数量
     """
 
-    def __init__(self, identity, user_id, username, text, status=RequestStatus.new, approver=None):
+    def __init__(self, identity, user_id, username, text, status=RequestStatus.new, approver=None,
+                 channel=None, ts=None, created=None, closed=None, amount=None, quantity=1):
         self.id = int(identity)
         self.user_id = user_id
         self.username = username
         self.text = text
         self.status = status
         self._approver = approver
+        self.channel = channel
+        self.ts = ts
+        self.created = created
+        self.closed = closed
+        self.amount = amount
+        self.quantity = quantity
 
     def __repr__(self):
         return "<PurchaseRequest: id: {}, user: {}>".format(self.id, self.username)
 
     def to_str(self):
         dic = {"id": self.id, "user_id": self.user_id, "username": self.username, "text": self.text}
+        if self.ts:
+            dic["channel"] = self.channel
+            dic["ts"] = self.ts
         return json.dumps(dic, ensure_ascii=False)
 
     @classmethod
@@ -43,12 +62,60 @@ class PurchaseRequest:
         :rtype: PurchaseRequest
         """
         dic = json.loads(value_str)
-        return cls(dic["id"], dic.get("user_id", ""), dic.get("username", ""), dic["text"], status, approver)
+        return cls(dic["id"], dic.get("user_id", ""), dic.get("username", ""), dic["text"], status, approver,
+                   dic.get("channel"), dic.get("ts"))
+
+    def to_hash(self):
+        """ Redis のハッシュに保存する辞書を返す
+
+        :rtype: dict[str, str]
+        """
+        dic = {"v": SCHEMA_VERSION, "u": self.user_id, "n": self.username, "t": self.text, "s": self.status.value}
+        if self._approver:
+            dic["a"] = self._approver
+        if self.ts:
+            dic["ch"] = self.channel
+            dic["ts"] = self.ts
+        if self.created is not None:
+            dic["c"] = self.created
+        if self.closed is not None:
+            dic["m"] = self.closed
+        if self.amount is not None:
+            dic["p"] = self.amount
+            dic["q"] = self.quantity
+        return dic
+
+    @classmethod
+    def from_hash(cls, identity, dic):
+        """ Redis のハッシュから PurchaseRequest を生成する
+
+        :param (int|str) identity: リクエストのID
+        :param dict[str, str] dic: to_hash メソッドで書き出した辞書
+        :rtype: PurchaseRequest
+        """
+        created = dic.get("c")
+        closed = dic.get("m")
+        amount = dic.get("p")
+        return cls(identity, dic.get("u", ""), dic.get("n", ""), dic.get("t", ""),
+                   RequestStatus(dic.get("s", RequestStatus.new.value)), dic.get("a"),
+                   dic.get("ch"), dic.get("ts"),
+                   float(created) if created else None, float(closed) if closed else None,
+                   int(amount) if amount not in (None, "") else None, int(dic.get("q") or 1))
 
     def to_message(self):
         message = "ID: {}, <@{}|{}>: {}\n".format(self.id, self.user_id, self.username, self.text)
         return message
 
+    @property
+    def total(self):
+        """ 単価 × 数量 (金額が無い場合は 0)
+
+        :rtype: int
+        """
+        if self.amount is None:
+            return 0
+        return self.amount * self.quantity
+
     @property
     def approver(self):
         if self._approver:
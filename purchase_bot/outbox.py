@@ -0,0 +1,135 @@
+"""
+Slack への送信をまとめる送信キュー
+"""
+
+import threading
+import time
+
+
+class MessageBatch:
+    """ 1 つのコマンドで送るメッセージを集める
+
+    with 文を抜けると、集めたメッセージが Outbox に渡される。
+    """
+
+    def __init__(self, outbox):
+        self._outbox = outbox
+        self.directs = {}
+        self.announcements = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._outbox.send(self)
+        return False
+
+    def direct(self, user_id, text):
+        """ user_id 宛ての DM に 1 行追加する """
+        if text:
+            self.directs.setdefault(user_id, []).append(text.rstrip("\n"))
+
+    def announce(self, text, color, attachment_text):
+        """ チャンネルへの色付き投稿を追加する """
+        self.announcements.append({"pretext": text, "color": color, "text": attachment_text})
+
+    def merge(self, other):
+        for user_id, lines in other.directs.items():
+            self.directs.setdefault(user_id, []).extend(lines)
+        self.announcements.extend(other.announcements)
+
+
+class Outbox:
+    """ 送信待ちのメッセージを集約し、間隔を空けて Slack に投稿する
+
+    DM は宛先ユーザごとに 1 通にまとめる。merge_announcements が True の場合か、
+    チャンネルへの投稿が merge_threshold 件を超える場合は、複数の attachment を持つ 1 件の投稿にまとめる
+    (範囲指定で大量に承認しても、最小間隔を空けた投稿が件数分続かないようにする)。
+    最小間隔を空けるのはチャンネルへの投稿だけで、DM は他のバッチの投稿の待ち時間に関わらずすぐに送る。
+
+    :param callable send_direct: (user_id, text) を受け取り DM を送る関数
+    :param callable post_channel: (text, attachments) を受け取りチャンネルに投稿し、API の結果を返す関数
+    :param bool merge_announcements: チャンネルへの投稿を常にまとめる場合は True
+    :param int merge_threshold: 1 回の送信での投稿がこの件数を超えたらまとめる (0 の場合は件数でまとめない)
+    :param float flush_window: 送信を待ち合わせる秒数 (0 の場合は with 文を抜けた時点で送る)
+    :param float min_interval: チャンネルへの投稿の最小間隔 (秒)
+    """
+    # 1 件の投稿に含められる attachment の上限
+    MAX_ATTACHMENTS = 100
+
+    def __init__(self, send_direct, post_channel, merge_announcements=False, flush_window=0.0,
+                 min_interval=1.0, timer=time.monotonic, sleep=time.sleep, merge_threshold=10):
+        self._send_direct = send_direct
+        self._post_channel = post_channel
+        self.merge_announcements = merge_announcements
+        self.merge_threshold = merge_threshold
+        self.flush_window = flush_window
+        self.min_interval = min_interval
+        self._timer = timer
+        self._sleep = sleep
+        self._pending = MessageBatch(self)
+        self._pending_lock = threading.Lock()
+        # DM の送信と、チャンネルへの投稿 (最小間隔の待ち時間を含む) をそれぞれ直列にする
+        self._send_lock = threading.Lock()
+        self._post_lock = threading.Lock()
+        self._flush_timer = None
+        self._last_posted = None
+
+    def batch(self):
+        """
+        :rtype: MessageBatch
+        """
+        return MessageBatch(self)
+
+    @property
+    def depth(self):
+        """ 送信待ちのメッセージ数 """
+        with self._pending_lock:
+            return len(self._pending.directs) + len(self._pending.announcements)
+
+    def send(self, batch):
+        """ batch を送信する (flush_window の間は他のバッチと合わせて待つ) """
+        with self._pending_lock:
+            self._pending.merge(batch)
+            if self.flush_window > 0:
+                if self._flush_timer is None:
+                    self._flush_timer = threading.Timer(self.flush_window, self.flush)
+                    self._flush_timer.daemon = True
+                    self._flush_timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """ 送信待ちのメッセージを全て送る """
+        with self._pending_lock:
+            batch, self._pending = self._pending, MessageBatch(self)
+            self._flush_timer = None
+        with self._send_lock:
+            for user_id, lines in batch.directs.items():
+                self._send_direct(user_id, "\n".join(lines))
+        if not batch.announcements:
+            return
+        with self._post_lock:
+            if self.merge_announcements or 0 < self.merge_threshold < len(batch.announcements):
+                attachments = batch.announcements
+                for start in range(0, len(attachments), self.MAX_ATTACHMENTS):
+                    chunk = attachments[start:start + self.MAX_ATTACHMENTS]
+                    text = "{}件の購入承認リクエストを処理しました".format(len(chunk))
+                    self._post(text, chunk)
+            else:
+                for attachment in batch.announcements:
+                    self._post(attachment["pretext"],
+                               [{"color": attachment["color"], "text": attachment["text"]}])
+
+    def _post(self, text, attachments):
+        """ 最小間隔を守ってチャンネルに投稿する
+
+        rate limit による再送は RateLimitedSlackClient が行うため、ここでは投稿の間隔だけを空ける。
+        """
+        if self._last_posted is not None:
+            wait = self._last_posted + self.min_interval - self._timer()
+            if wait > 0:
+                self._sleep(wait)
+        result = self._post_channel(text, attachments)
+        self._last_posted = self._timer()
+        return result
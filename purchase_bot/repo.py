@@ -1,158 +1,1437 @@
+import hashlib
+import json
 import os
-import redis
+import threading
+import time
+from collections import namedtuple
 
-from .model import PurchaseRequest, RequestStatus
+from .amount import parse_amount
+from .archive import Archive
+from .metrics import InstrumentedRedis, InstrumentedRedisCluster
+from .model import SCHEMA_VERSION, PurchaseRequest, RequestStatus
+from .report import UNKNOWN_MONTH
+from .search import query_terms, tokenize
+
+
+def connect_redis():
+    """ 環境変数 REDIS_HOST, REDIS_PORT, REDIS_DB の Redis に接続する
+
+    REDIS_CLUSTER=1 の場合は REDIS_HOST, REDIS_PORT のノードから Redis Cluster に接続する (REDIS_DB は使わない)。
+
+    :rtype: (InstrumentedRedis|InstrumentedRedisCluster)
+    """
+    host = os.environ.get("REDIS_HOST", "localhost")
+    port = os.environ.get("REDIS_PORT", 6379)
+    if os.environ.get("REDIS_CLUSTER", "") not in ("", "0"):
+        return InstrumentedRedisCluster(host=host, port=int(port), decode_responses=True)
+    db = os.environ.get("REDIS_DB", 0)
+    return InstrumentedRedis(host=host, port=port, db=db, decode_responses=True)
+
+
+def channel_namespace(client, channel):
+    """ 購入申請チャンネルのキーの名前空間を返す
+
+    以前の単一チャンネルのボットのキー (名前空間なし) にデータが残っている間は None を返し、
+    purchase_bot.migrate.move_to_namespace で移した後やデータが無い場合はチャンネルIDを返す。
+
+    :param redis.StrictRedis client:
+    :param str channel: 購入申請チャンネルのID
+    :rtype: (None|str)
+    """
+    if client.exists(PurchaseRepo.SCHEMA_KEY, PurchaseRepo.ID_KEY):
+        return None
+    return channel
+
+
+# 金額の合計の集計単位 (pending: 利用者ごとの未処理, user: 利用者ごとの承認済み, approver: 承認者ごと, month: 承認した月ごと)
+SPEND_PENDING = "pending"
+SPEND_USER = "user"
+SPEND_APPROVER = "approver"
+SPEND_MONTH = "month"
+
+# changed: 状態を変更したリクエストのリスト, handled: 既に対応済みだったIDのリスト, missing: 存在しないIDのリスト
+TransitionResult = namedtuple("TransitionResult", ["changed", "handled", "missing"])
+# requests: 1 ページ分のリクエストのリスト, cursor: 次のページを取得するためのカーソル (最後のページは None)
+Page = namedtuple("Page", ["requests", "cursor"])
+
+# 未処理のリクエストだけを指定の状態に移し、承認者・日時の記録とインデックスの削除を行う
+# 金額のあるリクエストは未処理の合計から引き、承認の場合は利用者・承認者・月ごとの合計に加える
+# 状態を変更したリクエストがあれば、未処理リクエストの変更番号を進めて変更を通知する
+# KEYS: 未処理のソート済み集合, 移動先のソート済み集合, メッセージインデックス, テキストインデックス,
+#       未処理リクエストの変更番号, 変更の通知先,
+#       利用者ごとの未処理の合計, 利用者ごとの承認済みの合計, 承認者ごとの合計, 月ごとの合計,
+#       (リクエストのハッシュ, 旧形式のリクエスト, 旧形式の承認者) * N
+# ARGV: 承認者, 変更後の状態, 現在日時, 現在の年月, リクエストID * N
+# 戻り値: {変更したリクエスト, 対応済みのID, 存在しないID, 変更番号 (変更が無ければ 0)}
+TRANSITION_SCRIPT = """
+local function add(key, field, amount)
+    if redis.call('HINCRBY', key, field, string.format('%d', amount)) == 0 then
+        redis.call('HDEL', key, field)
+    end
+end
+local changed, handled, missing, removed = {}, {}, {}, {}
+local n = 4
+for i = 11, #KEYS, 3 do
+    local record, item, approver = KEYS[i], KEYS[i + 1], KEYS[i + 2]
+    n = n + 1
+    local request_id = ARGV[n]
+    if redis.call('ZREM', KEYS[1], request_id) == 1 then
+        redis.call('ZADD', KEYS[2], ARGV[3], request_id)
+        table.insert(removed, tonumber(request_id))
+        local channel, ts = false, false
+        if redis.call('EXISTS', record) == 1 then
+            redis.call('HSET', record, 's', ARGV[2], 'a', ARGV[1], 'm', ARGV[3])
+            local fields = redis.call('HMGET', record, 'ch', 'ts', 'u', 'p', 'q')
+            channel, ts = fields[1], fields[2]
+            if fields[4] then
+                local total = tonumber(fields[4]) * tonumber(fields[5] or 1)
+                local user_id = fields[3] or ''
+                add(KEYS[7], user_id, -total)
+                if ARGV[2] == 'approved' then
+                    add(KEYS[8], user_id, total)
+                    add(KEYS[9], ARGV[1], total)
+                    add(KEYS[10], ARGV[4], total)
+                end
+            end
+            table.insert(changed, {request_id, 'hash', redis.call('HGETALL', record)})
+        else
+            local value = redis.call('GET', item)
+            redis.call('SET', approver, ARGV[1])
+            if value then
+                local request = cjson.decode(value)
+                channel, ts = request.channel, request.ts
+                table.insert(changed, {request_id, 'legacy', value})
+            end
+        end
+        if ts then
+            redis.call('HDEL', KEYS[3], channel .. ':' .. ts)
+        else
+            local field = redis.call('HGET', KEYS[4], '#' .. request_id)
+            if field then
+                redis.call('HDEL', KEYS[4], field, '#' .. request_id)
+            end
+        end
+    elseif redis.call('EXISTS', record) == 1 or redis.call('EXISTS', item) == 1 then
+        table.insert(handled, request_id)
+    else
+        table.insert(missing, request_id)
+    end
+end
+local version = 0
+if #removed > 0 then
+    version = redis.call('INCR', KEYS[5])
+    redis.call('PUBLISH', KEYS[6], version .. ' ' .. cjson.encode({op = 'del', ids = removed}))
+end
+return {changed, handled, missing, version}
+"""
+
+# リクエストの登録・更新・削除と、一覧・インデックス・未処理の合計・全文検索の索引・ジョブの予定への反映を行い、
+# 変更を通知する (リクエストの追加・更新は、その間に承認・却下されていた場合は未処理の合計に反映せず通知もしない)
+# KEYS: リクエストのハッシュ, 旧形式のリクエスト, 未処理のソート済み集合, 利用者ごとの一覧,
+#       外すインデックス, 加えるインデックス, 利用者ごとの未処理の合計, ジョブの予定,
+#       未処理リクエストの変更番号, 変更の通知先, (加える索引の語 * N, 外す索引の語 * M)
+# ARGV: 書き込む内容の JSON, 変更内容の JSON (通知しない場合は空文字列)
+# 書き込む内容: id, user (利用者のユーザID), member (索引の要素), add (N),
+#              hash (ハッシュに設定するフィールドと値), unset (ハッシュから消すフィールド),
+#              legacy (旧形式のリクエストが残っている場合だけ書き換える値), create (一覧に加える場合は true),
+#              delete (削除する場合は true), spend (未処理の合計の増減), unindex (外すインデックスのフィールド),
+#              index (加えるインデックスのフィールドと値), jobs (ジョブの予定時刻と名前)
+# 戻り値: {書き込んだら 1 (旧形式のリクエストが変換済みだった場合は 0), 変更番号 (通知しなかった場合は 0)}
+REQUEST_SCRIPT = """
+local request = cjson.decode(ARGV[1])
+local request_id = request.id
+local pending
+if request.delete then
+    pending = redis.call('ZREM', KEYS[3], request_id) == 1
+    redis.call('DEL', KEYS[1], KEYS[2])
+    if request.user ~= '' then
+        redis.call('ZREM', KEYS[4], request_id)
+    end
+else
+    if request.legacy then
+        if not redis.call('SET', KEYS[2], request.legacy, 'XX') then
+            return {0, 0}
+        end
+    else
+        if #request.unset > 0 then
+            redis.call('HDEL', KEYS[1], unpack(request.unset))
+        end
+        redis.call('HSET', KEYS[1], unpack(request.hash))
+    end
+    if request.create then
+        redis.call('ZADD', KEYS[3], request_id, request_id)
+        if request.user ~= '' then
+            redis.call('ZADD', KEYS[4], request_id, request_id)
+        end
+    end
+    pending = redis.call('ZSCORE', KEYS[3], request_id) ~= false
+end
+if pending and request.spend ~= '0' then
+    if redis.call('HINCRBY', KEYS[7], request.user, request.spend) == 0 then
+        redis.call('HDEL', KEYS[7], request.user)
+    end
+end
+if #request.unindex > 0 then
+    redis.call('HDEL', KEYS[5], unpack(request.unindex))
+end
+if #request.index > 0 then
+    redis.call('HSET', KEYS[6], unpack(request.index))
+end
+for i = 11, #KEYS do
+    if i <= 10 + request.add then
+        redis.call('ZADD', KEYS[i], 1, request.member)
+    else
+        redis.call('ZREM', KEYS[i], request.member)
+    end
+end
+if #request.jobs > 0 then
+    redis.call('ZADD', KEYS[8], 'NX', unpack(request.jobs))
+end
+local version = 0
+if ARGV[2] ~= '' and (pending or request.delete) then
+    version = redis.call('INCR', KEYS[9])
+    redis.call('PUBLISH', KEYS[10], version .. ' ' .. ARGV[2])
+end
+return {1, version}
+"""
+
+# 検索語ごとに全ての語を含むリクエストを求め、当てはまった検索語の数をスコアにして検索結果に保存し、1 ページ分を返す
+# KEYS: 検索結果, (検索語ごとの一時的な集合, 検索語の語 * N) * 検索語の数
+# ARGV: 検索結果を残す秒数, 返す範囲の始まり, 返す範囲の終わり, 検索語ごとの語の数 (N) * 検索語の数
+SEARCH_SCRIPT = """
+local term_keys = {}
+local k = 2
+for i = 4, #ARGV do
+    local count = tonumber(ARGV[i])
+    local args = {KEYS[k], count}
+    for j = k + 1, k + count do
+        table.insert(args, KEYS[j])
+    end
+    table.insert(args, 'AGGREGATE')
+    table.insert(args, 'MIN')
+    redis.call('ZINTERSTORE', unpack(args))
+    table.insert(term_keys, KEYS[k])
+    k = k + count + 1
+end
+redis.call('ZUNIONSTORE', KEYS[1], #term_keys, unpack(term_keys))
+redis.call('DEL', unpack(term_keys))
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return redis.call('ZREVRANGE', KEYS[1], ARGV[2], ARGV[3])
+"""
+
+# 集計済みでなければ金額の合計を置き換えて集計済みにする
+# KEYS: 集計済みかどうか, 合計 * N, ARGV: 合計ごとのフィールドと金額の JSON * N
+# 戻り値: 置き換えた場合は 1 (他のボットが先に集計していた場合は 0)
+SPEND_RESET_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    return 0
+end
+for i = 2, #KEYS do
+    redis.call('DEL', KEYS[i])
+    local fields = cjson.decode(ARGV[i - 1])
+    for j = 1, #fields, 1000 do
+        redis.call('HSET', KEYS[i], unpack(fields, j, math.min(j + 999, #fields)))
+    end
+end
+redis.call('SET', KEYS[1], 1)
+return 1
+"""
+
+# 承認者一覧を変更し、変更番号を進める
+# KEYS: 承認者一覧, 承認者一覧の変更番号, ARGV: SADD か SREM, ユーザID
+ADMIN_SCRIPT = """
+redis.call(ARGV[1], KEYS[1], ARGV[2])
+return redis.call('INCR', KEYS[2])
+"""
+
+# 旧形式の状態ごとの集合からソート済み集合にリクエストを移す
+# KEYS: 旧形式の集合, ソート済み集合, (リクエストのハッシュ, 旧形式のリクエスト) * N
+# ARGV: 承認・却下済みの集合なら 1, リクエストID * N
+# 戻り値: 移したリクエストの {ID, ユーザID} のリスト
+STATUS_INDEX_SCRIPT = """
+local moved = {}
+local n = 1
+for i = 3, #KEYS, 2 do
+    local record, item = KEYS[i], KEYS[i + 1]
+    n = n + 1
+    local request_id = ARGV[n]
+    if redis.call('SREM', KEYS[1], item) == 1 then
+        local score, user_id = request_id, false
+        if ARGV[1] == '1' then
+            score = 0
+        end
+        if redis.call('EXISTS', record) == 1 then
+            local fields = redis.call('HMGET', record, 'u', 'm')
+            user_id = fields[1]
+            if ARGV[1] == '1' and fields[2] then
+                score = fields[2]
+            end
+        else
+            local value = redis.call('GET', item)
+            if value then
+                user_id = cjson.decode(value).user_id
+            end
+        end
+        redis.call('ZADD', KEYS[2], score, request_id)
+        if type(user_id) ~= 'string' then
+            user_id = ''
+        end
+        table.insert(moved, {request_id, user_id})
+    end
+end
+return moved
+"""
+
+# 投稿に対応するリクエストIDを払い出す (払い出し済みならそのIDを返す)
+# KEYS: 投稿ごとのリクエストID, IDの採番, ARGV: 有効期限 (秒)
+# 戻り値: {リクエストID, 新しく払い出したら 1}
+RESERVE_ID_SCRIPT = """
+local request_id = redis.call('GET', KEYS[1])
+if request_id then
+    return {request_id, 0}
+end
+request_id = redis.call('INCR', KEYS[2])
+redis.call('SET', KEYS[1], request_id, 'EX', ARGV[1])
+return {request_id, 1}
+"""
+
+# イベントをジャーナルに追加し、未完了の一覧に登録する
+# KEYS: ジャーナル, 未完了の一覧, ARGV: イベントの JSON, 現在日時, ジャーナルの長さの上限
+JOURNAL_APPEND_SCRIPT = """
+local entry_id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[3], '*', 'event', ARGV[1])
+redis.call('ZADD', KEYS[2], ARGV[2], entry_id)
+return entry_id
+"""
+
+# イベントを完了済みにし、処理済みの投稿の ts を進める
+# KEYS: 未完了の一覧, 処理済みの投稿の ts, ARGV: ジャーナルのエントリID, 投稿の ts (無ければ空文字列)
+JOURNAL_DONE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+if ARGV[2] ~= '' then
+    local current = redis.call('GET', KEYS[2])
+    if not current or tonumber(current) < tonumber(ARGV[2]) then
+        redis.call('SET', KEYS[2], ARGV[2])
+    end
+end
+return 1
+"""
+
+# 予定時刻を過ぎたジョブを最大 ARGV[2] 件取り出す
+# KEYS: ジョブの予定, ARGV: 現在日時, 取り出す件数
+# 戻り値: {ジョブ名, 予定時刻, ...}
+CLAIM_JOBS_SCRIPT = """
+local jobs = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'WITHSCORES', 'LIMIT', 0, ARGV[2])
+for i = 1, #jobs, 2 do
+    redis.call('ZREM', KEYS[1], jobs[i])
+end
+return jobs
+"""
+
+# 保持者が自分ならリースを延長し、誰も保持していなければ取得する
+# KEYS: リース, ARGV: ワーカーID, 有効期限 (ミリ秒)
+LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'PX', ARGV[2]) then
+    return 1
+end
+return 0
+"""
+
+
+def _flatten(mapping):
+    """ 辞書をフィールドと値 (文字列) を交互に並べたリストにする (Lua スクリプトの HSET に渡す) """
+    return [str(value) for item in mapping.items() for value in item]
 
 
 class PurchaseRepo:
+    """ 購入承認リクエストの Redis への保存
+
+    リクエストは 1 件につき 1 つのハッシュ (RECORD_KEY) に状態・承認者・日時と合わせて保存する。
+    状態ごと・利用者ごとの一覧はリクエストIDを要素とするソート済み集合で、
+    未処理と利用者ごとの一覧は ID、承認・却下済みの一覧は承認・却下の日時をスコアにする。
+    旧形式 (ITEM_KEY の JSON 文字列と ITEM_ADMIN_KEY) のリクエストも読み込めるが、
+    purchase_bot.migrate で移行した後は参照しない。
+    承認・却下から時間が経ったリクエストは purchase_bot.archive で Redis から保管用の
+    SQLite に移され、get では保管先も探す。
+    namespace を指定すると、全てのキーを "purchase:{namespace}:" で始まる別のキーにする
+    (購入申請チャンネルごとに承認者・ID の採番・一覧を分ける)。{namespace} は Redis Cluster のハッシュタグで、
+    名前空間のキーは全て同じスロットに入る。複数のキーを読み書きする処理は 1 回の Lua スクリプト呼び出しか
+    トランザクションでないパイプラインで行うため、名前空間ごとに別のシャードに分散した Redis Cluster でも動く。
+    投稿内容とユーザ名の全文検索用に、語 (文字の N-gram) ごとにその語を含むリクエストの
+    ソート済み集合 (SEARCH_KEY) を持つ。検索用の索引は保管済みのリクエストの分も残す。
+    投稿内容から読み取った金額の合計を集計単位ごとのハッシュ (SPEND_KEY) に持ち、
+    登録・変更・削除・承認・却下と同時に更新する。合計は保管後も減らさない。
+    """
     ADMIN_KEY = "purchase:admin"
+    # 承認者一覧の変更ごとに増える番号
+    ADMIN_VERSION_KEY = "purchase:admin:version"
     ID_KEY = "purchase:request:id"
     ITEM_KEY = "purchase:request:{}"
     ITEM_ADMIN_KEY = "purchase:request:{}:approver"
-    NEW_KEY = "purchase:request:new"
-    APPROVED_KEY = "purchase:request:approved"
-    DENIED_KEY = "purchase:request:denied"
-
-    def __init__(self):
-        host = os.environ.get("REDIS_HOST", "localhost")
-        port = os.environ.get("REDIS_PORT", 6379)
-        db = os.environ.get("REDIS_DB", 0)
-        self._redis = redis.StrictRedis(host=host, port=port, db=db, decode_responses=True)
+    RECORD_KEY = "purchase:record:{}"
+    # 保存形式のバージョン (移行完了後に SCHEMA_VERSION になる)
+    SCHEMA_KEY = "purchase:schema"
+    NEW_KEY = "purchase:status:new"
+    APPROVED_KEY = "purchase:status:approved"
+    DENIED_KEY = "purchase:status:denied"
+    USER_REQUESTS_KEY = "purchase:user:{}:requests"
+    # 以前のバージョンの状態ごとの集合 (ITEM_KEY の形式でリクエストを登録していた)
+    LEGACY_NEW_KEY = "purchase:request:new"
+    LEGACY_APPROVED_KEY = "purchase:request:approved"
+    LEGACY_DENIED_KEY = "purchase:request:denied"
+    # 未処理リクエストの逆引きインデックス (channel:ts → ID, 旧データは username:テキストのハッシュ → ID)
+    MESSAGE_INDEX_KEY = "purchase:index:message"
+    TEXT_INDEX_KEY = "purchase:index:text"
+    INDEX_READY_KEY = "purchase:index:ready"
+    USERNAME_KEY = "purchase:user:{}:name"
+    IM_CHANNEL_KEY = "purchase:im"
+    # 承認者ごとの通知済みリクエスト (ID → 内容の fingerprint)
+    NOTIFIED_KEY = "purchase:notified:{}"
+    # 複数ワーカーで処理する場合のイベントの処理担当とリーダーのリース
+    EVENT_CLAIM_KEY = "purchase:event:{}"
+    LEASE_KEY = "purchase:lease:{}"
+    # 投稿 (channel:ts) ごとに払い出したリクエストID
+    MESSAGE_REQUEST_KEY = "purchase:message:{}"
+    # 受け取ったイベントのジャーナル (Stream) と未完了のエントリ、処理済みの購入申請チャンネルの投稿の ts
+    JOURNAL_KEY = "purchase:journal"
+    JOURNAL_PENDING_KEY = "purchase:journal:pending"
+    JOURNAL_CURSOR_KEY = "purchase:journal:cursor"
+    JOURNAL_MAXLEN = 10000
+    # 全文検索の索引 (語 → リクエストID) と検索結果の一時保存先
+    SEARCH_KEY = "purchase:search:gram:{}"
+    SEARCH_RESULT_KEY = "purchase:search:result:{}"
+    SEARCH_READY_KEY = "purchase:search:ready"
+    # 検索結果を次のページのために残す秒数
+    SEARCH_RESULT_TTL = 60
+    # 未処理リクエストの変更番号と、変更を通知する Pub/Sub のチャンネル
+    # (通知は "変更番号 変更内容の JSON" の形式で、変更内容は {"op": "put", "id": ID, "r": ハッシュ} か
+    # {"op": "del", "ids": [ID, ...]})
+    PENDING_VERSION_KEY = "purchase:pending:version"
+    PENDING_CHANNEL_KEY = "purchase:pending:changes"
+    # 集計単位ごとの金額の合計 (利用者のユーザID・承認者のユーザ名・"YYYY-MM" → 円) と、導入前のリクエストを集計済みかどうか
+    SPEND_KEY = "purchase:spend:{}"
+    SPEND_READY_KEY = "purchase:spend:ready"
+    # ジョブ名 → 予定時刻 (UNIX 時間) と、導入前の未処理リクエストの予定を登録済みかどうか
+    SCHEDULE_KEY = "purchase:schedule"
+    SCHEDULE_READY_KEY = "purchase:schedule:ready"
+    # 投稿ごとのリクエストIDを残す秒数
+    MESSAGE_REQUEST_TTL = 90 * 86400
+    DEFAULT_CHUNK_SIZE = 500
+    DEFAULT_ADMIN_CACHE_INTERVAL = 5
+
+    def __init__(self, client=None, chunk_size=None, admin_cache_interval=None, timer=time.monotonic, archive=None,
+                 namespace=None):
+        """
+        :param (None|redis.StrictRedis) client: 利用する Redis クライアント (省略時は環境変数から接続)
+        :param (None|int) chunk_size: 一括読み込み時に 1 ラウンドトリップで取得するリクエスト数
+        :param (None|float) admin_cache_interval: 承認者一覧の変更を確認する間隔 (秒)
+        :param callable timer: 現在時刻を返す関数
+        :param (None|Archive) archive: 保管済みリクエストの保存先 (省略時は環境変数 ARCHIVE_PATH があれば開く)
+        :param (None|str) namespace: 購入申請チャンネルごとにデータを分ける場合の名前 (省略時は従来のキーを使う)
+        """
+        if client is None:
+            client = connect_redis()
+        self._redis = client
+        self.namespace = namespace
+        if namespace:
+            # 全てのキーに同じハッシュタグを付け、Redis Cluster でも 1 つの名前空間のキーが同じスロットに入るようにする
+            prefix = "purchase:{{{}}}".format(namespace)
+            for name in dir(type(self)):
+                if name.endswith("_KEY"):
+                    key = getattr(type(self), name)
+                    # format で ID などを埋め込むキーでは波括弧をエスケープする
+                    tag = prefix.replace("{", "{{").replace("}", "}}") if "{}" in key else prefix
+                    setattr(self, name, key.replace("purchase", tag, 1))
+        if chunk_size is None:
+            chunk_size = os.environ.get("REDIS_CHUNK_SIZE", self.DEFAULT_CHUNK_SIZE)
+        self.chunk_size = max(1, int(chunk_size))
+        # 一覧取得で発生した Redis へのラウンドトリップ数
+        self.round_trips = 0
+        if admin_cache_interval is None:
+            admin_cache_interval = os.environ.get("ADMIN_CACHE_INTERVAL", self.DEFAULT_ADMIN_CACHE_INTERVAL)
+        self.admin_cache_interval = float(admin_cache_interval)
+        self._timer = timer
+        if archive is None and os.environ.get("ARCHIVE_PATH"):
+            archive = Archive(os.environ["ARCHIVE_PATH"], namespace=namespace)
+        self.archive = archive
+        self._admin_lock = threading.Lock()
+        self._admin = None
+        self._admin_version = None
+        self._admin_checked = None
         # Redis の起動確認
-        self._redis.info()
+        self._redis.ping()
+        self._transition_script = self._redis.register_script(TRANSITION_SCRIPT)
+        # 初回の呼び出しで NOSCRIPT が返らないよう事前に登録しておく
+        self._redis.script_load(TRANSITION_SCRIPT)
+        self._lease_script = self._redis.register_script(LEASE_SCRIPT)
+        self._status_index_script = self._redis.register_script(STATUS_INDEX_SCRIPT)
+        self._reserve_id_script = self._redis.register_script(RESERVE_ID_SCRIPT)
+        self._journal_append_script = self._redis.register_script(JOURNAL_APPEND_SCRIPT)
+        self._journal_done_script = self._redis.register_script(JOURNAL_DONE_SCRIPT)
+        self._claim_jobs_script = self._redis.register_script(CLAIM_JOBS_SCRIPT)
+        self._request_script = self._redis.register_script(REQUEST_SCRIPT)
+        self._search_script = self._redis.register_script(SEARCH_SCRIPT)
+        self._spend_reset_script = self._redis.register_script(SPEND_RESET_SCRIPT)
+        self._admin_script = self._redis.register_script(ADMIN_SCRIPT)
+        # 未処理リクエストのプロセス内の複製 (purchase_bot.view.PendingView.start で設定される)
+        self.view = None
+        self.refresh_schema()
+
+    def refresh_schema(self):
+        """ 旧形式のリクエストが残っているかを確認する """
+        schema = self._redis.get(self.SCHEMA_KEY)
+        # リクエストが 1 件も無ければ旧形式のデータも無い
+        if not schema and not self._redis.exists(self.ID_KEY):
+            self._redis.set(self.SCHEMA_KEY, SCHEMA_VERSION, nx=True)
+            schema = SCHEMA_VERSION
+        self.legacy_reads = not schema or int(schema) < SCHEMA_VERSION
 
     def get_id(self):
         return self._redis.incr(self.ID_KEY)
 
+    def reserve_id(self, channel, ts):
+        """ 投稿に対応するリクエストIDを払い出す
+
+        同じ投稿に対しては MESSAGE_REQUEST_TTL 秒の間は同じIDを返すため、
+        イベントを再処理してもリクエストが重複しない。
+
+        :param str channel: 投稿されたチャンネルのID
+        :param str ts: 投稿されたメッセージの ts
+        :rtype: int, bool
+        :return: リクエストID と 新しく払い出した場合は True
+        """
+        key = self.MESSAGE_REQUEST_KEY.format(self._message_field(channel, ts))
+        request_id, reserved = self._reserve_id_script(keys=[key, self.ID_KEY], args=[self.MESSAGE_REQUEST_TTL])
+        return int(request_id), bool(reserved)
+
     @staticmethod
     def get_id_from_key(key):
         return key.split(":")[-1]
 
-    def create_or_update(self, request, new=True):
+    def _status_key(self, status):
+        return {RequestStatus.new: self.NEW_KEY, RequestStatus.approved: self.APPROVED_KEY,
+                RequestStatus.denied: self.DENIED_KEY}[status]
+
+    @staticmethod
+    def _message_field(channel, ts):
+        return "{}:{}".format(channel, ts)
+
+    @staticmethod
+    def _text_field(username, text):
+        digest = hashlib.sha1((text or "").encode("utf-8")).hexdigest()
+        return "{}:{}".format(username, digest)
+
+    def _index_fields(self, request):
+        """ リクエストを引くためのインデックスのキーとフィールドを返す
+
+        メッセージの ts を持つリクエストは channel:ts で、
+        ts を持たない旧データは username とテキストのハッシュで引けるようにする。
+        旧データは削除時のために「#ID → フィールド名」の逆引きも登録する。
+
+        :param PurchaseRequest request:
+        :rtype: (str, dict[str, (int|str)])
+        """
+        if request.ts:
+            return self.MESSAGE_INDEX_KEY, {self._message_field(request.channel, request.ts): request.id}
+        field = self._text_field(request.username, request.text)
+        return self.TEXT_INDEX_KEY, {field: request.id, "#{}".format(request.id): field}
+
+    def _add_index(self, pipe, request):
+        """ リクエストをインデックスに登録するコマンドを pipe に追加する
+
+        :param redis.client.Pipeline pipe:
+        :param PurchaseRequest request:
+        """
+        key, fields = self._index_fields(request)
+        pipe.hset(key, mapping=fields)
+
+    @staticmethod
+    def _search_member(request_id):
+        # 同じ順位のリクエストが ID の新しい順に並ぶよう、辞書順と数値順が一致する形にする
+        return "{:012d}".format(int(request_id))
+
+    def _add_search_index(self, pipe, request, tokens=None):
+        """ リクエストを全文検索の索引に登録するコマンドを pipe に追加する
+
+        :param redis.client.Pipeline pipe:
+        :param PurchaseRequest request:
+        :param (None|set[str]) tokens: 登録する語 (省略時はリクエストの内容から求める)
+        """
+        member = self._search_member(request.id)
+        if tokens is None:
+            tokens = tokenize(request.username, request.text)
+        for token in tokens:
+            pipe.zadd(self.SEARCH_KEY.format(token), {member: 1})
+
+    def _write(self, request, fields=None, unset=(), legacy=False, create=False, delete=False, spend=0,
+               unindex=None, index=None, added=(), removed=(), jobs=None, change=None):
+        """ リクエストの書き込みと一覧・インデックス・索引などへの反映を REQUEST_SCRIPT 1 回で行う
+
+        :param PurchaseRequest request:
+        :param (None|dict) fields: ハッシュに設定するフィールド
+        :param list[str] unset: ハッシュから消すフィールド
+        :param bool legacy: 旧形式のリクエストを書き換える場合は True
+        :param bool create: 未処理と利用者ごとの一覧に加える場合は True
+        :param bool delete: 削除する場合は True
+        :param int spend: 未処理の場合に利用者ごとの未処理の合計に加える金額
+        :param (None|(str, dict)) unindex: 外すインデックスのキーとフィールド (_index_fields の戻り値)
+        :param (None|(str, dict)) index: 加えるインデックスのキーとフィールド
+        :param set[str] added: 全文検索の索引に加える語
+        :param set[str] removed: 全文検索の索引から外す語
+        :param (None|dict[str, float]) jobs: 同時に登録するジョブの予定 (既に予定があるジョブはそのまま)
+        :param (None|dict) change: 通知する未処理リクエストの変更内容
+        :rtype: bool
+        :return: 書き込んだ場合は True (旧形式のリクエストが変換済みだった場合は False)
+        """
+        unindex_key, unindex_fields = unindex or (self.TEXT_INDEX_KEY, {})
+        index_key, index_fields = index or (self.TEXT_INDEX_KEY, {})
+        added, removed = sorted(added), sorted(removed)
+        keys = [self.RECORD_KEY.format(request.id), self.ITEM_KEY.format(request.id), self.NEW_KEY,
+                self.USER_REQUESTS_KEY.format(request.user_id or ""), unindex_key, index_key,
+                self.SPEND_KEY.format(SPEND_PENDING), self.SCHEDULE_KEY,
+                self.PENDING_VERSION_KEY, self.PENDING_CHANNEL_KEY]
+        keys += [self.SEARCH_KEY.format(token) for token in added + removed]
+        payload = {"id": str(request.id), "user": request.user_id or "", "member": self._search_member(request.id),
+                   "add": len(added), "hash": _flatten(fields or {}), "unset": list(unset),
+                   "create": create, "delete": delete, "spend": str(spend),
+                   "unindex": list(unindex_fields), "index": _flatten(index_fields),
+                   "jobs": [str(value) for name, when in (jobs or {}).items() for value in (when, name)]}
+        if legacy:
+            payload["legacy"] = request.to_str()
+        written, version = self._request_script(
+            keys=keys, args=[json.dumps(payload, ensure_ascii=False),
+                             json.dumps(change, ensure_ascii=False) if change is not None else ""])
+        if written and change is not None:
+            self._apply_change(version, change)
+        return bool(written)
+
+    def _apply_change(self, version, change):
+        """ 自分の変更をプロセス内の複製にすぐに反映する (通知が届く前に読んでも変更後の内容を返すため) """
+        if version and self.view is not None:
+            self.view.apply(int(version), change)
+
+    def pending_version(self):
+        """ 未処理リクエストの変更番号を返す
+
+        :rtype: int
+        """
+        return int(self._redis.get(self.PENDING_VERSION_KEY) or 0)
+
+    def create_or_update(self, request, new=True, jobs=None):
         """ リクエストを登録
 
         :param PurchaseRequest request:
         :param bool new: 新規リクエストの場合は True
+        :param (None|dict[str, float]) jobs: 同時に登録するジョブの予定 (既に予定があるジョブはそのまま)
         """
-        key = self.ITEM_KEY.format(request.id)
-        value = request.to_str()
-        self._redis.set(key, value)
-        if new:
-            self._redis.sadd(self.NEW_KEY, key)
-
-    def get_list(self, keys, status):
-        """ 特定の key の list に対応するリクエスト一覧を返す
-        
-        :param list[str] keys: 取得したいリクエストの Redis 登録キーのリスト
-        :param RequestStatus status: リクエストの承認状況
+        if new and request.created is None:
+            request.created = time.time()
+        pending = request.status == RequestStatus.new
+        change = {"op": "put", "id": request.id, "r": request.to_hash()} if pending else None
+        self._write(request, fields=request.to_hash(), create=new, spend=request.total if new and pending else 0,
+                    index=self._index_fields(request) if new else None,
+                    added=tokenize(request.username, request.text), jobs=jobs, change=change)
+
+    def backfill_status_index(self):
+        """ 以前のバージョンの状態ごとの集合に残っているリクエストをソート済み集合に移す
+
+        承認・却下の日時が記録されていないリクエストはスコアを 0 にする。
+        移すものが無い場合は EXISTS 1 回で終わる。
+
+        :rtype: int
+        :return: 移したリクエスト数
+        """
+        legacy_keys = ((self.LEGACY_NEW_KEY, self.NEW_KEY, False),
+                       (self.LEGACY_APPROVED_KEY, self.APPROVED_KEY, True),
+                       (self.LEGACY_DENIED_KEY, self.DENIED_KEY, True))
+        if not self._redis.exists(*[legacy_key for legacy_key, _, _ in legacy_keys]):
+            return 0
+        total = 0
+        for legacy_key, key, closed in legacy_keys:
+            while True:
+                members = self._redis.srandmember(legacy_key, self.chunk_size)
+                if not members:
+                    break
+                request_ids = [self.get_id_from_key(member) for member in members]
+                script_keys = [legacy_key, key]
+                for request_id in request_ids:
+                    script_keys.append(self.RECORD_KEY.format(request_id))
+                    script_keys.append(self.ITEM_KEY.format(request_id))
+                moved = self._status_index_script(keys=script_keys, args=[int(closed)] + request_ids)
+                pipe = self._redis.pipeline(transaction=False)
+                for request_id, user_id in moved:
+                    if user_id:
+                        pipe.zadd(self.USER_REQUESTS_KEY.format(user_id), {request_id: request_id})
+                pipe.execute()
+                total += len(moved)
+        if total:
+            # 通知はしないが、変更番号を進めて各プロセスの複製を読み込み直させる
+            self._redis.incr(self.PENDING_VERSION_KEY)
+        return total
+
+    def backfill_index(self):
+        """ インデックス導入前の未処理リクエストに対してインデックスを作成する
+
+        作成済みの場合は何もしない。
+
+        :rtype: int
+        :return: インデックスを作成したリクエスト数
+        """
+        if self._redis.exists(self.INDEX_READY_KEY):
+            return 0
+        requests = self.get_new()
+        pipe = self._redis.pipeline(transaction=False)
+        for request in requests:
+            self._add_index(pipe, request)
+        pipe.set(self.INDEX_READY_KEY, 1)
+        pipe.execute()
+        return len(requests)
+
+    def backfill_search_index(self):
+        """ 全文検索の導入前のリクエストを索引に登録する
+
+        作成済みの場合は何もしない。状態ごとの一覧を chunk_size 件ずつ読みながら登録するため、
+        件数が多くてもメモリ使用量は一定になる。
+
+        :rtype: int
+        :return: 索引に登録したリクエスト数
+        """
+        if self._redis.exists(self.SEARCH_READY_KEY):
+            return 0
+        total = 0
+        for status in RequestStatus:
+            page = self._page(self._status_key(status), status, "-inf", "+inf", self.chunk_size, None)
+            while True:
+                pipe = self._redis.pipeline(transaction=False)
+                for request in page.requests:
+                    self._add_search_index(pipe, request)
+                pipe.execute()
+                total += len(page.requests)
+                if page.cursor is None:
+                    break
+                page = self._page(self._status_key(status), status, "-inf", "+inf", self.chunk_size, page.cursor)
+        self._redis.set(self.SEARCH_READY_KEY, 1)
+        return total
+
+    @staticmethod
+    def _spend_month(timestamp):
+        """ 月ごとの合計のフィールド名 ("YYYY-MM"、ローカル時刻) を返す """
+        if timestamp is None:
+            return UNKNOWN_MONTH
+        return time.strftime("%Y-%m", time.localtime(timestamp))
+
+    def backfill_spend(self):
+        """ 金額の集計の導入前のリクエストの金額を読み取り、合計を求める
+
+        集計済みの場合は何もしない。旧形式のリクエストには単価と数量を記録できず、状態の変更や削除で
+        合計から引けないため、旧形式のリクエストが残っている間 (移行前) も何もしない。
+        状態ごとの一覧を chunk_size 件ずつ読みながら各リクエストに単価と数量を記録し、
+        保管済みのリクエストも含めた合計を最後に 1 回のスクリプト呼び出しで書き込む
+        (集計前の登録・承認で加わっていた分は数え直した合計で置き換える)。
+        他のボットが同時に集計した場合は先に終わった方の結果だけを使う。
+
+        :rtype: int
+        :return: 金額を読み取ったリクエスト数
+        """
+        if self.legacy_reads or self._redis.exists(self.SPEND_READY_KEY):
+            return 0
+        totals = {unit: {} for unit in (SPEND_PENDING, SPEND_USER, SPEND_APPROVER, SPEND_MONTH)}
+
+        def add(unit, field, amount):
+            totals[unit][field] = totals[unit].get(field, 0) + amount
+
+        def count(request):
+            if request.status == RequestStatus.new:
+                add(SPEND_PENDING, request.user_id, request.total)
+            elif request.status == RequestStatus.approved:
+                add(SPEND_USER, request.user_id, request.total)
+                add(SPEND_APPROVER, request.approver, request.total)
+                add(SPEND_MONTH, self._spend_month(request.closed), request.total)
+
+        parsed = 0
+        for status in RequestStatus:
+            page = self._page(self._status_key(status), status, "-inf", "+inf", self.chunk_size, None)
+            while True:
+                pipe = self._redis.pipeline(transaction=False)
+                for request in page.requests:
+                    if request.amount is None:
+                        request.amount, request.quantity = parse_amount(request.text)
+                        if request.amount is None:
+                            continue
+                        parsed += 1
+                        pipe.hset(self.RECORD_KEY.format(request.id),
+                                  mapping={"p": request.amount, "q": request.quantity})
+                    count(request)
+                pipe.execute()
+                if page.cursor is None:
+                    break
+                page = self._page(self._status_key(status), status, "-inf", "+inf", self.chunk_size, page.cursor)
+        if self.archive is not None:
+            for request in self.archive.iter(chunk_size=self.chunk_size):
+                if request.amount is None:
+                    request.amount, request.quantity = parse_amount(request.text)
+                count(request)
+        keys = [self.SPEND_READY_KEY] + [self.SPEND_KEY.format(unit) for unit in totals]
+        args = [json.dumps(_flatten({field: amount for field, amount in fields.items() if amount}),
+                           ensure_ascii=False) for fields in totals.values()]
+        if not self._spend_reset_script(keys=keys, args=args):
+            return 0
+        return parsed
+
+    @staticmethod
+    def _decode_record(request_id, fields):
+        """ HGETALL の結果からリクエストを生成する (存在しない場合は None) """
+        if not fields:
+            return None
+        if isinstance(fields, list):
+            fields = dict(zip(fields[::2], fields[1::2]))
+        return PurchaseRequest.from_hash(request_id, fields)
+
+    def _fetch(self, request_ids, status):
+        """ リクエストを chunk_size 件ずつまとめて取得する
+
+        1 チャンクにつきハッシュの HGETALL を 1 つのパイプラインで送るため、
+        ラウンドトリップ数は ceil(len(request_ids) / chunk_size) になる。
+        旧形式のリクエストが含まれるチャンクは、本体と承認者の MGET がもう 1 回加わる。
+
+        :param list[str] request_ids: 取得したいリクエストIDのリスト
+        :param (None|RequestStatus) status: リクエストの承認状況 (旧形式のリクエストに使う。不明な場合は None)
         :rtype: list[PurchaseRequest]
+        :return: request_ids の順に並べたリクエスト (取得までの間に削除されたものは除く)
         """
         requests = []
-        for key in keys:
-            value = self._redis.get(key)
-            approver = self.get_approver(self.get_id_from_key(key))
-            request = PurchaseRequest.from_str(value, status, approver)
-            requests.append(request)
-        return sorted(requests, key=lambda x: x.id)
+        for start in range(0, len(request_ids), self.chunk_size):
+            chunk = request_ids[start:start + self.chunk_size]
+            pipe = self._redis.pipeline(transaction=False)
+            for request_id in chunk:
+                pipe.hgetall(self.RECORD_KEY.format(request_id))
+            records = pipe.execute()
+            self.round_trips += 1
+            decoded = [self._decode_record(request_id, fields) for request_id, fields in zip(chunk, records)]
+            legacy_ids = [request_id for request_id, request in zip(chunk, decoded) if request is None]
+            if legacy_ids and self.legacy_reads:
+                legacy = iter(self._fetch_legacy(legacy_ids, status))
+                decoded = [request if request is not None else next(legacy) for request in decoded]
+            requests.extend(request for request in decoded if request is not None)
+        return requests
+
+    def _fetch_legacy(self, request_ids, status):
+        """ 旧形式のリクエスト本体と承認者をまとめて取得する
+
+        :rtype: list[(PurchaseRequest|None)]
+        :return: request_ids と同じ順のリクエスト (存在しない場合は None)
+        """
+        pipe = self._redis.pipeline(transaction=False)
+        # Redis Cluster のパイプラインでは MGET を使えないため、キーごとに GET する
+        for request_id in request_ids:
+            pipe.get(self.ITEM_KEY.format(request_id))
+            pipe.get(self.ITEM_ADMIN_KEY.format(request_id))
+        if status is None:
+            for request_id in request_ids:
+                pipe.zscore(self.NEW_KEY, request_id)
+                pipe.zscore(self.APPROVED_KEY, request_id)
+        results = pipe.execute()
+        self.round_trips += 1
+        values = results[0:len(request_ids) * 2:2]
+        approvers = results[1:len(request_ids) * 2:2]
+        scores = results[len(request_ids) * 2:]
+        requests = []
+        for i, (value, approver) in enumerate(zip(values, approvers)):
+            if value is None:
+                requests.append(None)
+                continue
+            if status is None:
+                new, approved = scores[i * 2:i * 2 + 2]
+                if new is not None:
+                    status_ = RequestStatus.new
+                else:
+                    status_ = RequestStatus.approved if approved is not None else RequestStatus.denied
+            else:
+                status_ = status
+            requests.append(PurchaseRequest.from_str(value, status_, approver))
+        return requests
+
+    def get_list(self, request_ids, status):
+        """ リクエストIDのリストに対応するリクエスト一覧を同じ順で返す
+
+        :param list[(int|str)] request_ids: 取得したいリクエストIDのリスト
+        :param (None|RequestStatus) status: リクエストの承認状況
+        :rtype: list[PurchaseRequest]
+        """
+        return self._fetch(list(request_ids), status)
+
+    def _zrange(self, key):
+        self.round_trips += 1
+        return self._redis.zrange(key, 0, -1)
 
     def get_new(self):
-        """ 未処理のリクエスト一覧を返す """
-        keys = self._redis.smembers(self.NEW_KEY)
-        return self.get_list(keys, RequestStatus.new)
+        """ 未処理のリクエスト一覧を ID 順に返す (プロセス内の複製がある場合は Redis を参照しない) """
+        if self.view is not None:
+            return self.view.new()
+        return self.load_new()
+
+    def load_new(self):
+        """ 未処理のリクエスト一覧を Redis から ID 順に読み込む """
+        return self.get_list(self._zrange(self.NEW_KEY), RequestStatus.new)
+
+    def new_by_user(self, user_id):
+        """ 利用者の未処理のリクエストを ID 順に返す (プロセス内の複製がある場合は Redis を参照しない)
+
+        :param str user_id: 利用者のユーザID
+        :rtype: list[PurchaseRequest]
+        """
+        if self.view is not None:
+            return self.view.by_user(user_id)
+        requests = []
+        cursor = None
+        while True:
+            page = self.by_user(user_id, self.chunk_size, cursor)
+            requests.extend(request for request in page.requests if request.status == RequestStatus.new)
+            cursor = page.cursor
+            if cursor is None:
+                return requests
 
     def get_approved(self):
-        """ 承認済みのリクエスト一覧を返す """
-        keys = self._redis.smembers(self.APPROVED_KEY)
-        return self.get_list(keys, RequestStatus.approved)
+        """ 承認済みのリクエスト一覧を承認日時の順に返す """
+        return self.get_list(self._zrange(self.APPROVED_KEY), RequestStatus.approved)
 
     def get_denied(self):
-        """ 却下済みのリクエスト一覧を返す """
-        keys = self._redis.smembers(self.DENIED_KEY)
-        return self.get_list(keys, RequestStatus.denied)
+        """ 却下済みのリクエスト一覧を却下日時の順に返す """
+        return self.get_list(self._zrange(self.DENIED_KEY), RequestStatus.denied)
 
     def get_all(self):
         """ 全リクエスト一覧を返す
          
         :rtype: list[PurchaseRequest]
         """
-        requests = self.get_new() + self.get_approved() + self.get_denied()
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.zrange(self.NEW_KEY, 0, -1)
+        pipe.zrange(self.APPROVED_KEY, 0, -1)
+        pipe.zrange(self.DENIED_KEY, 0, -1)
+        new_ids, approved_ids, denied_ids = pipe.execute()
+        self.round_trips += 1
+        requests = self._fetch(new_ids, RequestStatus.new)
+        requests += self._fetch(approved_ids, RequestStatus.approved)
+        requests += self._fetch(denied_ids, RequestStatus.denied)
         return sorted(requests, key=lambda x: x.id)
 
+    def _page(self, key, status, min_score, max_score, limit, cursor):
+        """ ソート済み集合をスコアの範囲で 1 ページ分取得する
+
+        カーソルは「最後に返したスコア:そのスコアで返した件数」で、
+        同じスコアのリクエストが複数あってもページの境目で重複・欠落しない。
+        1 ページにかかる時間は limit に比例し、集合の大きさにはほとんど依存しない。
+
+        :rtype: Page
+        """
+        skip = 0
+        if cursor:
+            score, skip = cursor.rsplit(":", 1)
+            min_score, skip = float(score), int(skip)
+        items = self._redis.zrangebyscore(key, min_score, max_score, start=skip, num=limit, withscores=True)
+        self.round_trips += 1
+        requests = self._fetch([member for member, _ in items], status)
+        if len(items) < limit:
+            return Page(requests, None)
+        last = items[-1][1]
+        count = sum(1 for _, score in items if score == last)
+        if cursor and last == min_score:
+            count += skip
+        return Page(requests, "{!r}:{}".format(last, count))
+
+    def oldest_new(self, limit, cursor=None):
+        """ 未処理のリクエストを古い順に limit 件ずつ返す
+
+        :param int limit: 1 ページの件数
+        :param (None|str) cursor: 前のページの Page.cursor (最初のページは None)
+        :rtype: Page
+        """
+        return self._page(self.NEW_KEY, RequestStatus.new, "-inf", "+inf", limit, cursor)
+
+    def closed_between(self, status, start, end, limit, cursor=None):
+        """ start から end までに承認 (または却下) されたリクエストを日時の順に limit 件ずつ返す
+
+        承認・却下の日時が記録されていないリクエストは日時 0 として扱う。
+
+        :param RequestStatus status: approved か denied
+        :param float start: 期間の始まり (UNIX 時間)
+        :param float end: 期間の終わり (UNIX 時間)
+        :param int limit: 1 ページの件数
+        :param (None|str) cursor: 前のページの Page.cursor (最初のページは None)
+        :rtype: Page
+        """
+        return self._page(self._status_key(status), status, start, end, limit, cursor)
+
+    def by_user(self, user_id, limit, cursor=None):
+        """ 利用者のリクエストを古い順に limit 件ずつ返す
+
+        :param str user_id: 利用者のユーザID
+        :param int limit: 1 ページの件数
+        :param (None|str) cursor: 前のページの Page.cursor (最初のページは None)
+        :rtype: Page
+        """
+        return self._page(self.USER_REQUESTS_KEY.format(user_id), None, "-inf", "+inf", limit, cursor)
+
+    def search(self, query, limit, cursor=None):
+        """ 投稿内容かユーザ名に検索語を含むリクエストを limit 件ずつ返す
+
+        当てはまった検索語の多い順、同じ数の場合は新しい順に並べる。
+        検索語はそれぞれ 2 文字以上で、1 文字の検索語は無視する。
+        索引の語ごとの集合の積と和を Redis 上で求めるため、かかる時間は検索語を含むリクエストの数によって決まり、
+        全リクエストの数にはよらない。検索結果は SEARCH_RESULT_TTL 秒の間残し、次のページはそこから読む。
+        カーソルは読み飛ばす件数の文字列で、(ページ番号 - 1) * limit を指定してもよい。
+
+        :param str query: 空白で区切った検索語
+        :param int limit: 1 ページの件数
+        :param (None|str) cursor: 前のページの Page.cursor (最初のページは None)
+        :rtype: Page
+        """
+        terms = query_terms(query)
+        if not terms:
+            return Page([], None)
+        digest = hashlib.sha1("\n".join(" ".join(sorted(grams)) for grams in terms).encode("utf-8")).hexdigest()
+        key = self.SEARCH_RESULT_KEY.format(digest)
+        offset = int(cursor) if cursor else 0
+        members = None
+        if cursor:
+            pipe = self._redis.pipeline(transaction=False)
+            pipe.exists(key)
+            pipe.zrevrange(key, offset, offset + limit - 1)
+            exists, members = pipe.execute()
+            self.round_trips += 1
+            if not exists:
+                members = None
+        if members is None:
+            keys = [key]
+            for i, grams in enumerate(terms):
+                keys.append("{}:{}".format(key, i))
+                keys += [self.SEARCH_KEY.format(gram) for gram in sorted(grams)]
+            args = [self.SEARCH_RESULT_TTL, offset, offset + limit - 1] + [len(grams) for grams in terms]
+            members = self._search_script(keys=keys, args=args)
+            self.round_trips += 1
+        request_ids = [int(member) for member in members]
+        found = {request.id: request for request in self._fetch(request_ids, None)}
+        requests = []
+        for request_id in request_ids:
+            request = found.get(request_id)
+            if request is None and self.archive is not None:
+                request = self.archive.get(request_id)
+            if request is not None:
+                requests.append(request)
+        if len(members) < limit:
+            return Page(requests, None)
+        return Page(requests, str(offset + limit))
+
+    def get_spend(self, unit, *fields):
+        """ 集計単位ごとの金額の合計を返す
+
+        fields を指定した場合はそのフィールドだけを HMGET 1 回で読むため、かかる時間はリクエストの数によらない。
+
+        :param str unit: SPEND_PENDING, SPEND_USER, SPEND_APPROVER, SPEND_MONTH のいずれか
+        :param list[str] fields: 利用者のユーザID・承認者のユーザ名・"YYYY-MM" (省略時は全て)
+        :rtype: dict[str, int]
+        :return: フィールド → 合計 (円、合計が無いフィールドは 0)
+        """
+        key = self.SPEND_KEY.format(unit)
+        if fields:
+            values = self._redis.hmget(key, fields)
+            return {field: int(value or 0) for field, value in zip(fields, values)}
+        return {field: int(value) for field, value in self._redis.hgetall(key).items()}
+
+    def _load(self, request_id):
+        """ 特定IDのリクエストを取得
+
+        :rtype: (PurchaseRequest|None), bool
+        :return: リクエストインスタンス と 旧形式ならば True
+        """
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hgetall(self.RECORD_KEY.format(request_id))
+        if self.legacy_reads:
+            pipe.get(self.ITEM_KEY.format(request_id))
+            pipe.get(self.ITEM_ADMIN_KEY.format(request_id))
+            pipe.zscore(self.NEW_KEY, request_id)
+            pipe.zscore(self.APPROVED_KEY, request_id)
+        results = pipe.execute()
+        request = self._decode_record(request_id, results[0])
+        if request is not None:
+            return request, False
+        if not self.legacy_reads or not results[1]:
+            return None, False
+        value, approver, new, approved = results[1:]
+        if new is not None:
+            status = RequestStatus.new
+        else:
+            status = RequestStatus.approved if approved is not None else RequestStatus.denied
+        return PurchaseRequest.from_str(value, status, approver), True
+
     def get(self, request_id):
         """ 特定のリクエストを取得
 
+         Redis に無い場合は保管済みのリクエストから探す。
+
          :rtype: (PurchaseRequest|None), bool
          :return: リクエストインスタンス と 未承認ならば True
          """
-        key = self.ITEM_KEY.format(request_id)
-        value = self._redis.get(key)
-        if not value:
+        if self.view is not None:
+            request = self.view.get(request_id)
+            if request is not None:
+                return request, True
+        request, _ = self._load(request_id)
+        if request is None and self.archive is not None:
+            request = self.archive.get(request_id)
+        if request is None:
+            return None, False
+        return request, request.status == RequestStatus.new
+
+    def find_new(self, username, text, channel=None, ts=None):
+        """ 投稿元のメッセージから未処理のリクエストを探す
+
+        :param str username: 投稿者のユーザ名
+        :param str text: 投稿内容
+        :param (None|str) channel: 投稿されたチャンネルのID
+        :param (None|str) ts: 投稿されたメッセージの ts
+        :rtype: PurchaseRequest|None
+        """
+        return self._find_new(username, text, channel, ts)[0]
+
+    def _find_new(self, username, text, channel, ts):
+        if self.view is not None and not self.legacy_reads:
+            request = self.view.find(username, text, channel, ts)
+            if request is not None:
+                return request, False
+        pipe = self._redis.pipeline(transaction=False)
+        if ts:
+            pipe.hget(self.MESSAGE_INDEX_KEY, self._message_field(channel, ts))
+        pipe.hget(self.TEXT_INDEX_KEY, self._text_field(username, text))
+        request_id = next((value for value in pipe.execute() if value), None)
+        if not request_id:
             return None, False
-        request = PurchaseRequest.from_str(value)
-        if self._redis.sismember(self.NEW_KEY, key):
-            return request, True
-        return request, False
-
-    def update(self, username, prev_text, new_text):
-        """ リクエストを更新 """
-        keys = self._redis.smembers(self.NEW_KEY)
-        for key in keys:
-            value = self._redis.get(key)
-            request = PurchaseRequest.from_str(value)
-            if request.text == prev_text and request.username == username:
-                request.text = new_text
-                key = self.ITEM_KEY.format(request.id)
-                value = request.to_str()
-                self._redis.set(key, value)
-                return True
-        return False
-
-    def delete(self, username, prev_text):
-        """ リクエストを削除 """
-        keys = self._redis.smembers(self.NEW_KEY)
-        for key in keys:
-            value = self._redis.get(key)
-            request = PurchaseRequest.from_str(value)
-            if request.text == prev_text and request.username == username:
-                key = self.ITEM_KEY.format(request.id)
-                self._redis.delete(key)
-                self._redis.srem(self.NEW_KEY, key)
-                return True
-        return False
+        return self._load(request_id)
+
+    def update(self, username, prev_text, new_text, channel=None, ts=None, jobs=None):
+        """ リクエストを更新
+
+        :param (None|dict[str, float]) jobs: 更新した場合に同時に登録するジョブの予定 (既に予定があるジョブはそのまま)
+        """
+        request, legacy = self._find_new(username, prev_text, channel, ts)
+        if request is None:
+            return False
+        old_index = self._index_fields(request)
+        old_tokens = tokenize(request.username, request.text)
+        old_total = request.total
+        request.text = new_text
+        request.amount, request.quantity = parse_amount(new_text)
+        # 旧データは以後 channel:ts で引けるようにする
+        if ts and not request.ts:
+            request.channel = channel
+            request.ts = ts
+        fields = {"t": request.text}
+        if request.ts:
+            fields.update({"ch": request.channel, "ts": request.ts})
+        if request.amount is not None:
+            fields.update({"p": request.amount, "q": request.quantity})
+        # 変わった語だけを索引に反映する
+        new_tokens = tokenize(request.username, request.text)
+        change = {"op": "put", "id": request.id, "r": request.to_hash()}
+        # 旧形式のリクエストは、移行ツールが同時に変換した場合に古い形式で書き戻さないよう、残っている場合のみ更新する
+        if not self._write(request, fields=fields, unset=("p", "q") if request.amount is None else (), legacy=legacy,
+                           spend=request.total - old_total if not legacy else 0,
+                           unindex=old_index, index=self._index_fields(request),
+                           added=new_tokens - old_tokens, removed=old_tokens - new_tokens, jobs=jobs, change=change):
+            return self.update(username, prev_text, new_text, channel, ts, jobs)
+        return True
+
+    def delete(self, username, prev_text, channel=None, ts=None, jobs=None):
+        """ リクエストを削除
+
+        :param (None|dict[str, float]) jobs: 削除した場合に同時に登録するジョブの予定 (既に予定があるジョブはそのまま)
+        """
+        request = self.find_new(username, prev_text, channel, ts)
+        if request is None:
+            return False
+        # 承認・却下と同時に削除しても未処理の合計から二重に引かないよう、一覧から外せた場合だけ引く
+        self._write(request, delete=True, spend=-request.total, unindex=self._index_fields(request),
+                    removed=tokenize(request.username, request.text), jobs=jobs,
+                    change={"op": "del", "ids": [request.id]})
+        return True
 
     def set_approver(self, request_id, username):
         """ 特定IDのリクエストの承認者を登録 """
-        key = self.ITEM_ADMIN_KEY.format(request_id)
-        self._redis.set(key, username)
+        key = self.RECORD_KEY.format(request_id)
+        if self._redis.exists(key):
+            self._redis.hset(key, "a", username)
+        else:
+            self._redis.set(self.ITEM_ADMIN_KEY.format(request_id), username)
 
     def get_approver(self, request_id):
-        """ 特定IDのリクエストの承認者を登録 """
-        key = self.ITEM_ADMIN_KEY.format(request_id)
-        return self._redis.get(key)
+        """ 特定IDのリクエストの承認者を取得 """
+        pipe = self._redis.pipeline(transaction=False)
+        pipe.hget(self.RECORD_KEY.format(request_id), "a")
+        pipe.get(self.ITEM_ADMIN_KEY.format(request_id))
+        approver, legacy_approver = pipe.execute()
+        return approver or legacy_approver
+
+    def transition(self, request_ids, status, username):
+        """ 未処理のリクエストをまとめて承認または却下する
+
+        状態の確認と変更は 1 回の Lua スクリプト呼び出しでアトミックに行うため、
+        複数の承認者が同じIDを同時に処理しても変更されるのは 1 度だけになる。
+
+        :param list[int] request_ids: リクエストIDのリスト
+        :param RequestStatus status: 変更後の状態 (approved か denied)
+        :param str username: 承認者のユーザ名
+        :rtype: TransitionResult
+        """
+        keys = [self.NEW_KEY, self._status_key(status), self.MESSAGE_INDEX_KEY, self.TEXT_INDEX_KEY,
+                self.PENDING_VERSION_KEY, self.PENDING_CHANNEL_KEY]
+        keys += [self.SPEND_KEY.format(unit) for unit in (SPEND_PENDING, SPEND_USER, SPEND_APPROVER, SPEND_MONTH)]
+        for request_id in request_ids:
+            keys.append(self.RECORD_KEY.format(request_id))
+            keys.append(self.ITEM_KEY.format(request_id))
+            keys.append(self.ITEM_ADMIN_KEY.format(request_id))
+        now = time.time()
+        args = [username, status.value, now, self._spend_month(now)] + list(request_ids)
+        changed, handled, missing, version = self._transition_script(keys=keys, args=args)
+        changed = [PurchaseRequest.from_str(value, status, username) if layout == "legacy"
+                   else self._decode_record(request_id, value)
+                   for request_id, layout, value in changed]
+        handled = [int(i) for i in handled]
+        missing = [int(i) for i in missing]
+        if missing and self.archive is not None:
+            # 保管済みのリクエストは対応済み
+            archived = self.archive.exists(missing)
+            handled += [i for i in missing if i in archived]
+            missing = [i for i in missing if i not in archived]
+        if version:
+            self._apply_change(version, {"op": "del", "ids": [request.id for request in changed]})
+        return TransitionResult(changed, handled, missing)
 
     def approve(self, request_id, username):
         """ 特定IDのリクエストを承認 """
-        key = self.ITEM_KEY.format(request_id)
-        self._redis.srem(self.NEW_KEY, key)
-        self._redis.sadd(self.APPROVED_KEY, key)
-        self.set_approver(request_id, username)
+        return self.transition([request_id], RequestStatus.approved, username)
 
     def deny(self, request_id, username):
         """ 特定IDのリクエストを却下 """
-        key = self.ITEM_KEY.format(request_id)
-        self._redis.srem(self.NEW_KEY, key)
-        self._redis.sadd(self.DENIED_KEY, key)
-        self.set_approver(request_id, username)
+        return self.transition([request_id], RequestStatus.denied, username)
 
     @property
     def admin(self):
-        """ 承認者ユーザ一覧を取得 """
-        return self._redis.smembers(self.ADMIN_KEY)
+        """ 承認者ユーザ一覧を取得
+
+        一覧はプロセス内にキャッシュし、admin_cache_interval 秒ごとに
+        変更番号だけを確認して、変わっていた場合のみ読み直す。
+        他のプロセスでの変更も admin_cache_interval 秒以内に反映される。
+
+        :rtype: frozenset[str]
+        """
+        with self._admin_lock:
+            now = self._timer()
+            if self._admin is not None and now - self._admin_checked < self.admin_cache_interval:
+                return self._admin
+            version = self._redis.get(self.ADMIN_VERSION_KEY)
+            if self._admin is None or version != self._admin_version:
+                self._admin = frozenset(self._redis.smembers(self.ADMIN_KEY))
+                self._admin_version = version
+            self._admin_checked = now
+            return self._admin
+
+    def _change_admin(self, command, user):
+        self._admin_script(keys=[self.ADMIN_KEY, self.ADMIN_VERSION_KEY], args=[command, user])
+        with self._admin_lock:
+            self._admin = None
 
     def add_admin(self, user):
         """ 承認者ユーザ一覧を追加 """
-        self._redis.sadd(self.ADMIN_KEY, user)
+        self._change_admin("SADD", user)
 
     def remove_admin(self, user):
         """ 承認者ユーザ一覧から削除 """
-        self._redis.srem(self.ADMIN_KEY, user)
+        self._change_admin("SREM", user)
+
+    def get_username(self, user_id):
+        """ 共有キャッシュからユーザ名を取得 """
+        return self._redis.get(self.USERNAME_KEY.format(user_id))
+
+    def set_username(self, user_id, username, ttl):
+        """ 共有キャッシュにユーザ名を ttl 秒間保存 """
+        self._redis.set(self.USERNAME_KEY.format(user_id), username, ex=int(ttl))
+
+    def delete_username(self, user_id):
+        """ 共有キャッシュからユーザ名を削除 """
+        self._redis.delete(self.USERNAME_KEY.format(user_id))
+
+    def get_im_channel(self, user_id):
+        """ 共有キャッシュからユーザとの DM チャンネルIDを取得 """
+        return self._redis.hget(self.IM_CHANNEL_KEY, user_id)
+
+    def set_im_channel(self, user_id, channel_id):
+        """ 共有キャッシュにユーザとの DM チャンネルIDを保存 """
+        self._redis.hset(self.IM_CHANNEL_KEY, user_id, channel_id)
+
+    def get_notified(self, users):
+        """ 承認者ごとに通知済みのリクエストを取得
+
+        :param list[str] users: 承認者のユーザIDのリスト
+        :rtype: dict[str, dict[str, str]]
+        :return: ユーザID → (リクエストID → fingerprint)
+        """
+        pipe = self._redis.pipeline(transaction=False)
+        for user in users:
+            pipe.hgetall(self.NOTIFIED_KEY.format(user))
+        return dict(zip(users, pipe.execute()))
+
+    def save_notified(self, user, fingerprints, removed=(), reset=False):
+        """ 承認者に通知したリクエストを記録
+
+        :param str user: 承認者のユーザID
+        :param dict[int, str] fingerprints: 通知したリクエストID → fingerprint
+        :param list[int] removed: 通知済みから外すリクエストID
+        :param bool reset: それまでの記録を破棄する場合は True
+        """
+        key = self.NOTIFIED_KEY.format(user)
+        pipe = self._redis.pipeline(transaction=False)
+        if reset:
+            pipe.delete(key)
+        if removed:
+            pipe.hdel(key, *removed)
+        if fingerprints:
+            pipe.hset(key, mapping=fingerprints)
+        pipe.execute()
+
+    def claim_event(self, event_id, worker_id, ttl):
+        """ イベントの処理担当になる
+
+        :param str event_id: イベントを識別する文字列
+        :param str worker_id: ワーカーのID
+        :param int ttl: 記録を残す秒数
+        :rtype: bool
+        :return: 担当になれた場合は True (他のワーカーが担当済みの場合は False)
+        """
+        return bool(self._redis.set(self.EVENT_CLAIM_KEY.format(event_id), worker_id, nx=True, ex=int(ttl)))
+
+    def journal_append(self, event):
+        """ イベントをジャーナルに記録する
+
+        :param dict event: RTM イベント
+        :rtype: str
+        :return: ジャーナルのエントリID
+        """
+        return self._journal_append_script(keys=[self.JOURNAL_KEY, self.JOURNAL_PENDING_KEY],
+                                           args=[json.dumps(event, ensure_ascii=False), time.time(),
+                                                 self.JOURNAL_MAXLEN])
+
+    def journal_done(self, entry_id, ts=None):
+        """ ジャーナルのイベントを完了済みにする (何度呼んでもよい)
+
+        :param str entry_id: ジャーナルのエントリID
+        :param (None|str) ts: 処理した購入申請チャンネルの投稿の ts
+        """
+        self._journal_done_script(keys=[self.JOURNAL_PENDING_KEY, self.JOURNAL_CURSOR_KEY], args=[entry_id, ts or ""])
+
+    def journal_pending(self, before=None):
+        """ 完了済みになっていないイベントを記録順に返す
+
+        ジャーナルの長さの上限を超えて消えたイベントは未完了の一覧からも外す。
+
+        :param (None|float) before: 指定した場合はこの日時 (UNIX 時間) より前に記録したイベントだけを返す
+        :rtype: list[(str, dict)]
+        :return: エントリID と イベント のリスト
+        """
+        if before is None:
+            entry_ids = self._redis.zrange(self.JOURNAL_PENDING_KEY, 0, -1)
+        else:
+            entry_ids = self._redis.zrangebyscore(self.JOURNAL_PENDING_KEY, "-inf", "({}".format(before))
+        pipe = self._redis.pipeline(transaction=False)
+        for entry_id in entry_ids:
+            pipe.xrange(self.JOURNAL_KEY, entry_id, entry_id)
+        events = []
+        lost = []
+        for entry_id, entries in zip(entry_ids, pipe.execute()):
+            if entries:
+                events.append((entry_id, json.loads(entries[0][1]["event"])))
+            else:
+                lost.append(entry_id)
+        if lost:
+            self._redis.zrem(self.JOURNAL_PENDING_KEY, *lost)
+        return events
+
+    def journal_cursor(self):
+        """ 処理済みの購入申請チャンネルの投稿のうち最新の ts を返す
+
+        :rtype: (None|str)
+        """
+        return self._redis.get(self.JOURNAL_CURSOR_KEY)
+
+    def acquire_lease(self, name, worker_id, ttl):
+        """ リースを取得または延長する
+
+        :param str name: リースの名前
+        :param str worker_id: ワーカーのID
+        :param float ttl: リースの有効期限 (秒)
+        :rtype: bool
+        :return: リースを保持している場合は True
+        """
+        return bool(self._lease_script(keys=[self.LEASE_KEY.format(name)], args=[worker_id, int(ttl * 1000)]))
+
+    def schedule(self, jobs, nx=False):
+        """ ジョブの予定時刻を登録する
+
+        :param dict[str, float] jobs: ジョブ名 → 予定時刻 (UNIX 時間)
+        :param bool nx: 既に予定があるジョブはそのままにする場合は True
+        """
+        if jobs:
+            self._redis.zadd(self.SCHEDULE_KEY, jobs, nx=nx)
+
+    def unschedule(self, *jobs):
+        """ ジョブの予定を取り消す """
+        if jobs:
+            self._redis.zrem(self.SCHEDULE_KEY, *jobs)
+
+    def claim_jobs(self, now, limit):
+        """ 予定時刻を過ぎたジョブを予定の早い順に limit 件まで取り出す
+
+        取り出したジョブは予定から削除されるため、複数のボットが同時に呼んでも同じジョブは 1 度しか返らない。
+
+        :param float now: 現在日時 (UNIX 時間)
+        :param int limit: 取り出すジョブの数
+        :rtype: list[(str, float)]
+        :return: ジョブ名 と 予定時刻 のリスト
+        """
+        jobs = self._claim_jobs_script(keys=[self.SCHEDULE_KEY], args=[now, limit])
+        return [(name, float(due)) for name, due in zip(jobs[::2], jobs[1::2])]
+
+    def next_job_time(self):
+        """ 最も早いジョブの予定時刻を返す (予定が無い場合は None)
+
+        :rtype: (None|float)
+        """
+        jobs = self._redis.zrange(self.SCHEDULE_KEY, 0, 0, withscores=True)
+        return jobs[0][1] if jobs else None
+
+    def backfill_schedule(self, jobs):
+        """ ジョブの予定の導入前からある未処理リクエストの予定を登録する
+
+        登録済みの場合は何もしない。
+
+        :param callable jobs: リクエストを受け取り、ジョブ名 → 予定時刻 の辞書を返す関数
+        :rtype: int
+        :return: 予定を登録したリクエスト数
+        """
+        if self._redis.exists(self.SCHEDULE_READY_KEY):
+            return 0
+        total = 0
+        cursor = None
+        while True:
+            page = self.oldest_new(self.chunk_size, cursor)
+            scheduled = {}
+            for request in page.requests:
+                scheduled.update(jobs(request))
+            self.schedule(scheduled, nx=True)
+            total += len(page.requests)
+            cursor = page.cursor
+            if cursor is None:
+                break
+        self._redis.set(self.SCHEDULE_READY_KEY, 1)
+        return total
@@ -0,0 +1,147 @@
+"""
+全期間のリクエストの集計と CSV への書き出し
+"""
+
+import csv
+import datetime
+import io
+import re
+from collections import Counter
+
+from .model import RequestStatus
+
+CSV_COLUMNS = ["id", "status", "user_id", "username", "approver", "text", "created", "closed"]
+UNKNOWN_MONTH = "unknown"
+
+
+def month_range(text):
+    """ 文字列中の年月 (2018-04 や 2018/4) から、その月の期間を返す
+
+    :param str text: コマンドの文字列
+    :rtype: (None|(float, float, str))
+    :return: 月初と翌月初の UNIX 時間 (ローカル時刻) と "YYYY-MM" (年月が無い場合は None)
+    """
+    match = re.search(r"(\d{4})[-/](\d{1,2})", text)
+    if match is None:
+        return None
+    year, month = int(match.group(1)), int(match.group(2))
+    if not 1 <= month <= 12:
+        return None
+    first = datetime.datetime(year, month, 1)
+    following = datetime.datetime(year + month // 12, month % 12 + 1, 1)
+    return first.timestamp(), following.timestamp(), "{:04d}-{:02d}".format(year, month)
+
+
+def _month(timestamp):
+    if timestamp is None:
+        return UNKNOWN_MONTH
+    return datetime.datetime.fromtimestamp(timestamp).strftime("%Y-%m")
+
+
+def _isoformat(timestamp):
+    if timestamp is None:
+        return ""
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(timespec="seconds")
+
+
+def stream_requests(repo, start=None, end=None, chunk_size=500):
+    """ Redis と保管済みのリクエストを chunk_size 件ずつ読み込みながら返す
+
+    承認・却下済みのリクエストは承認・却下の日時で、未処理のリクエストは登録日時で期間を絞り込む。
+    一度にメモリに載るのは chunk_size 件までになる。
+
+    :param PurchaseRepo repo:
+    :param (None|float) start: 期間の始まり (UNIX 時間、この日時を含む)
+    :param (None|float) end: 期間の終わり (UNIX 時間、この日時を含まない)
+    :param int chunk_size: 1 回に読み込む件数
+    :rtype: collections.Iterable[PurchaseRequest]
+    """
+    min_score = "-inf" if start is None else start
+    max_score = "+inf" if end is None else "({}".format(end)
+    for status in (RequestStatus.approved, RequestStatus.denied):
+        cursor = None
+        while True:
+            page = repo.closed_between(status, min_score, max_score, chunk_size, cursor)
+            yield from page.requests
+            cursor = page.cursor
+            if cursor is None:
+                break
+    cursor = None
+    while True:
+        page = repo.oldest_new(chunk_size, cursor)
+        for request in page.requests:
+            created = request.created
+            if start is None and end is None:
+                yield request
+            elif created is not None and (start is None or start <= created) and (end is None or created < end):
+                yield request
+        cursor = page.cursor
+        if cursor is None:
+            break
+    if repo.archive is not None:
+        yield from repo.archive.iter(start, end, chunk_size)
+
+
+class Report:
+    """ 状態・利用者・承認者・月ごとのリクエスト数 """
+
+    def __init__(self):
+        self.total = 0
+        self.by_status = Counter()
+        self.by_user = Counter()
+        self.by_approver = Counter()
+        self.by_month = Counter()
+
+    def add(self, request):
+        """ リクエストを集計に加える
+
+        :param PurchaseRequest request:
+        """
+        self.total += 1
+        self.by_status[request.status.value] += 1
+        self.by_user[request.username] += 1
+        if request.approver:
+            self.by_approver[request.approver] += 1
+        timestamp = request.created if request.status == RequestStatus.new else request.closed
+        self.by_month[_month(timestamp)] += 1
+
+    def summary(self, top=10):
+        """ Slack に投稿する集計結果を返す
+
+        :param int top: 利用者・承認者ごとの件数を表示する人数
+        :rtype: str
+        """
+        lines = ["合計: {} 件".format(self.total),
+                 "状態別: " + ", ".join("{} {}".format(name, count) for name, count in sorted(self.by_status.items())),
+                 "月別: " + ", ".join("{} {}".format(name, count) for name, count in sorted(self.by_month.items()))]
+        lines.append("利用者別 (上位 {}): ".format(top) + ", ".join(
+            "{} {}".format(name, count) for name, count in self.by_user.most_common(top)))
+        lines.append("承認者別 (上位 {}): ".format(top) + ", ".join(
+            "{} {}".format(name, count) for name, count in self.by_approver.most_common(top)))
+        return "\n".join(lines)
+
+
+def export(repo, fileobj, start=None, end=None, chunk_size=500):
+    """ リクエストを CSV で fileobj に書き出しながら集計する
+
+    CSV は Excel でそのまま開けるよう BOM 付きの UTF-8 で書き出す。
+
+    :param PurchaseRepo repo:
+    :param fileobj: バイナリモードで開いたファイル
+    :param (None|float) start: 期間の始まり (UNIX 時間、この日時を含む)
+    :param (None|float) end: 期間の終わり (UNIX 時間、この日時を含まない)
+    :param int chunk_size: 1 回に読み込む件数
+    :rtype: Report
+    """
+    report = Report()
+    text = io.TextIOWrapper(fileobj, encoding="utf-8-sig", newline="")
+    writer = csv.writer(text)
+    writer.writerow(CSV_COLUMNS)
+    for request in stream_requests(repo, start, end, chunk_size):
+        report.add(request)
+        writer.writerow([request.id, request.status.value, request.user_id, request.username, request.approver,
+                         request.text, _isoformat(request.created), _isoformat(request.closed)])
+    text.flush()
+    # fileobj を呼び出し元で使い続けられるように切り離す
+    text.detach()
+    return report
@@ -0,0 +1,153 @@
+"""
+asyncio ベースのイベント処理ランタイム
+"""
+
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+
+def event_key(message):
+    """ 処理順序を守る必要があるイベントのまとまりを表すキーを返す
+
+    同じ投稿に対する作成・編集・削除は同じキーになり、到着順に処理される。
+    ダイレクトメッセージのコマンドは送信者ごとに到着順に処理される。
+
+    :param dict message: RTM イベント
+    :rtype: (None|tuple)
+    :return: キー (順序の制約がないイベントは None)
+    """
+    if message.get('type') != 'message':
+        return None
+    channel = message.get('channel') or ''
+    if channel.startswith('D'):
+        return 'user', message.get('user')
+    sub_type = message.get('subtype')
+    if sub_type in ('message_changed', 'message_deleted'):
+        ts = (message.get('previous_message') or {}).get('ts') or message.get('deleted_ts')
+    else:
+        ts = message.get('ts')
+    return 'message', channel, ts
+
+
+async def replay(events):
+    """ イベントのリストを Runtime.run に渡せる非同期イテレータにする """
+    for event in events:
+        yield event
+
+
+class RTMEventSource:
+    """ slackclient の RTM ソケットが読み込み可能になった時だけイベントを読み出す
+
+    :param slackclient.SlackClient client: rtm_connect 済みのクライアント
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._queue = None
+        self._fileno = None
+
+    def _socket_fileno(self):
+        return self._client.server.websocket.sock.fileno()
+
+    def _watch(self, loop):
+        """ 再接続でソケットが変わった場合は監視対象を付け替える """
+        fileno = self._socket_fileno()
+        if fileno == self._fileno:
+            return
+        if self._fileno is not None:
+            loop.remove_reader(self._fileno)
+        loop.add_reader(fileno, self._on_readable, loop)
+        self._fileno = fileno
+
+    def _on_readable(self, loop):
+        try:
+            for message in self._client.rtm_read():
+                self._queue.put_nowait(message)
+            self._watch(loop)
+        except Exception as e:
+            loop.remove_reader(self._fileno)
+            self._queue.put_nowait(e)
+
+    async def __aiter__(self):
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        self._watch(loop)
+        try:
+            while True:
+                message = await self._queue.get()
+                if isinstance(message, Exception):
+                    raise message
+                yield message
+        finally:
+            loop.remove_reader(self._fileno)
+            self._fileno = None
+
+
+class Runtime:
+    """ イベントをワーカースレッドで並行に処理する
+
+    key_func が同じキーを返すイベント同士は到着順に 1 件ずつ処理される。
+
+    :param callable handler: イベントを処理する関数 (ワーカースレッドで呼ばれる)
+    :param callable key_func: イベントから順序キーを求める関数
+    :param int max_workers: 同時に処理するイベント数の上限
+    """
+
+    def __init__(self, handler, key_func=event_key, max_workers=8):
+        self._logger = logging.getLogger("purchase_bot")
+        self._handler = handler
+        self._key_func = key_func
+        self._max_workers = max_workers
+        self._tails = {}
+        self._tasks = set()
+        metrics.QUEUE_DEPTH.labels("events", "").set_function(lambda: len(self._tasks))
+
+    @property
+    def pending(self):
+        """ 処理待ち・処理中のイベント数 """
+        return len(self._tasks)
+
+    def _handle(self, message):
+        try:
+            with metrics.EVENT_SECONDS.labels(message.get('type', '')).time():
+                self._handler(message)
+        except Exception:
+            self._logger.exception("Failed to handle message: {}".format(message))
+
+    async def _run(self, executor, previous, message):
+        if previous is not None:
+            await asyncio.wait([previous])
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(executor, self._handle, message)
+
+    def _submit(self, executor, message):
+        key = self._key_func(message)
+        previous = self._tails.get(key) if key is not None else None
+        task = asyncio.ensure_future(self._run(executor, previous, message))
+        self._tasks.add(task)
+        if key is not None:
+            self._tails[key] = task
+
+        def done(t):
+            self._tasks.discard(t)
+            if key is not None and self._tails.get(key) is t:
+                del self._tails[key]
+
+        task.add_done_callback(done)
+
+    async def run(self, source):
+        """ source からイベントを受け取り、尽きるまで処理する
+
+        :param source: RTM イベントを返す非同期イテレータ
+        """
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            try:
+                async for message in source:
+                    self._logger.debug(message)
+                    self._submit(executor, message)
+            finally:
+                if self._tasks:
+                    await asyncio.wait(list(self._tasks))
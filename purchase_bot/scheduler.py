@@ -0,0 +1,142 @@
+"""
+Redis のソート済み集合に予定時刻を記録したジョブの実行
+"""
+
+import datetime
+import logging
+import threading
+import time
+from collections import defaultdict
+
+
+def job_name(kind, arg=None):
+    """ ソート済み集合の要素にするジョブ名を返す
+
+    同じ種類・引数のジョブは 1 つにまとまる。
+
+    :param str kind: ジョブの種類
+    :param arg: ジョブの引数 (リクエストIDなど)
+    :rtype: str
+    """
+    if arg is None:
+        return kind
+    return "{}:{}".format(kind, arg)
+
+
+def parse_job(name):
+    """ ジョブ名を種類と引数に分ける
+
+    :rtype: str, (None|str)
+    """
+    kind, _, arg = name.partition(":")
+    return kind, arg or None
+
+
+def next_daily(at, now):
+    """ 毎日 at の時刻に行う処理の、now より後の次の予定時刻を返す
+
+    :param str at: "09:00" のような時刻 (ローカル時間)
+    :param float now: 現在日時 (UNIX 時間)
+    :rtype: float
+    """
+    hour, minute = (int(value) for value in at.split(":"))
+    current = datetime.datetime.fromtimestamp(now)
+    due = current.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if due <= current:
+        due += datetime.timedelta(days=1)
+    return due.timestamp()
+
+
+class Scheduler:
+    """ 予定時刻になったジョブを種類ごとにまとめて実行する
+
+    予定時刻は PurchaseRepo.SCHEDULE_KEY のソート済み集合に記録されているため、
+    複数のボットが同じ Redis を共有していても、各ジョブを実行するのは取り出した 1 つのボットだけになる。
+    run は次の予定時刻まで (最長 max_idle 秒) 眠り、他のボットが追加したジョブも max_idle 秒以内に実行する。
+    handler が例外を送出した場合、そのジョブは retry_delay 秒後に実行し直す。
+
+    :param PurchaseRepo repo:
+    :param dict[str, callable] handlers: ジョブの種類 → handler(args, now)
+        (args は同時に取り出した同じ種類のジョブの引数のリスト)
+    :param int batch_size: 1 回に取り出すジョブの数
+    :param float max_idle: 予定が無い場合に Redis を確認し直す間隔 (秒)
+    :param float retry_delay: 失敗したジョブを実行し直すまでの秒数
+    :param callable timer: 現在日時 (UNIX 時間) を返す関数
+    """
+
+    def __init__(self, repo, handlers, batch_size=100, max_idle=60.0, retry_delay=60.0, timer=time.time):
+        self._logger = logging.getLogger("purchase_bot")
+        self._repo = repo
+        self._handlers = handlers
+        self.batch_size = batch_size
+        self.max_idle = max_idle
+        self.retry_delay = retry_delay
+        self._timer = timer
+        self._wakeup = threading.Event()
+        self._wake_at = None
+
+    def notify(self, due):
+        """ このプロセスで due に予定したジョブを追加したことを伝え、必要なら run を早く起こす
+
+        :param float due: 追加したジョブの予定時刻 (UNIX 時間)
+        """
+        wake_at = self._wake_at
+        if wake_at is not None and due < wake_at:
+            self._wakeup.set()
+
+    def run_pending(self, now=None):
+        """ 予定時刻を過ぎたジョブを batch_size 件ずつ取り出して実行する
+
+        :param (None|float) now: 現在日時 (UNIX 時間)
+        :rtype: int
+        :return: 実行したジョブの数
+        """
+        total = 0
+        while True:
+            current = self._timer() if now is None else now
+            jobs = self._repo.claim_jobs(current, self.batch_size)
+            grouped = defaultdict(list)
+            for name, _ in jobs:
+                kind, arg = parse_job(name)
+                grouped[kind].append(arg)
+            for kind, args in grouped.items():
+                handler = self._handlers.get(kind)
+                if handler is None:
+                    self._logger.warning("unknown job: {}".format(kind))
+                    continue
+                try:
+                    handler(args, current)
+                except Exception:
+                    self._logger.exception("Failed to run {} jobs: {}".format(kind, args))
+                    self._repo.schedule({job_name(kind, arg): current + self.retry_delay for arg in args})
+            total += len(jobs)
+            if len(jobs) < self.batch_size:
+                return total
+
+    def run(self, stop):
+        """ stop がセットされるまで、予定時刻ごとにジョブを実行する
+
+        :param threading.Event stop:
+        """
+        while not stop.is_set():
+            try:
+                self.run_pending()
+                due = self._repo.next_job_time()
+            except Exception:
+                self._logger.exception("Failed to run scheduled jobs")
+                due = None
+            now = self._timer()
+            wait = self.max_idle if due is None else min(max(0.0, due - now), self.max_idle)
+            self._wake_at = now + wait
+            self._wakeup.wait(wait)
+            self._wakeup.clear()
+            self._wake_at = None
+
+    def start(self, stop):
+        """ run を実行するデーモンスレッドを開始する
+
+        :rtype: threading.Thread
+        """
+        thread = threading.Thread(target=self.run, args=(stop,), name="scheduler", daemon=True)
+        thread.start()
+        return thread
@@ -0,0 +1,60 @@
+"""
+リクエストの全文検索に使う語の切り出し
+"""
+
+import re
+import unicodedata
+
+# 語の区切り (空白と記号) で分けた後、連続する N 文字ずつを索引の語にする
+NGRAM_SIZE = 2
+WORD = re.compile(r"\w+")
+
+
+def normalize(text):
+    """ 全角・半角や大文字・小文字の違いをなくした文字列を返す
+
+    :param str text:
+    :rtype: str
+    """
+    return unicodedata.normalize("NFKC", text or "").lower()
+
+
+def ngrams(word, size=NGRAM_SIZE):
+    """ word に含まれる size 文字ずつの部分文字列を返す (word が size 文字より短い場合は空)
+
+    :param str word: 正規化済みの語
+    :rtype: list[str]
+    """
+    return [word[i:i + size] for i in range(len(word) - size + 1)]
+
+
+def tokenize(*texts):
+    """ 索引に登録する語の集合を返す
+
+    日本語は単語に分けずに文字の N-gram にするため、「モニター」は「モニ」「ニタ」「ター」になる。
+
+    :param list[str] texts: 投稿内容やユーザ名
+    :rtype: set[str]
+    """
+    tokens = set()
+    for text in texts:
+        for word in WORD.findall(normalize(text)):
+            tokens.update(ngrams(word))
+    return tokens
+
+
+def query_terms(query):
+    """ 検索文字列を空白で区切った検索語ごとに、索引の語の集合を返す
+
+    N 文字に満たない検索語は索引で引けないため除く。
+
+    :param str query: "4K モニター" のような文字列
+    :rtype: list[frozenset[str]]
+    :return: 重複を除いた検索語ごとの語の集合 (現れた順)
+    """
+    terms = []
+    for word in WORD.findall(normalize(query)):
+        grams = frozenset(ngrams(word))
+        if grams and grams not in terms:
+            terms.append(grams)
+    return terms
@@ -0,0 +1,212 @@
+"""
+Slack の Web API のレート制限に合わせて呼び出しを調整するクライアント
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from . import metrics
+
+# Web API のメソッドごとの Tier (https://api.slack.com/docs/rate-limits)
+# chat.postMessage は Tier ではなくチャンネルあたり毎秒 1 件程度に制限される
+METHOD_TIERS = {
+    "chat.postMessage": "post",
+    "users.info": 4,
+    "im.open": 3,
+    "reactions.add": 3,
+    "conversations.history": 3,
+    "files.upload": 2,
+    "users.setActive": 2,
+}
+DEFAULT_TIER = 3
+# Tier ごとの 1 分あたりの呼び出し回数
+TIER_LIMITS = {1: 1, 2: 20, 3: 50, 4: 100, "post": 60}
+
+
+class TokenBucket:
+    """ 一定の割合でトークンが貯まり、呼び出しごとに 1 つ消費するバケット
+
+    :param float rate: 1 秒あたりに貯まるトークン数
+    :param float burst: 貯められるトークン数の上限
+    :param callable timer: 現在時刻を返す関数
+    :param callable sleep: 指定秒数待つ関数
+    """
+
+    def __init__(self, rate, burst, timer=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self._timer = timer
+        self._sleep = sleep
+        self._tokens = burst
+        self._updated = timer()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """ トークンを 1 つ予約し、使えるようになるまでの秒数を返す """
+        with self._lock:
+            now = self._timer()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            if self._tokens >= 0:
+                return 0.0
+            return -self._tokens / self.rate
+
+    def acquire(self):
+        """ トークンを 1 つ消費する (足りない場合は貯まるまで待つ)
+
+        :rtype: float
+        :return: 待った秒数
+        """
+        wait = self._reserve()
+        if wait > 0:
+            self._sleep(wait)
+        return wait
+
+    def pause(self, seconds):
+        """ Retry-After を受け取った場合などに、seconds 秒間トークンを使えなくする """
+        if seconds <= 0:
+            return
+        with self._lock:
+            now = self._timer()
+            # 次の acquire がちょうど seconds 秒待つようにする
+            self._tokens = min(self._tokens, 1 - seconds * self.rate)
+            self._updated = now
+
+
+class RateLimitedSlackClient:
+    """ Web API をレート制限に合わせて呼び出す Slack クライアントのラッパー
+
+    api_call は Tier ごとのトークンバケットで呼び出しの間隔を調整し、
+    HTTP 429 には Retry-After だけ待って、接続エラーと 5xx には指数的に間隔を空けて、
+    最大 max_retries 回まで再送する。HTTP 接続はセッションで使い回す。
+    再送しても失敗した場合は例外を送出せず、ok が false の応答を返す。
+    api_call 以外の属性 (RTM など) は元のクライアントに委譲する。
+
+    :param slackclient.SlackClient client: 元のクライアント (token と RTM に使う)
+    :param (None|str) base_url: Web API の URL (省略時は環境変数 SLACK_API_URL か https://slack.com/api/)
+    :param int max_retries: 再送する回数の上限
+    :param float timeout: 1 回の HTTP リクエストのタイムアウト (秒)
+    :param float backoff: 接続エラー・5xx の場合の最初の待ち時間 (秒, 再送ごとに倍になる)
+    :param int pool_size: 使い回す HTTP 接続の数
+    :param callable timer: 現在時刻を返す関数
+    :param callable sleep: 指定秒数待つ関数
+    """
+    # Retry-After が無い 429 の場合の待ち時間 (秒)
+    DEFAULT_RETRY_AFTER = 1
+
+    def __init__(self, client, base_url=None, max_retries=3, timeout=10.0, backoff=0.5, pool_size=8,
+                 timer=time.monotonic, sleep=time.sleep):
+        self._logger = logging.getLogger("purchase_bot")
+        self._client = client
+        if base_url is None:
+            base_url = os.environ.get("SLACK_API_URL", "https://slack.com/api/")
+        self.base_url = base_url.rstrip("/") + "/"
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self._timer = timer
+        self._sleep = sleep
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount("https://", adapter)
+        self._session.mount("http://", adapter)
+        self._buckets = {}
+        self._buckets_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        # calls: HTTP リクエスト数, rate_limited: 429 の回数, retries: 再送の回数, failures: 再送しても失敗した回数
+        self.stats = {"calls": 0, "rate_limited": 0, "retries": 0, "failures": 0}
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def close(self):
+        self._session.close()
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def bucket(self, method):
+        """ メソッドの Tier のトークンバケットを返す (同じ Tier のメソッドで共有する) """
+        tier = METHOD_TIERS.get(method, DEFAULT_TIER)
+        with self._buckets_lock:
+            bucket = self._buckets.get(tier)
+            if bucket is None:
+                limit = TIER_LIMITS[tier]
+                bucket = TokenBucket(limit / 60.0, max(1, limit // 6), self._timer, self._sleep)
+                self._buckets[tier] = bucket
+            return bucket
+
+    @staticmethod
+    def _encode(method, kwargs):
+        """ slackclient と同じ形式で POST する内容に変換する """
+        data = dict(kwargs)
+        files = None
+        if method == "files.upload" and "file" in data:
+            files = {"file": data.pop("file")}
+        for name, value in data.items():
+            if name in ("channels", "users", "types") and isinstance(value, list):
+                data[name] = ",".join(value)
+            elif isinstance(value, (list, dict)):
+                data[name] = json.dumps(value)
+        return data, files
+
+    def api_call(self, method, timeout=None, **kwargs):
+        """ Web API を呼び出す
+
+        :param str method: API メソッド名
+        :rtype: dict
+        :return: 応答の JSON (HTTP ヘッダを "headers" に含む)
+        """
+        data, files = self._encode(method, kwargs)
+        headers = {"Authorization": "Bearer {}".format(data.pop("token", None) or self._client.token)}
+        bucket = self.bucket(method)
+        error = "request_failed"
+        response_headers = {}
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                self._count("retries")
+                metrics.SLACK_API_RETRIES.labels(method, error).inc()
+                # 再送時はアップロードするファイルを先頭から読み直す
+                for f in (files or {}).values():
+                    if hasattr(f, "seek"):
+                        f.seek(0)
+            bucket.acquire()
+            self._count("calls")
+            try:
+                response = self._session.post(self.base_url + method, data=data, files=files, headers=headers,
+                                              timeout=timeout or self.timeout)
+            except requests.RequestException as e:
+                self._logger.warning("{} failed: {}".format(method, e))
+                error = "request_failed"
+                self._sleep(self.backoff * 2 ** attempt)
+                continue
+            response_headers = dict(response.headers)
+            if response.status_code == 429:
+                self._count("rate_limited")
+                retry_after = float(response.headers.get("Retry-After", self.DEFAULT_RETRY_AFTER))
+                self._logger.warning("{} rate limited, retrying after {} seconds".format(method, retry_after))
+                metrics.RATE_LIMIT_RETRIES.labels(method).inc()
+                # 同じ Tier の他の呼び出しも Retry-After の間は待たせる
+                bucket.pause(retry_after)
+                error = "ratelimited"
+                continue
+            if response.status_code >= 500:
+                error = "http_{}".format(response.status_code)
+                self._sleep(self.backoff * 2 ** attempt)
+                continue
+            try:
+                result = response.json()
+            except ValueError:
+                result = {"ok": False, "error": "invalid_response"}
+            result["headers"] = response_headers
+            return result
+        self._count("failures")
+        return {"ok": False, "error": error, "headers": response_headers}
@@ -0,0 +1,123 @@
+"""
+複数の購入申請チャンネルを 1 つのプロセスで扱う
+"""
+
+import asyncio
+import logging
+import os
+import re
+import threading
+
+from slackclient import SlackClient
+
+from . import metrics
+from .bot import PurchaseBot
+from .repo import PurchaseRepo, channel_namespace, connect_redis
+from .runtime import RTMEventSource, Runtime
+from .slack import RateLimitedSlackClient
+
+# <#C123> または <#C123|name> の形式のチャンネル指定
+CHANNEL_MENTION = re.compile(r"\s*<#([A-Z0-9]+)(?:\|[^>]*)?>")
+
+
+class MultiChannelBot:
+    """ 購入申請チャンネルごとの PurchaseBot にイベントを振り分ける
+
+    承認者・IDの採番・リクエストの一覧はチャンネルごとに分かれ、各チャンネルのデータは
+    チャンネルIDを名前空間とする PurchaseRepo に保存する (Redis Cluster では名前空間ごとに 1 つのスロットに入る)。
+    ただし legacy_channel のデータは、purchase_bot.migrate.move_to_namespace で移すまでは
+    以前の単一チャンネルのボットと同じキーに保存する。
+    Slack と Redis の接続は全チャンネルで共有する。
+
+    ダイレクトメッセージのコマンドは、"承認 #purchase-dev 1" のようにチャンネルを指定した場合はそのチャンネルで、
+    指定しない場合は送信者が承認者になっているチャンネルが 1 つだけならそのチャンネルで実行する。
+
+    :param list[str] channels: 購入申請チャンネルのIDのリスト (省略時は SLACK_CHANNEL_IDS をカンマで区切ったもの)
+    :param (None|str) legacy_channel: 以前のキーが残っていればそれを使うチャンネルのID (省略時は SLACK_CHANNEL_ID)
+    :param client: Slack クライアント (省略時は SLACK_TOKEN の SlackClient を RateLimitedSlackClient で包んで使う)
+    :param (None|redis.StrictRedis) redis: Redis クライアント (省略時は環境変数から接続)
+    :param bool debug: デバッグログを出力する場合は True
+    """
+
+    def __init__(self, channels=None, legacy_channel=None, client=None, redis=None, debug=False):
+        self._logger = logging.getLogger("purchase_bot")
+        if channels is None:
+            channels = [channel for channel in os.environ["SLACK_CHANNEL_IDS"].split(",") if channel]
+        if legacy_channel is None:
+            legacy_channel = os.environ.get("SLACK_CHANNEL_ID")
+        if client is None:
+            client = RateLimitedSlackClient(SlackClient(os.environ["SLACK_TOKEN"]),
+                                            max_retries=int(os.environ.get("SLACK_MAX_RETRIES", 3)))
+        if redis is None:
+            redis = connect_redis()
+        # チャンネルID → そのチャンネルの PurchaseBot (設定した順)
+        self.bots = {}
+        for channel in channels:
+            namespace = channel_namespace(redis, channel) if channel == legacy_channel else channel
+            repo = PurchaseRepo(redis, namespace=namespace)
+            self.bots[channel] = PurchaseBot(debug=debug, client=client, repo=repo, purchase_channel=channel)
+        self.client = next(iter(self.bots.values())).client
+        self._workers = int(os.environ.get("BOT_WORKERS", 8))
+        self._stop = threading.Event()
+
+    def _admin_channels(self, user_id):
+        return [channel for channel, bot in self.bots.items() if user_id in bot.repo.admin]
+
+    def _route(self, message):
+        """ イベントを処理するチャンネルの PurchaseBot を選ぶ
+
+        :rtype: (None|PurchaseBot), dict
+        :return: PurchaseBot (処理しない場合は None) と 渡すイベント (チャンネル指定は取り除く)
+        """
+        channel = message.get('channel') or ''
+        if channel in self.bots:
+            return self.bots[channel], message
+        if not channel.startswith('D') or len(self.bots) == 1:
+            return next(iter(self.bots.values())), message
+        text = message.get('text') or ''
+        mention = CHANNEL_MENTION.search(text)
+        if mention and mention.group(1) in self.bots:
+            text = text[:mention.start()] + text[mention.end():]
+            return self.bots[mention.group(1)], dict(message, text=text)
+        user_id = message.get('user')
+        if not user_id or message.get('subtype') or message.get('bot_id'):
+            return None, message
+        channels = self._admin_channels(user_id)
+        if len(channels) == 1:
+            return self.bots[channels[0]], message
+        bot = next(iter(self.bots.values()))
+        bot._send_direct_message(user_id, "購入申請チャンネルを指定してください (例: `承認 <#{}> 1`): {}".format(
+            channels[0] if channels else bot._purchase_channel,
+            ", ".join("<#{}>".format(channel) for channel in (channels or self.bots))))
+        return None, message
+
+    def _handle_message(self, message):
+        if message.get('type') == 'user_change':
+            for bot in self.bots.values():
+                bot._handle_message(message)
+            return
+        bot, message = self._route(message)
+        if bot is not None:
+            bot._handle_message(message)
+
+    async def run(self, source):
+        """ source から届くイベントを各チャンネルの PurchaseBot で並行に処理する
+
+        :param source: RTM イベントを返す非同期イテレータ
+        """
+        await Runtime(self._handle_message, max_workers=self._workers).run(source)
+
+    def main(self):
+        if not self.client.rtm_connect():
+            raise RuntimeError('failed to connect slack, invalid token?')
+        self.client.api_call("users.setActive")
+        for bot in self.bots.values():
+            bot.catch_up()
+            bot.scheduler.start(self._stop)
+        metrics_port = os.environ.get("METRICS_PORT")
+        if metrics_port:
+            metrics_host = os.environ.get("METRICS_HOST", metrics.DEFAULT_HOST)
+            metrics.start_http_server(metrics_port, host=metrics_host)
+            self._logger.info("serving metrics on {}:{}".format(metrics_host, metrics_port))
+        self._logger.info("Begin main loop for {} channels".format(len(self.bots)))
+        asyncio.run(self.run(RTMEventSource(self.client)))
@@ -0,0 +1,197 @@
+"""
+未処理リクエストのプロセス内の複製
+"""
+
+import copy
+import json
+import logging
+import threading
+import time
+
+from .model import PurchaseRequest
+
+
+class PendingView:
+    """ 未処理リクエストを ID・利用者・投稿で引けるようにメモリ上に持つ
+
+    start で Redis から一括で読み込み、以後は PurchaseRepo が書き込みのたびに Pub/Sub で通知する変更を反映する。
+    変更には連番の変更番号が付いており、番号が飛んだ場合 (通知を取りこぼした場合) や、
+    resync_interval 秒ごとに確認する Redis の変更番号と一致しない場合は読み込み直す。
+    通知は全プロセスに届くため、複数のボットが書き込んでも各プロセスの複製は一致する。
+    start の後は PurchaseRepo の get_new・get・update・delete などが Redis の代わりにこの複製を参照する。
+
+    :param PurchaseRepo repo:
+    :param float resync_interval: Redis の変更番号を確認する間隔 (秒)
+    :param callable timer: 現在時刻を返す関数
+    """
+
+    def __init__(self, repo, resync_interval=30.0, timer=time.monotonic):
+        self._logger = logging.getLogger("purchase_bot")
+        self._repo = repo
+        self.resync_interval = resync_interval
+        self._timer = timer
+        self._lock = threading.Lock()
+        self._requests = {}
+        # 利用者のユーザID → リクエストIDの集合
+        self._by_user = {}
+        # channel:ts (旧データは username:テキストのハッシュ) → リクエストID
+        self._by_message = {}
+        # 反映済みの変更番号
+        self.version = None
+        # 読み込み直した回数
+        self.resyncs = 0
+        self._pubsub = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def __len__(self):
+        return len(self._requests)
+
+    def start(self):
+        """ 変更の購読を始めてから一括で読み込み、repo の読み込みにこの複製を使わせる
+
+        :rtype: PendingView
+        """
+        self._pubsub = self._repo._redis.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(self._repo.PENDING_CHANNEL_KEY)
+        self.resync()
+        self._thread = threading.Thread(target=self._run, name="pending-view", daemon=True)
+        self._thread.start()
+        self._repo.view = self
+        return self
+
+    def stop(self):
+        self._repo.view = None
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        if self._pubsub is not None:
+            self._pubsub.close()
+
+    def resync(self):
+        """ 未処理リクエストを Redis から読み込み直す
+
+        変更番号を先に読むため、読み込み中の変更は後から届く通知で (同じ内容で) もう一度反映される。
+        """
+        version = self._repo.pending_version()
+        requests = self._repo.load_new()
+        with self._lock:
+            self._requests = {}
+            self._by_user = {}
+            self._by_message = {}
+            for request in requests:
+                self._put(request)
+            self.version = version
+            self.resyncs += 1
+
+    def _message_key(self, request):
+        if request.ts:
+            return self._repo._message_field(request.channel, request.ts)
+        return self._repo._text_field(request.username, request.text)
+
+    def _put(self, request):
+        self._remove(request.id)
+        self._requests[request.id] = request
+        self._by_user.setdefault(request.user_id, set()).add(request.id)
+        self._by_message[self._message_key(request)] = request.id
+
+    def _remove(self, request_id):
+        request = self._requests.pop(request_id, None)
+        if request is None:
+            return
+        ids = self._by_user.get(request.user_id)
+        if ids is not None:
+            ids.discard(request_id)
+            if not ids:
+                del self._by_user[request.user_id]
+        key = self._message_key(request)
+        if self._by_message.get(key) == request_id:
+            del self._by_message[key]
+
+    def apply(self, version, change):
+        """ 変更番号 version の変更を反映する
+
+        :param int version: 変更番号
+        :param dict change: 変更内容
+        :rtype: bool
+        :return: 反映済みか反映した場合は True, 間の変更が届いていない場合は False
+        """
+        with self._lock:
+            if self.version is None or version <= self.version:
+                return True
+            if version != self.version + 1:
+                return False
+            if change["op"] == "put":
+                self._put(PurchaseRequest.from_hash(change["id"], change["r"]))
+            else:
+                for request_id in change["ids"]:
+                    self._remove(int(request_id))
+            self.version = version
+            return True
+
+    def _on_message(self, data):
+        version, payload = data.split(" ", 1)
+        if not self.apply(int(version), json.loads(payload)):
+            self._logger.info("pending view missed changes before {}, resyncing".format(version))
+            self.resync()
+
+    def _run(self):
+        checked = self._timer()
+        while not self._stop.is_set():
+            try:
+                message = self._pubsub.get_message(timeout=1.0)
+                if message is not None and message["type"] == "message":
+                    self._on_message(message["data"])
+                if self._timer() - checked >= self.resync_interval:
+                    checked = self._timer()
+                    if self._repo.pending_version() != self.version:
+                        self.resync()
+            except Exception:
+                # 接続が切れていた間の通知は届かないため、再接続後に読み込み直す
+                self._logger.exception("pending view subscription failed")
+                self._stop.wait(1.0)
+                try:
+                    self.resync()
+                except Exception:
+                    self._logger.exception("failed to resync pending view")
+
+    def new(self):
+        """ 未処理のリクエスト一覧を ID 順に返す
+
+        :rtype: list[PurchaseRequest]
+        """
+        with self._lock:
+            return [copy.copy(self._requests[request_id]) for request_id in sorted(self._requests)]
+
+    def get(self, request_id):
+        """ 未処理のリクエストを返す (未処理でない場合は None)
+
+        :rtype: (None|PurchaseRequest)
+        """
+        with self._lock:
+            request = self._requests.get(int(request_id))
+            return copy.copy(request) if request is not None else None
+
+    def by_user(self, user_id):
+        """ 利用者の未処理のリクエストを ID 順に返す
+
+        :rtype: list[PurchaseRequest]
+        """
+        with self._lock:
+            return [copy.copy(self._requests[request_id]) for request_id in sorted(self._by_user.get(user_id, ()))]
+
+    def find(self, username, text, channel=None, ts=None):
+        """ 投稿元のメッセージから未処理のリクエストを探す
+
+        :rtype: (None|PurchaseRequest)
+        """
+        keys = []
+        if ts:
+            keys.append(self._repo._message_field(channel, ts))
+        keys.append(self._repo._text_field(username, text))
+        with self._lock:
+            for key in keys:
+                request_id = self._by_message.get(key)
+                if request_id is not None:
+                    return copy.copy(self._requests[request_id])
+        return None
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+"""
+購入承認リクエストの集計と CSV への書き出し
+
+    $ python report.py --output purchases.csv                  # 全期間
+    $ python report.py --month 2018-04 --output 2018-04.csv    # 指定した月
+"""
+
+import argparse
+import os
+import sys
+
+from purchase_bot import report
+from purchase_bot.repo import PurchaseRepo, channel_namespace, connect_redis
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--month", help="集計する月 (YYYY-MM)")
+    parser.add_argument("--output", required=True, help="書き出す CSV ファイル")
+    parser.add_argument("--chunk-size", type=int, default=500, help="1 回に読み込むリクエスト数")
+    parser.add_argument("--channel", help="購入申請チャンネルのID (省略時は SLACK_CHANNEL_ID)")
+    args = parser.parse_args()
+
+    start = end = None
+    if args.month:
+        period = report.month_range(args.month)
+        if period is None:
+            parser.error("--month must be YYYY-MM")
+        start, end, _ = period
+
+    client = connect_redis()
+    legacy_channel = os.environ.get("SLACK_CHANNEL_ID")
+    channel = args.channel or legacy_channel
+    namespace = channel_namespace(client, channel) if channel == legacy_channel else channel
+    with open(args.output, "wb") as f:
+        result = report.export(PurchaseRepo(client, namespace=namespace), f, start, end, args.chunk_size)
+    print(result.summary(), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
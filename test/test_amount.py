@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_
+
+from purchase_bot.amount import parse_amount
+
+
+def test_parse_amount():
+    eq_(parse_amount("モニター ￥12,800"), (12800, 1))
+    eq_(parse_amount("USBケーブル 1280円 x3"), (1280, 3))
+    eq_(parse_amount("ペン ×１０ ５００円"), (500, 10))
+    eq_(parse_amount("本 2冊 3,000 円"), (3000, 2))
+    eq_(parse_amount("1.5万円のチェア"), (15000, 1))
+    # 金額の数字や英単語の一部は数量にしない
+    eq_(parse_amount("¥1,000,000"), (1000000, 1))
+    eq_(parse_amount("box3 100円"), (100, 1))
+    eq_(parse_amount("4K モニター 2台"), (None, 2))
+    eq_(parse_amount(""), (None, 1))
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import fakeredis
+from nose.tools import eq_
+
+from purchase_bot.archive import Archive, archive_closed
+from purchase_bot.model import PurchaseRequest, RequestStatus
+from purchase_bot.repo import PurchaseRepo
+
+
+def test_archive_closed():
+    archive = Archive(":memory:")
+    repo = PurchaseRepo(fakeredis.FakeStrictRedis(decode_responses=True), archive=archive)
+    for request_id in range(1, 5):
+        repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "alice", "item {}".format(request_id),
+                                              channel="C1", ts="{}.0".format(request_id)))
+    repo.approve(1, "admin")
+    repo.deny(2, "admin")
+    repo.approve(3, "admin")
+
+    eq_(archive_closed(repo, archive, days=30, batch_size=1, now=time.time() + 31 * 86400), 3)
+    eq_(len(archive), 3)
+    eq_(repo.get_approved(), [])
+    eq_(repo.get_denied(), [])
+    eq_([r.id for r in repo.get_new()], [4])
+    eq_(repo._redis.exists(repo.RECORD_KEY.format(1)), 0)
+
+    request, new = repo.get(2)
+    eq_((request.text, request.status, request.approver, request.ts, new),
+        ("item 2", RequestStatus.denied, "admin", "2.0", False))
+    eq_(repo.transition([1, 4, 9], RequestStatus.approved, "admin").handled, [1])
+    # 期限前のリクエストは移さない
+    eq_(archive_closed(repo, archive, days=30), 0)
+    eq_([r.id for r in repo.get_approved()], [4])
@@ -1,8 +1,15 @@
 # -*- coding: utf-8 -*-
 
+import random
+import time
+
 from nose.tools import eq_
 
-from purchase_bot.bot import get_request_id, VALID_ID_RANGE
+from fakes import FakeSlackClient, LatencyRedis
+from purchase_bot import metrics
+from purchase_bot.bot import COMMANDS, JOB_JOURNAL, PurchaseBot, get_request_id, parse_request_ids, VALID_ID_RANGE
+from purchase_bot.idset import IdSet
+from purchase_bot.repo import PurchaseRepo
 
 
 def test_get_request_id():
@@ -47,6 +54,346 @@ def test_get_request_id():
     eq_(ids, [])
     eq_(msg, 'WRONG_REQUEST 2-1 : ID1-ID2では、ID1はID2以下である必要があります。\n')
 
-    ids, msg = get_request_id('承認 1-100')
+    too_large = '1-{}'.format(VALID_ID_RANGE + 2)
+    ids, msg = get_request_id('承認 ' + too_large)
     eq_(ids, [])
-    eq_(msg, 'WRONG_REQUEST 1-100 : 一度に{}個より多くのIDは選択できません。\n'.format(VALID_ID_RANGE))
+    eq_(msg, 'WRONG_REQUEST {} : 一度に{}個より多くのIDは選択できません。\n'.format(too_large, VALID_ID_RANGE))
+
+
+
+def test_parse_request_ids():
+    selection = parse_request_ids('承認 1-300 !37 !100-199 <@U1> <@U2|bob>')
+    eq_(selection.ids.intervals(), [(1, 36), (38, 99), (200, 300)])
+    eq_(len(selection.ids), 199)
+    eq_(selection.excluded.intervals(), [(37, 37), (100, 199)])
+    eq_(selection.users, ['U1', 'U2'])
+    eq_(selection.message, '')
+
+    # 除外は順序によらず最後に適用する
+    eq_(parse_request_ids('承認 !5 1-10').ids.format(), '1-4, 6-10')
+    eq_(parse_request_ids('承認 !a').message, 'WRONG_REQUEST a: IDは整数でなければなりません。\n')
+
+
+def test_id_set_matches_set_model():
+    rng = random.Random(19)
+    for _ in range(200):
+        ids = IdSet()
+        model = set()
+        for _ in range(rng.randint(1, 20)):
+            start = rng.randint(0, 60)
+            end = start + rng.randint(-2, 15)
+            if rng.random() < 0.7:
+                ids.add(start, end)
+                model.update(range(start, end + 1))
+            else:
+                ids.discard(start, end)
+                model.difference_update(range(start, end + 1))
+        eq_(list(ids), sorted(model))
+        eq_(len(ids), len(model))
+        value = rng.randint(-1, 80)
+        eq_(value in ids, value in model)
+        intervals = ids.intervals()
+        # 区間は重ならず、隣り合う区間の間には隙間がある
+        eq_(all(a_end + 1 < b_start for (_, a_end), (b_start, _) in zip(intervals, intervals[1:])), True)
+        size = rng.randint(1, 7)
+        chunks = list(ids.chunks(size))
+        eq_([i for chunk in chunks for i in chunk], sorted(model))
+        eq_(all(len(chunk) == size for chunk in chunks[:-1]), True)
+
+
+def test_parse_large_range_benchmark():
+    # 範囲どうしが重ならないよう、1 つの範囲は間隔 (1000) より短くする
+    span = min(VALID_ID_RANGE, 999)
+    text = '承認 ' + ' '.join('{}-{}'.format(i * 1000, i * 1000 + span - 1) for i in range(200)) + \
+        ' ' + ' '.join('!{}'.format(i * 1000 + 7) for i in range(200))
+    started = time.perf_counter()
+    for _ in range(10):
+        selection = parse_request_ids(text)
+    elapsed = (time.perf_counter() - started) / 10
+    eq_(len(selection.ids), 200 * (span - 1))
+    # 範囲を展開しないため、10 万件近いIDの指定でも区間の数だけを持ち、範囲の大きさによらず速い
+    eq_(len(selection.ids.intervals()), 400)
+    eq_(elapsed < 0.05, True, "parse_request_ids took {:.3f}s".format(elapsed))
+
+
+def _make_bot():
+    client = FakeSlackClient()
+    bot = PurchaseBot(client=client, repo=PurchaseRepo(LatencyRedis()), purchase_channel='C1')
+    bot._outbox.min_interval = 0
+    bot.repo.add_admin('UADMIN')
+    return bot, client
+
+
+def test_username_cache_invalidated_on_user_change():
+    bot, client = _make_bot()
+    client.usernames['U1'] = 'alice'
+    eq_(bot._get_username('U1'), 'alice')
+    eq_(bot._get_username('U1'), 'alice')
+    eq_(client.counts['users.info'], 1)
+    eq_(bot._user_cache.stats()['hits'], 1)
+    lines = metrics.REGISTRY.render().splitlines()
+    eq_('purchase_bot_cache_lookups{cache="users",channel="C1",result="hit"} 1' in lines, True)
+
+    client.usernames['U1'] = 'alice2'
+    bot._handle_message({'type': 'user_change', 'user': {'id': 'U1', 'name': 'alice2'}})
+    eq_(bot._get_username('U1'), 'alice2')
+    eq_(client.counts['users.info'], 2)
+
+
+def test_shared_username_cache():
+    redis = LatencyRedis()
+    clients = [FakeSlackClient(), FakeSlackClient()]
+    bots = [PurchaseBot(client=client, repo=PurchaseRepo(redis), purchase_channel='C1') for client in clients]
+    for bot in bots:
+        bot._share_user_cache = True
+    clients[0].usernames['U1'] = 'alice'
+    eq_(bots[0]._get_username('U1'), 'alice')
+    # 他のボットが Redis に保存したユーザ名を使う
+    eq_(bots[1]._get_username('U1'), 'alice')
+    eq_([client.counts['users.info'] for client in clients], [1, 0])
+
+    # 変更の通知を受けたボットは共有キャッシュからも削除する
+    clients[0].usernames['U1'] = clients[1].usernames['U1'] = 'alice2'
+    bots[0]._handle_message({'type': 'user_change', 'user': {'id': 'U1', 'name': 'alice2'}})
+    eq_(redis.get(bots[0].repo.USERNAME_KEY.format('U1')), None)
+    bots[1]._user_cache.invalidate('U1')
+    eq_(bots[1]._get_username('U1'), 'alice2')
+    eq_(clients[1].counts['users.info'], 1)
+
+
+class StaleChannelSlackClient(FakeSlackClient):
+    """ 閉じられた DM チャンネルへの投稿に channel_not_found を返す """
+
+    def __init__(self, stale):
+        super().__init__()
+        self.stale = set(stale)
+
+    def api_call(self, method, **kwargs):
+        result = super().api_call(method, **kwargs)
+        if method == "chat.postMessage" and kwargs.get("channel") in self.stale:
+            return {"ok": False, "error": "channel_not_found"}
+        return result
+
+
+def test_direct_message_channel_cache():
+    bot, client = _make_bot()
+    bot._send_direct_message('U1', 'a')
+    bot._send_direct_message('U1', 'b')
+    # 2 通目はキャッシュした DM チャンネルに送る
+    eq_(client.counts['im.open'], 1)
+    eq_([p['channel'] for p in client.sent('chat.postMessage')], ['DU1', 'DU1'])
+
+    client = StaleChannelSlackClient(['DOLD'])
+    bot = PurchaseBot(client=client, repo=PurchaseRepo(LatencyRedis()), purchase_channel='C1')
+    bot._im_channels['U1'] = 'DOLD'
+    bot._send_direct_message('U1', 'c')
+    # channel_not_found の場合は im.open で取得し直して 1 度だけ送り直す
+    eq_(client.counts['im.open'], 1)
+    eq_([p['channel'] for p in client.sent('chat.postMessage')], ['DOLD', 'DU1'])
+    eq_(bot._im_channels['U1'], 'DU1')
+
+
+def test_shared_direct_message_channel_cache():
+    redis = LatencyRedis()
+    clients = [FakeSlackClient(), FakeSlackClient()]
+    bots = [PurchaseBot(client=client, repo=PurchaseRepo(redis), purchase_channel='C1') for client in clients]
+    for bot in bots:
+        bot._share_im_cache = True
+    bots[0]._send_direct_message('U1', 'a')
+    bots[1]._send_direct_message('U1', 'b')
+    # 他のボットが Redis に保存した DM チャンネルを使う
+    eq_([client.counts['im.open'] for client in clients], [1, 0])
+    eq_(clients[1].sent('chat.postMessage')[0]['channel'], 'DU1')
+
+
+def test_approve_command():
+    bot, client = _make_bot()
+    for i in range(1, 4):
+        bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'item {}'.format(i),
+                             'ts': '{}.0'.format(i)})
+    client.calls.clear()
+    bot.repo._redis.reset_stats()
+
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '承認 1-2 5'})
+    eq_([r.id for r in bot.repo.get_approved()], [1, 2])
+    posts = client.sent('chat.postMessage')
+    eq_(len([p for p in posts if p['channel'] == 'C1']), 2)
+    eq_([p['text'] for p in posts if p['channel'] == 'DUADMIN'],
+        ['ID: 1 を承認しました\nID: 2 を承認しました\nID: 5 が見つかりません'])
+    # 承認処理は 1 回のスクリプト呼び出しで行う (他の 2 回はジャーナルへの記録と完了)
+    eq_(bot.repo._redis.commands['EVALSHA'], 3)
+
+
+def test_report_command():
+    bot, client = _make_bot()
+    for i in range(1, 4):
+        bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'item {}'.format(i),
+                             'ts': '{}.0'.format(i)})
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '承認 1'})
+
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': 'レポート'})
+    uploads = client.sent('files.upload')
+    eq_(len(uploads), 1)
+    eq_(uploads[0]['channels'], 'DUADMIN')
+    eq_(uploads[0]['filename'], 'purchases-all.csv')
+    eq_(len(uploads[0]['file'].decode('utf-8-sig').splitlines()), 4)
+    eq_(uploads[0]['initial_comment'].splitlines()[0], '合計: 3 件')
+
+
+def test_search_command():
+    bot, client = _make_bot()
+    for i, text in enumerate(['モニター', 'キーボード', 'モニターアーム'], 1):
+        bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': text, 'ts': '{}.0'.format(i)})
+    client.calls.clear()
+
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '検索 ﾓﾆﾀｰ'})
+    text = client.sent('chat.postMessage')[-1]['text']
+    eq_(text.splitlines()[0], '「モニター」の検索結果 (1ページ目)')
+    eq_([line.split(',')[0] for line in text.splitlines() if line.startswith('[')], ['[未承認] ID: 3', '[未承認] ID: 1'])
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '検索 モニター #2'})
+    eq_(client.sent('chat.postMessage')[-1]['text'], '「モニター」に当てはまる購入承認リクエストはありません')
+
+
+def test_spend_command():
+    bot, client = _make_bot()
+    for i, text in enumerate(['モニター ¥30,000', 'ケーブル 500円 x2', 'マウス'], 1):
+        bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U{}'.format(i % 2), 'text': text,
+                             'ts': '{}.0'.format(i)})
+    eq_(bot.repo.get(2)[0].amount, 500)
+    eq_(bot.repo.get(2)[0].quantity, 2)
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '承認 1-3'})
+    bot.repo._redis.reset_stats()
+
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '支出 <@U1>'})
+    eq_(client.sent('chat.postMessage')[-1]['text'], '<@U1> の承認済みの合計: ¥30,000, 未処理の合計: ¥0')
+    # 合計は HMGET で読むだけで、リクエストを読み込まない
+    eq_(bot.repo._redis.commands['HGETALL'], 0)
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '支出'})
+    lines = client.sent('chat.postMessage')[-1]['text'].splitlines()
+    eq_(lines[0], '承認済みの合計: ¥31,000')
+    eq_(lines[-1], '未処理の合計: ¥0 (0人)')
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '支出 2000-01'})
+    eq_(client.sent('chat.postMessage')[-1]['text'], '2000-01 の承認済みの合計: ¥0')
+
+
+def test_scheduled_reminders():
+    bot, client = _make_bot()
+    bot._escalation_users = ['UBOSS']
+    # ジャーナルの確認は test_replay_stale_journal で扱う
+    bot.repo.unschedule(JOB_JOURNAL)
+    for i in range(1, 3):
+        bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'item {}'.format(i),
+                             'ts': '{}.0'.format(i)})
+    # イベントの処理中には通知しない
+    eq_(client.sent('chat.postMessage'), [])
+    now = time.time()
+    eq_(bot.scheduler.run_pending(now + 60), 1)
+    eq_(client.sent('chat.postMessage')[-1]['text'].splitlines()[0], '新しい購入承認リクエストが 2件あります。')
+
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '承認 1'})
+    client.calls.clear()
+    bot.scheduler.run_pending(now + 25 * 3600)
+    texts = [(p['channel'], p['text'].splitlines()[0]) for p in client.sent('chat.postMessage')]
+    eq_(texts, [('DUADMIN', '承認待ちが 24時間を過ぎた購入承認リクエストが 1件あります。')])
+    # 未処理のリクエストだけ次の催促を予定する
+    eq_(bot.repo.claim_jobs(now + 50 * 3600, 10), [('remind:2', now + 49 * 3600)])
+
+    client.calls.clear()
+    bot.scheduler.run_pending(now + 73 * 3600)
+    eq_([(p['channel'], p['text'].splitlines()[0]) for p in client.sent('chat.postMessage')],
+        [('DUBOSS', '72時間以上承認されていない購入承認リクエストが 1件あります。')])
+
+
+def test_command_router():
+    eq_(COMMANDS.match('承認者登録').name, '承認者登録')
+    eq_(COMMANDS.match('承認 1-3').name, '承認')
+    # 文字列中のコマンドは先頭一致のコマンドより優先する
+    eq_(COMMANDS.match('承認 使い方').name, '使い方')
+    eq_(COMMANDS.match('未承認の一覧').name, '未承認')
+    eq_(COMMANDS.match('こんにちは 承認'), None)
+
+    bot, client = _make_bot()
+    bot._handle_message({'type': 'message', 'channel': 'DU1', 'user': 'U1', 'text': '承認 1'})
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': 'こんにちは'})
+    # 承認者以外や不明なコマンドではユーザ名を調べない
+    eq_(client.counts['users.info'], 0)
+    eq_([p['text'] for p in client.sent('chat.postMessage')],
+        ['承認者以外は利用できません', '不明なコマンドです: こんにちは'])
+    # 計測のラベルは実行したコマンドの名前 (当てはまらない場合は unknown)
+    lines = metrics.REGISTRY.render().splitlines()
+    labels = [line.split('"')[1] for line in lines if line.startswith('purchase_bot_command_seconds_count')]
+    eq_('承認' in labels and 'unknown' in labels, True)
+
+
+def test_close_requests_with_selectors():
+    bot, client = _make_bot()
+    for i in range(1, 6):
+        user = 'U1' if i % 2 else 'U2'
+        bot._handle_message({'type': 'message', 'channel': 'C1', 'user': user, 'text': 'item {}'.format(i),
+                             'ts': '{}.0'.format(i)})
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': '承認 1'})
+    client.calls.clear()
+
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN',
+                         'text': '却下 <@U1> !5 1-2 8-9'})
+    eq_([r.id for r in bot.repo.get_denied()], [2, 3])
+    eq_([r.id for r in bot.repo.get_new()], [4, 5])
+    eq_([p['text'] for p in client.sent('chat.postMessage') if p['channel'] == 'DUADMIN'],
+        ['ID: 2 を却下しました\nID: 3 を却下しました\nID: 1 は既に対応済みです\nID: 8-9 が見つかりません'])
+
+
+def test_close_requests_limits_total_ids():
+    bot, client = _make_bot()
+    bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'item 1', 'ts': '1.0'})
+    client.calls.clear()
+    bot.repo._redis.reset_stats()
+
+    # 1 つずつは上限内の範囲でも、合わせて VALID_ID_RANGE 個を超える指定は受け付けない
+    span = VALID_ID_RANGE // 2 + 1
+    text = '承認 1-{} {}-{}'.format(span, span + 1, span * 2)
+    bot._handle_message({'type': 'message', 'channel': 'DADMIN', 'user': 'UADMIN', 'text': text})
+    eq_([r.id for r in bot.repo.get_new()], [1])
+    eq_(bot.repo._redis.commands['EVALSHA'], 2)
+    eq_([p['text'] for p in client.sent('chat.postMessage')],
+        ['WRONG_REQUEST : 一度に{}個より多くのIDは選択できません。'.format(VALID_ID_RANGE)])
+
+
+def test_catch_up():
+    bot, client = _make_bot()
+    bot._handle_message({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'item 1', 'ts': '1.0'})
+    eq_(bot.repo.journal_cursor(), '1.0')
+
+    # 処理の途中で終了したイベント
+    bot.repo.journal_append({'type': 'message', 'channel': 'C1', 'user': 'U2', 'text': 'item 2', 'ts': '2.0'})
+    # 停止中の投稿 (処理済みの投稿やボットの投稿も含まれる)
+    client.history = [
+        {'type': 'message', 'user': 'U1', 'text': 'item 1', 'ts': '1.0'},
+        {'type': 'message', 'user': 'U2', 'text': 'item 2', 'ts': '2.0'},
+        {'type': 'message', 'user': 'U3', 'text': 'item 3', 'ts': '3.0', 'thread_ts': '3.0'},
+        {'type': 'message', 'subtype': 'bot_message', 'text': 'posted', 'ts': '3.5'},
+    ]
+    client.calls.clear()
+    bot.catch_up()
+    eq_([(r.id, r.text) for r in bot.repo.get_new()], [(1, 'item 1'), (2, 'item 2'), (3, 'item 3')])
+    # 登録済みの投稿 (item 1) にはリアクションを付け直さない
+    eq_([c['timestamp'] for c in client.sent('reactions.add')], ['2.0', '3.0'])
+    eq_(bot.repo.journal_pending(), [])
+    eq_(bot.repo.journal_cursor(), '3.0')
+
+    bot.catch_up()
+    eq_(len(bot.repo.get_new()), 3)
+
+
+def test_replay_stale_journal():
+    bot, client = _make_bot()
+    now = time.time()
+    # 処理の途中で終了した他のワーカーのイベントと、処理中のイベント
+    stale = bot.repo.journal_append({'type': 'message', 'channel': 'C1', 'user': 'U1', 'text': 'item 1', 'ts': '1.0'})
+    bot.repo._redis.zadd(bot.repo.JOURNAL_PENDING_KEY, {stale: now - 600})
+    bot.repo.journal_append({'type': 'message', 'channel': 'C1', 'user': 'U2', 'text': 'item 2', 'ts': '2.0'})
+
+    eq_(bot.scheduler.run_pending(now + 60), 1)
+    eq_([r.text for r in bot.repo.get_new()], ['item 1'])
+    eq_(len(bot.repo.journal_pending()), 1)
+    # 次の確認を予定する
+    eq_(bot.repo._redis.zscore(bot.repo.SCHEDULE_KEY, JOB_JOURNAL), now + 120)
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_
+
+from purchase_bot.cache import TTLCache
+
+
+def test_ttl_cache():
+    now = [0.0]
+    cache = TTLCache(maxsize=2, ttl=10, timer=lambda: now[0])
+    cache.set("U1", "alice")
+    cache.set("U2", "bob")
+    eq_(cache.get("U1"), "alice")
+    # U2 が最も古く使われたので追い出される
+    cache.set("U3", "carol")
+    eq_(cache.get("U2"), None)
+    now[0] = 11
+    eq_(cache.get("U1"), None)
+    cache.set("U1", "alice")
+    cache.invalidate("U1")
+    eq_(cache.get("U1"), None)
+    eq_(cache.stats(), {"hits": 1, "misses": 3, "size": 1})
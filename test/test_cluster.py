@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_
+
+from fakes import LatencyRedis
+from purchase_bot.cluster import Coordinator
+from purchase_bot.repo import PurchaseRepo
+
+
+def test_claim_and_leader():
+    now = [0.0]
+    client = LatencyRedis()
+    first = Coordinator(PurchaseRepo(client), worker_id="w1", lease_ttl=30, timer=lambda: now[0])
+    second = Coordinator(PurchaseRepo(client), worker_id="w2", lease_ttl=30, timer=lambda: now[0])
+
+    message = {"type": "message", "channel": "C1", "user": "U1", "text": "本", "ts": "1.0"}
+    eq_(first.claim(message), True)
+    eq_(second.claim(message), False)
+    eq_(second.claim({"type": "user_change", "user": {"id": "U1"}}), True)
+
+    eq_(first.is_leader(), True)
+    eq_(second.is_leader(), False)
+    # リーダーが延長しなければ、有効期限後に他のワーカーが引き継ぐ
+    client.delete("purchase:lease:leader")
+    now[0] = 10
+    eq_(second.is_leader(), True)
+    eq_(first.is_leader(), False)
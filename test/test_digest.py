@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_
+
+from purchase_bot import digest
+from purchase_bot.model import PurchaseRequest
+
+
+def test_diff():
+    requests = [PurchaseRequest(1, "U1", "alice", "本"), PurchaseRequest(2, "U2", "bob", "ペン 2本"),
+                PurchaseRequest(4, "U1", "alice", "机")]
+    notified = {"1": digest.fingerprint(requests[0]), "2": digest.fingerprint(PurchaseRequest(2, "U2", "bob", "ペン")),
+                "3": "0"}
+    added, edited, withdrawn = digest.diff(notified, requests)
+    eq_([r.id for r in added], [4])
+    eq_([r.id for r in edited], [2])
+    eq_(withdrawn, [3])
+    eq_(digest.delta_digest([], [], []), [])
+
+
+def test_paginate():
+    eq_(digest.paginate(["a\n", "b\n"], limit=10), ["a\nb\n"])
+    eq_(digest.paginate(["aaaa", "bbbb", "cc"], limit=8), ["aaaabbbb(1/2)", "cc(2/2)"])
+    requests = [PurchaseRequest(i, "U1", "alice", "x" * 100) for i in range(1, 101)]
+    pages = digest.full_digest(requests)
+    eq_(len(pages), 5)
+    eq_(sum(page.count("-----") for page in pages), 100)
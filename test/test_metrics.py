@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+
+import urllib.request
+
+from nose.tools import eq_
+
+from purchase_bot import metrics
+
+
+def test_histogram_render():
+    registry = metrics.Registry()
+    histogram = metrics.Histogram("test_seconds", "Test.", ["method"], buckets=(0.1, 1.0), registry=registry)
+    histogram.labels("a").observe(0.05)
+    histogram.labels("a").observe(0.5)
+    histogram.labels("a").observe(5)
+    counter = metrics.Counter("test_total", "Test.", ["error"], registry=registry)
+    counter.labels('quo"te').inc(2)
+    lines = registry.render().splitlines()
+    eq_(lines[2:7], ['test_seconds_bucket{method="a",le="0.1"} 1',
+                     'test_seconds_bucket{method="a",le="1.0"} 2',
+                     'test_seconds_bucket{method="a",le="+Inf"} 3',
+                     'test_seconds_sum{method="a"} 5.55',
+                     'test_seconds_count{method="a"} 3'])
+    eq_(lines[-1], 'test_total{error="quo\\"te"} 2')
+
+
+def test_http_server():
+    registry = metrics.Registry()
+    metrics.Gauge("test_depth", "Test.", ["queue"], registry=registry).labels("events").set_function(lambda: 7)
+    # 既定ではローカルホストだけで待ち受ける
+    server = metrics.start_http_server(0, registry=registry)
+    try:
+        eq_(server.server_address[0], "127.0.0.1")
+        url = "http://127.0.0.1:{}/metrics".format(server.server_address[1])
+        body = urllib.request.urlopen(url).read().decode("utf-8")
+        eq_(body.splitlines()[-1], 'test_depth{queue="events"} 7')
+    finally:
+        server.shutdown()
+        server.server_close()
+
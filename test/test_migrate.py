@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_
+
+from fakes import LatencyRedis
+from purchase_bot.archive import Archive, archive_closed
+from purchase_bot.migrate import compare_layouts, migrate, move_to_namespace
+from purchase_bot.model import PurchaseRequest, RequestStatus
+from purchase_bot.repo import PurchaseRepo, channel_namespace
+
+
+def test_migrate():
+    client = LatencyRedis()
+    repo = PurchaseRepo(client)
+    client.delete(repo.SCHEMA_KEY)
+    client.set(repo.ID_KEY, 2)
+    repo.refresh_schema()
+    client.set(repo.ITEM_KEY.format(1), '{"id": 1, "username": "alice", "text": "本"}')
+    client.sadd(repo.LEGACY_NEW_KEY, repo.ITEM_KEY.format(1))
+    client.set(repo.ITEM_KEY.format(2), '{"id": 2, "user_id": "U2", "username": "bob", "text": "ペン", '
+                                        '"channel": "C1", "ts": "2.0"}')
+    client.set(repo.ITEM_ADMIN_KEY.format(2), "admin")
+    client.sadd(repo.LEGACY_APPROVED_KEY, repo.ITEM_KEY.format(2))
+    eq_(repo.backfill_status_index(), 2)
+    before = [(r.id, r.username, r.text, r.status, r.approver) for r in repo.get_all()]
+
+    eq_(migrate(repo, batch_size=1), 2)
+    eq_(client.exists(repo.ITEM_KEY.format(1), repo.ITEM_KEY.format(2), repo.ITEM_ADMIN_KEY.format(2)), 0)
+    eq_(repo.legacy_reads, False)
+    eq_([(r.id, r.username, r.text, r.status, r.approver) for r in repo.get_all()], before)
+    eq_(repo.get(2)[0].ts, "2.0")
+    eq_(repo.get(1)[1], True)
+    eq_(repo.transition([1], RequestStatus.denied, "admin").changed[0].username, "alice")
+    eq_(migrate(repo), 0)
+
+
+def test_move_to_namespace():
+    client = LatencyRedis()
+    archive = Archive(":memory:")
+    repo = PurchaseRepo(client, archive=archive)
+    other = PurchaseRepo(client, namespace="C2")
+    for text, amount in (("本", 1000), ("ペン", 200), ("ノート", None)):
+        repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "alice", text, channel="C1", ts=text,
+                                              amount=amount))
+    other.create_or_update(PurchaseRequest(other.get_id(), "U2", "bob", "机", channel="C2", ts="1.0"))
+    repo.add_admin("UADMIN")
+    repo.transition([1], RequestStatus.approved, "admin")
+    archive_closed(repo, archive, 0, now=repo.get(1)[0].closed + 1)
+    eq_(channel_namespace(client, "C1"), None)
+
+    eq_(move_to_namespace(client, "C1", batch_size=2, archive=archive) > 0, True)
+    # 他の名前空間のキーはそのままで、以前のキーは全てハッシュタグ付きのキーに移る
+    eq_(sorted({key.split(":")[1] for key in client.keys("purchase:*")}), ["{C1}", "{C2}"])
+    eq_(channel_namespace(client, "C1"), "C1")
+    moved = PurchaseRepo(client, archive=archive, namespace="C1")
+    eq_([(r.id, r.text) for r in moved.get_new()], [(2, "ペン"), (3, "ノート")])
+    eq_(moved.get(1)[0].approver, "admin")
+    eq_(moved.admin, frozenset(["UADMIN"]))
+    eq_(moved.get_spend("pending"), {"U1": 200})
+    eq_([r.id for r in moved.search("ノート", 10).requests], [3])
+    eq_(moved.get_id(), 4)
+    eq_([r.id for r in other.get_new()], [1])
+
+
+def test_compare_layouts():
+    result = compare_layouts(PurchaseRepo(LatencyRedis()), 30)
+    eq_(result["legacy"]["keys"], 54)
+    # ハッシュ形式では承認者のキーが無くなる (保存形式のバージョンのキーが 1 つ増える)
+    eq_(result["compact"]["keys"], 35)
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+
+import threading
+
+from nose.tools import eq_
+
+from purchase_bot.outbox import Outbox
+
+
+class Recorder:
+
+    def __init__(self):
+        self.directs = []
+        self.posts = []
+        self.sleeps = []
+        self.now = 0.0
+
+    def send_direct(self, user_id, text):
+        self.directs.append((user_id, text))
+
+    def post_channel(self, text, attachments):
+        self.posts.append((text, attachments))
+        return {"ok": True}
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def _make_outbox(recorder, **kwargs):
+    return Outbox(recorder.send_direct, recorder.post_channel,
+                  timer=lambda: recorder.now, sleep=recorder.sleep, **kwargs)
+
+
+def test_coalesce_directs():
+    recorder = Recorder()
+    outbox = _make_outbox(recorder)
+    with outbox.batch() as batch:
+        for request_id in range(1, 4):
+            batch.announce("req {}".format(request_id), "good", "approved")
+            batch.direct("U1", "ID: {} を承認しました".format(request_id))
+        batch.direct("U1", "")
+    eq_(recorder.directs, [("U1", "ID: 1 を承認しました\nID: 2 を承認しました\nID: 3 を承認しました")])
+    eq_(len(recorder.posts), 3)
+    # 2 件目以降は最小間隔を空けて投稿する
+    eq_(recorder.sleeps, [1.0, 1.0])
+
+
+def test_merge_announcements():
+    recorder = Recorder()
+    outbox = _make_outbox(recorder, merge_announcements=True)
+    with outbox.batch() as batch:
+        batch.announce("req 1", "good", "approved")
+        batch.announce("req 2", "danger", "denied")
+    eq_(len(recorder.posts), 1)
+    eq_([a["pretext"] for a in recorder.posts[0][1]], ["req 1", "req 2"])
+    eq_(outbox.depth, 0)
+
+
+def test_merge_above_threshold():
+    recorder = Recorder()
+    outbox = _make_outbox(recorder, merge_threshold=2)
+    with outbox.batch() as batch:
+        for request_id in range(1, 3):
+            batch.announce("req {}".format(request_id), "good", "approved")
+    eq_(len(recorder.posts), 2)
+    with outbox.batch() as batch:
+        for request_id in range(1, 501):
+            batch.announce("req {}".format(request_id), "good", "approved")
+    # 500 件の投稿は 100 件ずつの 5 件にまとまる
+    eq_([len(attachments) for _, attachments in recorder.posts[2:]], [100] * 5)
+
+
+def test_directs_are_not_blocked_by_paced_posts():
+    recorder = Recorder()
+    outbox = _make_outbox(recorder)
+    sent = []
+
+    def sleep(seconds):
+        # 1 件目のバッチが投稿の間隔を待っている間に、別のコマンドの DM を送る
+        if not sent:
+            thread = threading.Thread(target=outbox.send, args=(other,))
+            thread.start()
+            thread.join(timeout=1.0)
+            sent.append(list(recorder.directs))
+        recorder.sleep(seconds)
+
+    outbox._sleep = sleep
+    other = outbox.batch()
+    other.direct("U2", "ID: 9 は既に対応済みです")
+    with outbox.batch() as batch:
+        for request_id in range(1, 3):
+            batch.announce("req {}".format(request_id), "good", "approved")
+        batch.direct("U1", "ID: 1-2 を承認しました")
+    eq_(sent, [[("U1", "ID: 1-2 を承認しました"), ("U2", "ID: 9 は既に対応済みです")]])
+    eq_(len(recorder.posts), 2)
+
+
+class RateLimitedRecorder(Recorder):
+
+    def post_channel(self, text, attachments):
+        self.posts.append((text, attachments))
+        return {"ok": False, "error": "ratelimited"}
+
+
+def test_rate_limited_post_is_not_resent():
+    recorder = RateLimitedRecorder()
+    outbox = _make_outbox(recorder)
+    with outbox.batch() as batch:
+        batch.announce("req 1", "good", "approved")
+    # 再送は RateLimitedSlackClient に任せる
+    eq_(len(recorder.posts), 1)
+    eq_(recorder.sleeps, [])
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import fakeredis
+from nose.tools import eq_
+
+from purchase_bot.migrate import migrate
+from purchase_bot.model import PurchaseRequest, RequestStatus
+from purchase_bot.repo import SPEND_APPROVER, SPEND_MONTH, SPEND_PENDING, SPEND_USER, PurchaseRepo
+
+
+def _make_repo(chunk_size=None):
+    return PurchaseRepo(fakeredis.FakeStrictRedis(decode_responses=True), chunk_size=chunk_size)
+
+
+def _create(repo, count):
+    for _ in range(count):
+        request_id = repo.get_id()
+        repo.create_or_update(PurchaseRequest(request_id, "U{}".format(request_id),
+                                              "user{}".format(request_id), "item {}".format(request_id)))
+
+
+def test_get_list_chunked():
+    repo = _make_repo(chunk_size=4)
+    _create(repo, 10)
+    repo.approve(3, "admin")
+    repo.deny(5, "admin")
+
+    repo.round_trips = 0
+    requests = repo.get_new()
+    eq_([r.id for r in requests], [1, 2, 4, 6, 7, 8, 9, 10])
+    # ZRANGE 1 回 + 8 件を 4 件ずつ 2 回
+    eq_(repo.round_trips, 3)
+
+    repo.round_trips = 0
+    requests = repo.get_all()
+    eq_([r.id for r in requests], list(range(1, 11)))
+    eq_(requests[2].status, RequestStatus.approved)
+    eq_(requests[2].approver, "admin")
+    eq_(requests[4].status, RequestStatus.denied)
+    eq_(requests[0].approver, "")
+    # ZRANGE 3 回を 1 パイプライン + 8 件で 2 回 + 承認/却下各 1 回
+    eq_(repo.round_trips, 5)
+
+
+def test_update_and_delete_by_message_index():
+    repo = _make_repo()
+    request_id = repo.get_id()
+    repo.create_or_update(PurchaseRequest(request_id, "U1", "alice", "本", channel="C1", ts="100.1"))
+    # 旧形式 (channel / ts なし) のリクエスト
+    repo._redis.delete(repo.SCHEMA_KEY)
+    repo.refresh_schema()
+    repo._redis.set(repo.ITEM_KEY.format(2), '{"id": 2, "username": "bob", "text": "ペン"}')
+    repo._redis.sadd(repo.LEGACY_NEW_KEY, repo.ITEM_KEY.format(2))
+    eq_(repo.backfill_status_index(), 1)
+    eq_(repo.backfill_index(), 2)
+    eq_(repo.backfill_index(), 0)
+
+    eq_(repo.update("alice", "本", "本 2冊", "C1", "100.1"), True)
+    eq_(repo.get(request_id)[0].text, "本 2冊")
+    eq_(repo.update("alice", "本", "本 3冊", "C1", "999.9"), False)
+
+    # 旧形式はユーザ名とテキストで引き、更新後は ts で引ける
+    eq_(repo.update("bob", "ペン", "赤ペン", "C1", "200.2"), True)
+    eq_(repo.find_new("bob", "赤ペン", "C1", "200.2").id, 2)
+    eq_(repo._redis.hlen(repo.TEXT_INDEX_KEY), 0)
+
+    repo.approve(request_id, "admin")
+    eq_(repo.find_new("alice", "本 2冊", "C1", "100.1"), None)
+    eq_(repo.delete("bob", "赤ペン", "C1", "200.2"), True)
+    eq_(repo.get(2), (None, False))
+    eq_(repo._redis.hlen(repo.MESSAGE_INDEX_KEY), 0)
+
+
+def test_transition():
+    repo = _make_repo()
+    _create(repo, 3)
+    repo.approve(2, "admin1")
+
+    repo.delete("user3", "item 3")
+    result = repo.transition([1, 2, 3], RequestStatus.denied, "admin2")
+    eq_([r.id for r in result.changed], [1])
+    eq_(result.changed[0].approver, "admin2")
+    eq_(result.handled, [2])
+    eq_(result.missing, [3])
+    eq_(repo.get_approver(2), "admin1")
+    eq_([r.id for r in repo.get_denied()], [1])
+    eq_(repo.get_new(), [])
+    eq_(repo._redis.hlen(repo.TEXT_INDEX_KEY), 0)
+
+
+def test_paginated_queries():
+    repo = _make_repo()
+    _create(repo, 7)
+    repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "user1", "item 8"))
+    # 一度に承認したリクエストは承認日時が同じになる
+    repo.transition([2, 3, 4], RequestStatus.approved, "admin")
+    repo.approve(6, "admin")
+
+    repo.round_trips = 0
+    page = repo.oldest_new(2)
+    eq_([r.id for r in page.requests], [1, 5])
+    # ZRANGEBYSCORE 1 回 + 2 件の取得 1 回
+    eq_(repo.round_trips, 2)
+    page = repo.oldest_new(2, page.cursor)
+    eq_([r.id for r in page.requests], [7, 8])
+    eq_(repo.oldest_new(2, page.cursor), ([], None))
+
+    ids = []
+    cursor = None
+    while True:
+        page = repo.closed_between(RequestStatus.approved, 0, time.time() + 1, 2, cursor)
+        ids += [r.id for r in page.requests]
+        cursor = page.cursor
+        if cursor is None:
+            break
+    eq_(ids, [2, 3, 4, 6])
+    eq_(repo.closed_between(RequestStatus.approved, 0, 1, 10).requests, [])
+
+    page = repo.by_user("U1", 10)
+    eq_([(r.id, r.status) for r in page.requests], [(1, RequestStatus.new), (8, RequestStatus.new)])
+    eq_(page.cursor, None)
+    repo.delete("user1", "item 8")
+    eq_([r.id for r in repo.by_user("U1", 10).requests], [1])
+
+
+def test_search():
+    repo = _make_repo()
+    for text in ["4Kモニター 2台", "ｷｰﾎﾞｰﾄﾞ", "モニターアーム", "USB ケーブル"]:
+        repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "alice", text))
+    repo.approve(1, "admin")
+
+    # 全角・半角と大文字・小文字を区別せず、当てはまった検索語の多い順、同じなら新しい順
+    eq_([r.id for r in repo.search("モニター 4k", 10).requests], [1, 3])
+    eq_([r.id for r in repo.search("キーボード", 10).requests], [2])
+    eq_(repo.search("モニター", 10).requests[1].status, RequestStatus.approved)
+    page = repo.search("ALICE", 3)
+    eq_([r.id for r in page.requests], [4, 3, 2])
+    eq_([r.id for r in repo.search("alice", 3, page.cursor).requests], [1])
+    # 1 文字の検索語は引けない
+    eq_(repo.search("台", 10), ([], None))
+
+    repo.update("alice", "モニターアーム", "デスクライト")
+    eq_([r.id for r in repo.search("モニター", 10).requests], [1])
+    eq_([r.id for r in repo.search("ライト", 10).requests], [3])
+    repo.delete("alice", "デスクライト")
+    eq_(repo.search("ライト", 10).requests, [])
+
+
+def test_spend():
+    repo = _make_repo()
+    # 集計の導入前のリクエスト
+    repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "alice", "モニター ¥30,000"))
+    repo.create_or_update(PurchaseRequest(repo.get_id(), "U2", "bob", "ケーブル 500円 x2"))
+    repo.approve(1, "admin")
+    eq_(repo.get_spend(SPEND_USER), {})
+    eq_(repo.backfill_spend(), 2)
+    eq_(repo.backfill_spend(), 0)
+    month = repo._spend_month(repo.get(1)[0].closed)
+    eq_(repo.get_spend(SPEND_USER), {"U1": 30000})
+    eq_(repo.get_spend(SPEND_PENDING), {"U2": 1000})
+    eq_(repo.get(2)[0].total, 1000)
+
+    repo.create_or_update(PurchaseRequest(repo.get_id(), "U2", "bob", "マウス 2,000円", amount=2000, channel="C1", ts="3.0"))
+    eq_(repo.get_spend(SPEND_PENDING, "U2", "U3"), {"U2": 3000, "U3": 0})
+    # 変更・削除は未処理の合計に反映する
+    eq_(repo.update("bob", "マウス 2,000円", "マウス 2,000円 x2", "C1", "3.0"), True)
+    eq_(repo.get_spend(SPEND_PENDING, "U2")["U2"], 5000)
+    eq_(repo.delete("bob", "ケーブル 500円 x2"), True)
+    eq_(repo.get_spend(SPEND_PENDING), {"U2": 4000})
+    repo.deny(3, "admin")
+    eq_(repo.get_spend(SPEND_PENDING), {})
+
+    repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "alice", "キーボード", amount=8000, quantity=2))
+    repo.transition([4], RequestStatus.approved, "admin2")
+    eq_(repo.get_spend(SPEND_USER), {"U1": 46000})
+    eq_(repo.get_spend(SPEND_APPROVER), {"admin": 30000, "admin2": 16000})
+    eq_(repo.get_spend(SPEND_MONTH, month), {month: 46000})
+    # 承認済みのリクエストを削除しようとしても合計は変わらない
+    eq_(repo.delete("alice", "キーボード"), False)
+    eq_(repo.get_spend(SPEND_USER), {"U1": 46000})
+
+
+def test_spend_with_legacy_requests():
+    repo = _make_repo()
+    repo._redis.delete(repo.SCHEMA_KEY)
+    repo._redis.set(repo.ID_KEY, 3)
+    repo.refresh_schema()
+    for request_id, text in ((1, "モニター 10000円"), (2, "ケーブル 500円"), (3, "マウス 2000円")):
+        repo._redis.set(repo.ITEM_KEY.format(request_id),
+                        '{{"id": {0}, "user_id": "U1", "username": "alice", "text": "{1}"}}'.format(request_id, text))
+        repo._redis.sadd(repo.LEGACY_NEW_KEY, repo.ITEM_KEY.format(request_id))
+    repo.backfill_status_index()
+    repo.backfill_index()
+    # 旧形式のリクエストが残っている間は集計しない
+    eq_(repo.backfill_spend(), 0)
+    # 集計前に登録したリクエストは集計時に数え直す
+    repo.create_or_update(PurchaseRequest(repo.get_id(), "U1", "alice", "本 1000円", amount=1000))
+    repo.approve(1, "admin")
+    eq_(repo.delete("alice", "ケーブル 500円"), True)
+    eq_(repo.get_spend(SPEND_PENDING), {"U1": 1000})
+    eq_(repo.get_spend(SPEND_USER), {})
+
+    eq_(migrate(repo), 2)
+    eq_(repo.backfill_spend(), 2)
+    eq_(repo.get_spend(SPEND_PENDING), {"U1": 3000})
+    eq_(repo.get_spend(SPEND_USER), {"U1": 10000})
+    repo.approve(3, "admin")
+    eq_(repo.delete("alice", "本 1000円"), True)
+    eq_(repo.get_spend(SPEND_PENDING), {})
+    eq_(repo.get_spend(SPEND_USER), {"U1": 12000})
+    eq_(repo.get_spend(SPEND_APPROVER), {"admin": 12000})
+
+
+def test_admin_cache():
+    now = [0.0]
+    client = fakeredis.FakeStrictRedis(decode_responses=True)
+    repo = PurchaseRepo(client, admin_cache_interval=5, timer=lambda: now[0])
+    other = PurchaseRepo(client, admin_cache_interval=5, timer=lambda: now[0])
+    eq_(other.admin, frozenset())
+    repo.add_admin("U1")
+    eq_(repo.admin, frozenset(["U1"]))
+    # 他のプロセスの変更は確認間隔が過ぎるまで反映されない
+    eq_(other.admin, frozenset())
+    now[0] = 5
+    eq_(other.admin, frozenset(["U1"]))
+    repo.remove_admin("U1")
+    now[0] = 10
+    eq_(other.admin, frozenset())
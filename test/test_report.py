@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+
+import csv
+import datetime
+import io
+
+import fakeredis
+from nose.tools import eq_
+
+from purchase_bot import report
+from purchase_bot.archive import Archive
+from purchase_bot.model import PurchaseRequest, RequestStatus
+from purchase_bot.repo import PurchaseRepo
+
+
+def test_month_range():
+    start, end, label = report.month_range("レポート 2018/12")
+    eq_(label, "2018-12")
+    eq_(datetime.datetime.fromtimestamp(start), datetime.datetime(2018, 12, 1))
+    eq_(datetime.datetime.fromtimestamp(end), datetime.datetime(2019, 1, 1))
+    eq_(report.month_range("レポート"), None)
+    eq_(report.month_range("レポート 2018-13"), None)
+
+
+def test_export():
+    archive = Archive(":memory:")
+    repo = PurchaseRepo(fakeredis.FakeStrictRedis(decode_responses=True), archive=archive)
+    april = datetime.datetime(2018, 4, 10).timestamp()
+    may = datetime.datetime(2018, 5, 10).timestamp()
+    archive.put([PurchaseRequest(1, "U1", "alice", "本", RequestStatus.approved, "admin", created=april,
+                                 closed=april)])
+    for request_id, username in ((2, "alice"), (3, "bob"), (4, "bob")):
+        repo.create_or_update(PurchaseRequest(request_id, "U" + username, username, "item {}".format(request_id),
+                                              created=may))
+    repo.approve(2, "admin")
+    repo.deny(3, "boss")
+
+    f = io.BytesIO()
+    result = report.export(repo, f, chunk_size=1)
+    rows = list(csv.reader(io.StringIO(f.getvalue().decode("utf-8-sig"))))
+    eq_(rows[0], report.CSV_COLUMNS)
+    eq_(sorted(int(row[0]) for row in rows[1:]), [1, 2, 3, 4])
+    eq_(result.total, 4)
+    eq_(dict(result.by_status), {"approved": 2, "denied": 1, "new": 1})
+    eq_(dict(result.by_user), {"alice": 2, "bob": 2})
+    eq_(dict(result.by_approver), {"admin": 2, "boss": 1})
+    eq_(result.by_month["2018-04"], 1)
+    eq_(result.by_month["2018-05"], 1)
+
+    start, end, _ = report.month_range("2018-04")
+    result = report.export(repo, io.BytesIO(), start, end)
+    eq_((result.total, dict(result.by_status)), (1, {"approved": 1}))
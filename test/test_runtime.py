@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+import asyncio
+import time
+
+from nose.tools import eq_
+
+from fakes import FakeSlackClient, LatencyRedis
+from purchase_bot.bot import PurchaseBot
+from purchase_bot.repo import PurchaseRepo
+from purchase_bot.runtime import Runtime, event_key, replay
+
+
+def test_event_key():
+    eq_(event_key({"type": "message", "channel": "C1", "ts": "1.0"}), ("message", "C1", "1.0"))
+    eq_(event_key({"type": "message", "channel": "C1", "subtype": "message_deleted",
+                   "deleted_ts": "1.0", "previous_message": {"ts": "1.0"}}), ("message", "C1", "1.0"))
+    eq_(event_key({"type": "message", "channel": "D1", "user": "U1"}), ("user", "U1"))
+    eq_(event_key({"type": "presence_change"}), None)
+
+
+def test_runtime_keeps_order_per_key():
+    handled = []
+
+    def handler(event):
+        # 先に届いたイベントほど遅く終わるようにする
+        time.sleep(0.05 if event["n"] == 0 else 0)
+        handled.append(event["n"])
+
+    events = [{"k": "a", "n": 0}, {"k": "b", "n": 1}, {"k": "a", "n": 2}]
+    asyncio.run(Runtime(handler, key_func=lambda e: e["k"], max_workers=4).run(replay(events)))
+    # 別キーの 1 は 0 を待たずに処理され、同じキーの 2 は 0 の後に処理される
+    eq_(handled, [1, 0, 2])
+
+
+def test_bot_run_with_fake_source():
+    client = FakeSlackClient()
+    repo = PurchaseRepo(LatencyRedis())
+    bot = PurchaseBot(client=client, repo=repo, purchase_channel="C1")
+    events = [
+        {"type": "message", "channel": "C1", "user": "U1", "text": "本", "ts": "1.0"},
+        {"type": "message", "channel": "C1", "user": "U2", "text": "ペン", "ts": "2.0"},
+        {"type": "message", "channel": "C1", "subtype": "message_changed",
+         "message": {"text": "本 2冊", "ts": "1.0"},
+         "previous_message": {"user": "U1", "text": "本", "ts": "1.0"}},
+        {"type": "message", "channel": "C1", "subtype": "message_deleted", "deleted_ts": "2.0",
+         "previous_message": {"user": "U2", "text": "ペン", "ts": "2.0"}},
+    ]
+    asyncio.run(bot.run(replay(events)))
+    eq_([(r.username, r.text) for r in repo.get_new()], [("name-U1", "本 2冊")])
+    eq_(client.counts["reactions.add"], 2)
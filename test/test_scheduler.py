@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+
+import datetime
+
+from nose.tools import eq_
+
+from fakes import LatencyRedis
+from purchase_bot.repo import PurchaseRepo
+from purchase_bot.scheduler import Scheduler, next_daily, parse_job
+
+
+def test_run_pending():
+    client = LatencyRedis()
+    first, second = PurchaseRepo(client), PurchaseRepo(client)
+    calls = []
+
+    def remind(args, now):
+        calls.append(("remind", sorted(args), now))
+
+    def fail(args, now):
+        raise RuntimeError("boom")
+
+    scheduler = Scheduler(first, {"remind": remind, "fail": fail}, batch_size=2, retry_delay=10)
+    first.schedule({"remind:1": 100, "remind:2": 200, "remind:3": 150, "fail": 120, "remind:4": 500})
+    eq_(first.next_job_time(), 100)
+
+    eq_(scheduler.run_pending(now=50), 0)
+    eq_(calls, [])
+    # 予定時刻を過ぎたジョブを batch_size 件ずつ取り出し、種類ごとにまとめて実行する
+    eq_(scheduler.run_pending(now=200), 4)
+    eq_(calls, [("remind", ["1"], 200), ("remind", ["2", "3"], 200)])
+    # 失敗したジョブは retry_delay 秒後に実行し直す
+    eq_(client.zscore(first.SCHEDULE_KEY, "fail"), 210)
+    # 取り出したジョブは他のボットには返らない
+    eq_(second.claim_jobs(205, 10), [])
+    eq_(second.claim_jobs(1000, 10), [("fail", 210.0), ("remind:4", 500.0)])
+    eq_(first.next_job_time(), None)
+
+
+def test_next_daily():
+    now = datetime.datetime(2018, 4, 1, 10, 30).timestamp()
+    eq_(datetime.datetime.fromtimestamp(next_daily("09:00", now)), datetime.datetime(2018, 4, 2, 9, 0))
+    eq_(datetime.datetime.fromtimestamp(next_daily("18:00", now)), datetime.datetime(2018, 4, 1, 18, 0))
+    eq_(parse_job("remind:12"), ("remind", "12"))
+    eq_(parse_job("daily"), ("daily", None))
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+from nose.tools import eq_
+
+from purchase_bot.slack import RateLimitedSlackClient, TokenBucket
+
+
+class _Token:
+    token = "xoxb-test"
+
+
+class _FakeSlackHandler(BaseHTTPRequestHandler):
+    """ 応答を順番に返す Slack Web API の代わり """
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode("utf-8")
+        server = self.server
+        server.requests.append((self.path, self.headers["Authorization"], parse_qs(body),
+                                self.client_address[1]))
+        status, headers, payload = server.responses.pop(0) if server.responses else (200, {}, {"ok": True})
+        data = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def _start_server(responses):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _FakeSlackHandler)
+    server.requests = []
+    server.responses = list(responses)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def test_token_bucket():
+    now = [0.0]
+    waits = []
+
+    def sleep(seconds):
+        waits.append(seconds)
+        now[0] += seconds
+
+    bucket = TokenBucket(rate=2, burst=2, timer=lambda: now[0], sleep=sleep)
+    eq_([bucket.acquire() for _ in range(3)], [0.0, 0.0, 0.5])
+    bucket.pause(3)
+    eq_(bucket.acquire(), 3.0)
+    eq_(waits, [0.5, 3.0])
+
+
+def test_retry_after_and_connection_reuse():
+    server = _start_server([
+        (429, {"Retry-After": "0"}, {"ok": False, "error": "ratelimited"}),
+        (503, {}, {}),
+        (200, {}, {"ok": True, "channel": {"id": "D1"}}),
+    ])
+    sleeps = []
+    client = RateLimitedSlackClient(_Token(), base_url="http://127.0.0.1:{}/api".format(server.server_port),
+                                    backoff=0.01, sleep=sleeps.append)
+    try:
+        result = client.api_call("im.open", user="U1", attachments=[{"text": "a"}])
+        eq_(result["channel"]["id"], "D1")
+        eq_(client.stats, {"calls": 3, "rate_limited": 1, "retries": 2, "failures": 0})
+        path, authorization, form, _ = server.requests[0]
+        eq_((path, authorization), ("/api/im.open", "Bearer xoxb-test"))
+        eq_(form["attachments"], ['[{"text": "a"}]'])
+        # 5xx の後は backoff だけ待つ
+        eq_(0.02 in sleeps, True)
+        # 接続は使い回す
+        eq_(len({port for _, _, _, port in server.requests}), 1)
+
+        server.responses = [(429, {"Retry-After": "0"}, {"ok": False, "error": "ratelimited"})] * 4
+        result = client.api_call("users.info", user="U1")
+        eq_((result["ok"], result["error"]), (False, "ratelimited"))
+        eq_(client.stats["failures"], 1)
+    finally:
+        client.close()
+        server.shutdown()
+        server.server_close()
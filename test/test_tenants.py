@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+from nose.tools import eq_
+
+from redis.crc import key_slot
+
+from fakes import ClusterRulesRedis, FakeSlackClient, LatencyRedis
+from purchase_bot import metrics
+from purchase_bot.repo import PurchaseRepo
+from purchase_bot.tenants import MultiChannelBot
+
+
+def test_route_by_channel():
+    client = FakeSlackClient()
+    redis = LatencyRedis()
+    # 以前の単一チャンネルのボットのデータ
+    PurchaseRepo(redis)
+    bot = MultiChannelBot(channels=['C1', 'C2'], legacy_channel='C1', client=client, redis=redis)
+    for channel_bot in bot.bots.values():
+        channel_bot._outbox.min_interval = 0
+    first, second = bot.bots['C1'].repo, bot.bots['C2'].repo
+    first.add_admin('UADMIN')
+    second.add_admin('UDEV')
+    first.add_admin('UBOTH')
+    second.add_admin('UBOTH')
+
+    for channel in ('C1', 'C2', 'C2'):
+        bot._handle_message({'type': 'message', 'channel': channel, 'user': 'U1', 'text': 'item',
+                             'ts': '{}.0'.format(len(client.calls))})
+    # ID の採番と一覧はチャンネルごと
+    eq_([r.id for r in first.get_new()], [1])
+    eq_([r.id for r in second.get_new()], [1, 2])
+    # 最初のチャンネルは以前のキーのまま、他のチャンネルは同じハッシュタグのキーになる
+    eq_(redis.exists(PurchaseRepo.NEW_KEY), 1)
+    eq_(sorted({key.split(':')[1] for key in redis.keys('purchase:{*')}), ['{C2}'])
+
+    bot._handle_message({'type': 'message', 'channel': 'DUDEV', 'user': 'UDEV', 'text': '承認 2'})
+    eq_([r.id for r in second.get_approved()], [2])
+    eq_(first.get_approved(), [])
+
+    # 複数のチャンネルの承認者はチャンネルを指定する
+    bot._handle_message({'type': 'message', 'channel': 'DUBOTH', 'user': 'UBOTH', 'text': '却下 1'})
+    eq_(client.sent('chat.postMessage')[-1]['text'].split(' (')[0], '購入申請チャンネルを指定してください')
+    bot._handle_message({'type': 'message', 'channel': 'DUBOTH', 'user': 'UBOTH', 'text': '却下 <#C1|purchase> 1'})
+    eq_([r.id for r in first.get_denied()], [1])
+    # 送信キューの長さはチャンネルごとに公開する
+    lines = metrics.REGISTRY.render().splitlines()
+    eq_([line for line in lines if line.startswith('purchase_bot_queue_depth{queue="outbox"')],
+        ['purchase_bot_queue_depth{queue="outbox",channel="C1"} 0',
+         'purchase_bot_queue_depth{queue="outbox",channel="C2"} 0'])
+    eq_([r.id for r in second.get_new()], [1])
+
+
+def test_cluster_key_layout():
+    client = FakeSlackClient()
+    redis = ClusterRulesRedis()
+    # 以前のキーにデータが無ければ legacy_channel もチャンネルIDを名前空間にする
+    bot = MultiChannelBot(channels=['C1', 'C2'], legacy_channel='C1', client=client, redis=redis)
+    for channel, channel_bot in bot.bots.items():
+        channel_bot._outbox.min_interval = 0
+        channel_bot.repo.add_admin('U' + channel)
+        for i in range(1, 4):
+            bot._handle_message({'type': 'message', 'channel': channel, 'user': 'U1', 'text': 'モニター {}000円'.format(i),
+                                 'ts': '{}.0'.format(i)})
+        bot._handle_message({'type': 'message', 'channel': channel, 'subtype': 'message_changed',
+                             'previous_message': {'user': 'U1', 'text': 'モニター 1000円', 'ts': '1.0'},
+                             'message': {'text': 'キーボード 1500円'}})
+        bot._handle_message({'type': 'message', 'channel': channel, 'subtype': 'message_deleted',
+                             'previous_message': {'user': 'U1', 'text': 'モニター 2000円', 'ts': '2.0'}})
+        bot._handle_message({'type': 'message', 'channel': 'DU' + channel, 'user': 'U' + channel,
+                             'text': '承認 <#{}> 1'.format(channel)})
+        eq_([r.text for r in channel_bot.repo.search('キーボード', 10).requests], ['キーボード 1500円'])
+        eq_(channel_bot.repo.get_spend('user', 'U1'), {'U1': 1500})
+        eq_(channel_bot.repo.get_spend('pending', 'U1'), {'U1': 3000})
+    # 全てのキーはチャンネルごとのハッシュタグを持ち、チャンネルごとに 1 つのスロットに入る
+    keys = redis.keys('purchase:*')
+    eq_(sorted({key.split(':')[1] for key in keys}), ['{C1}', '{C2}'])
+    for channel in ('C1', 'C2'):
+        eq_(len({key_slot(key.encode()) for key in keys if key.startswith('purchase:{%s}' % channel)}), 1)
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+
+import time
+
+import fakeredis
+from nose.tools import eq_
+
+from fakes import LatencyRedis
+from purchase_bot.model import PurchaseRequest, RequestStatus
+from purchase_bot.repo import PurchaseRepo
+from purchase_bot.view import PendingView
+
+
+def _wait(condition, timeout=3.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+
+def test_pending_view():
+    server = fakeredis.FakeServer()
+    local, other = LatencyRedis(server=server), LatencyRedis(server=server)
+    repo, writer = PurchaseRepo(local), PurchaseRepo(other)
+    writer.create_or_update(PurchaseRequest(writer.get_id(), "U1", "alice", "本", channel="C1", ts="1.0"))
+    view = PendingView(repo).start()
+    try:
+        eq_([r.id for r in repo.get_new()], [1])
+
+        # 他のプロセスの書き込みは通知で反映される
+        writer.create_or_update(PurchaseRequest(writer.get_id(), "U2", "bob", "ペン", channel="C1", ts="2.0"))
+        writer.update("alice", "本", "辞書", "C1", "1.0")
+        _wait(lambda: view.version == 3)
+        local.reset_stats()
+        eq_([(r.id, r.text) for r in repo.get_new()], [(1, "辞書"), (2, "ペン")])
+        eq_([r.id for r in repo.new_by_user("U2")], [2])
+        eq_(repo.find_new("alice", "辞書", "C1", "1.0").id, 1)
+        eq_(repo.get(2)[0].username, "bob")
+        # 未処理リクエストの参照では Redis にアクセスしない
+        eq_(local.round_trips, 0)
+
+        # 自分の書き込みは通知を待たずに反映される
+        repo.approve(1, "admin")
+        eq_([r.id for r in repo.get_new()], [2])
+        eq_(repo.get(1)[0].status, RequestStatus.approved)
+
+        # 通知を取りこぼした場合は読み込み直す
+        other.set(writer.PENDING_VERSION_KEY, 10)
+        writer.delete("bob", "ペン", "C1", "2.0")
+        _wait(lambda: view.version == 11)
+        eq_(view.resyncs, 2)
+        eq_(repo.get_new(), [])
+    finally:
+        view.stop()
+    eq_(repo.view, None)